@@ -1,9 +1,19 @@
+import importlib
 
 from . import data
 from . import utils
-from . import uiutil
-from . import encoder
-from . import analyze
+from . import trajstore
+
+#-- Modules that import GUI libraries (or many other modules) are imported on first use, so that scripts that
+#-- only need the core data modules start fast
+_lazy_modules = ('uiutil', 'encoder', 'analyze')
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '{:}' has no attribute '{:}'".format(__name__, name))
+
 
 def version():
     return 0, 0, 1
@@ -1,3 +1,12 @@
+import importlib
 
 from . import transform
-from . import plots
+
+#-- plots imports matplotlib, so it is imported on first use (analyze.plots)
+_lazy_modules = ('plots', )
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '{:}' has no attribute '{:}'".format(__name__, name))
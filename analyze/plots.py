@@ -1,4 +1,9 @@
 import math
+import os
+import shutil
+import tempfile
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from matplotlib.backends.backend_pdf import PdfPages
 
@@ -7,6 +12,7 @@ import matplotlib.pyplot as plt
 from matplotlib import patches
 
 from analyze.transform import get_bounding_box
+import data
 import utils as u
 
 
@@ -33,13 +39,13 @@ def plot_trial(trial, n_colors=10, get_z_levels=None, ax=None, decorations=None)
 
     lightest_color = 0.95
 
-    points = trial.on_paper_points
+    points = data.Trajectory.from_points(trial.on_paper_points)
     if len(points) == 0:
         return
 
-    x = np.array([point.x for point in points])
-    y = np.array([point.y for point in points])
-    z = np.array([point.z for point in points])
+    x = points.x
+    y = points.y
+    z = points.z
     # minz = int(min(z))
     if get_z_levels is None:
         z = _convert_z_to_level(z, max(z), n_colors)
@@ -52,24 +58,19 @@ def plot_trial(trial, n_colors=10, get_z_levels=None, ax=None, decorations=None)
     if decorations is not None:
         _draw_trial_rectangles(trial, ax, decorations)
 
-    for z_level in range(n_colors+1):
-        inds = z == z_level
-        if sum(inds) > 0:
-            color = lightest_color * (1 - z_level/n_colors)
-            #before:
-            color = (color, ) * 3
-
-            #c = int(minz/10)
-            #mult = c if (c>3 and c< 5) else 3
-            #color = (color, ) * (int(mult))
-            ax.scatter(x[inds], y[inds], color=color, s=4)
+    #-- All points are drawn by one scatter; the darker (higher-pressure) points are drawn on top of the lighter ones
+    inds = np.flatnonzero((z >= 0) & (z <= n_colors))
+    inds = inds[np.argsort(z[inds], kind='stable')]
+    if len(inds) > 0:
+        gray = lightest_color * (1 - z[inds] / n_colors)
+        ax.scatter(x[inds], y[inds], c=np.repeat(gray[:, np.newaxis], 3, axis=1), s=4)
 
     if decorations is not None:
         _draw_trial_rectangles(trial, ax, decorations)
 
 
 #------------------------------------------------------------------------------
-def plot_trials(exp, out_fn, cols_per_page=2, rows_per_page=5, n_colors=10, max_trials=None, decorations=None):
+def plot_trials(exp, out_fn, cols_per_page=2, rows_per_page=5, n_colors=10, max_trials=None, decorations=None, n_workers=1):
     """
     Plot the experiment raw data - the characters, as the subject wrote them - and save to a PDF file.
 
@@ -79,41 +80,69 @@ def plot_trials(exp, out_fn, cols_per_page=2, rows_per_page=5, n_colors=10, max_
     :param rows_per_page: No. of trial rows in each page
     :param n_colors: No. of colors to use to denote level of pressure
     :param max_trials: Plot only the first trials in the experiment
+    :param n_workers: No. of processes that render the pages in parallel. Each process renders a range of pages to
+                      a separate PDF file, and these files are then merged. This requires the pypdf package;
+                      without it, the pages are rendered serially (with a warning).
     """
 
     n_trials_per_page = cols_per_page * rows_per_page
 
-    pdf = PdfPages(out_fn)
     trials = list(exp.sorted_trials)
-    z_values = np.array([point.z for t in trials for point in t.on_paper_points])
-    max_z = max(z_values)
-    def get_z_levels(z):
-        return _convert_z_to_level(z, max_z, n_colors)
+    max_z = max(np.max(data.Trajectory.from_points(t.on_paper_points).z, initial=0) for t in trials) if len(trials) > 0 else 0
 
     if max_trials is not None:
         trials = trials[:min(max_trials, len(trials))]
 
-    n_pages = math.ceil(len(trials) / n_trials_per_page)
+    pages = [trials[i:i + n_trials_per_page] for i in range(0, len(trials), n_trials_per_page)]
+    n_pages = len(pages)
 
     progress = u.ProgressBar(len(trials), 'Preparing pdf...')
+
+    if n_workers > 1 and n_pages > 1 and _pypdf() is None:
+        warnings.warn('plot_trials(): n_workers={:} was ignored and the pages are rendered serially, because the pypdf '
+                      'package (needed for merging the PDF files) is not installed'.format(n_workers))
+        n_workers = 1
+
+    if n_workers > 1 and n_pages > 1:
+        _plot_pages_parallel(pages, out_fn, cols_per_page, rows_per_page, n_colors, max_z, decorations, n_workers, progress)
+    else:
+        _plot_pages(pages, out_fn, cols_per_page, rows_per_page, n_colors, max_z, decorations, progress=progress.progress)
+
+    if n_pages > 3:
+        print('')
+
+
+#------------------------------------------------------------------------------
+def _plot_pages(pages, out_fn, cols_per_page, rows_per_page, n_colors, max_z, decorations, progress=None):
+    """
+    Plot the given pages (each is a list of trials) to a PDF file
+
+    :param progress: Function called with the number of trials plotted so far, after each page
+    """
+
+    n_trials_per_page = cols_per_page * rows_per_page
+
+    def get_z_levels(z):
+        return _convert_z_to_level(z, max_z, n_colors)
+
+    pdf = PdfPages(out_fn)
     n_done = 0
 
-    while len(trials) > 0:
+    for page_trials in pages:
 
-        curr_page_n_trials = min(n_trials_per_page, len(trials))
+        curr_page_n_trials = len(page_trials)
         fig, axes = plt.subplots(rows_per_page, cols_per_page)
         fig.subplots_adjust(hspace=.8, wspace=0.3)
 
         axes = np.reshape(axes, [n_trials_per_page])
 
-        for i in range(curr_page_n_trials):
-            trial = trials.pop(0)
+        for i, trial in enumerate(page_trials):
             n_done += 1
             ax = axes[i]
             ax.get_yaxis().set_visible(False)
             ax.get_xaxis().set_visible(False)
             ax.set_title(_trial_title(trial), fontdict=dict(fontsize=5))
-            plot_trial(trial, ax=ax, get_z_levels=get_z_levels, decorations=decorations)
+            plot_trial(trial, ax=ax, get_z_levels=get_z_levels, n_colors=n_colors, decorations=decorations)
 
         if curr_page_n_trials < n_trials_per_page:
             for i in range(curr_page_n_trials, n_trials_per_page):
@@ -124,12 +153,62 @@ def plot_trials(exp, out_fn, cols_per_page=2, rows_per_page=5, n_colors=10, max_
         pdf.savefig(fig)
         plt.close(fig)
 
-        progress.progress(n_done)
+        if progress is not None:
+            progress(n_done)
 
     pdf.close()
 
-    if n_pages > 3:
-        print('')
+    return n_done
+
+
+#------------------------------------------------------------------------------
+def _plot_pages_parallel(pages, out_fn, cols_per_page, rows_per_page, n_colors, max_z, decorations, n_workers, progress):
+    """
+    Plot the pages in worker processes - each process plots a range of pages to a temporary PDF file - and merge
+    the temporary files, in order, into the output file
+    """
+
+    pypdf = _pypdf()
+
+    #-- A few page ranges per worker, so the workers stay busy when some pages take longer than others
+    n_shards = min(len(pages), n_workers * 4)
+    shard_size = math.ceil(len(pages) / n_shards)
+    shards = [pages[i:i + shard_size] for i in range(0, len(pages), shard_size)]
+
+    tmp_dir = tempfile.mkdtemp(prefix='plot_trials_', dir=os.path.dirname(os.path.abspath(out_fn)))
+    try:
+        shard_filenames = [os.path.join(tmp_dir, 'pages_{:05d}.pdf'.format(i)) for i in range(len(shards))]
+
+        n_done = 0
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_plot_pages, shard, shard_fn, cols_per_page, rows_per_page, n_colors, max_z, decorations)
+                       for shard, shard_fn in zip(shards, shard_filenames)]
+            for future in as_completed(futures):
+                n_done += future.result()
+                progress.progress(n_done)
+
+        writer = pypdf.PdfWriter()
+        for shard_fn in shard_filenames:
+            writer.append(shard_fn)
+
+        tmp_out_fn = out_fn + '.tmp'
+        with open(tmp_out_fn, 'wb') as fp:
+            writer.write(fp)
+        writer.close()
+        os.replace(tmp_out_fn, out_fn)
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+#------------------------------------------------------------------------------
+def _pypdf():
+    """ The pypdf module, which is needed for merging PDF files (None if it's not installed) """
+    try:
+        import pypdf
+        return pypdf
+    except ImportError:
+        return None
 
 
 #-------------------------------------------------------------
@@ -146,7 +225,8 @@ def _trial_title(trial):
         title += '(#{:})'.format(trial.target_id)
 
     if trial.stimulus is not None:
-        if trial.stimulus.isnumeric:
+        #-- Numeric strings are shown as they are (e.g. leading zeros are kept); only real ints get thousands separators
+        if isinstance(trial.stimulus, (int, np.integer)) and not isinstance(trial.stimulus, bool):
             title += ': {:,d}'.format(trial.stimulus)
         else:
             title += ': {:}'.format(trial.stimulus)
@@ -2,18 +2,22 @@
 Transform the encoder data
 """
 import csv
+import os
+import pickle
+import warnings
 import numpy as np
 from collections import namedtuple
-from copy import copy
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 
-import math
+import data
 
 CharInfo = namedtuple('CharInfo', ['character', 'csv_row'])
 
 #-----------------------------------------------------------------------------------------------------
 class AggFunc(object):
 
-    def __init__(self, func, out_fields, apply_per_char=True, get_prev_aggregations=False):
+    def __init__(self, func, out_fields, apply_per_char=True, get_prev_aggregations=False, in_fields=None):
         """
 
         :param func: Aggregation function. It can be either of:
@@ -21,9 +25,14 @@ class AggFunc(object):
             - function(trial, csv_rows) - runs on all characters. Returns a list with one element per character, which is an
                                           aggregated value or a list/tuple of aggregated values.
                                           The csv_rows argument is the output of previous aggregation functions: a char_num->info dict,
-                                          where "info" is a dict with the results of previous aggregation functions
+                                          where "info" is a read-only dict with the results of previous aggregation functions
         :param out_fields: Name(s) of the functino's output fields
         :param apply_per_char: indicates whether the "func" parameter works on one character or on the whole trial
+        :param in_fields: Name(s) of the fields that the function needs from other aggregation functions (implies
+                          get_prev_aggregations). The function runs after the functions that produce these fields, and
+                          sees only these fields (and the character's identification fields).
+                          If get_prev_aggregations=True without in_fields, the function runs after all the functions
+                          that precede it in the list, and sees all their fields.
         """
 
         if isinstance(out_fields, str):
@@ -33,35 +42,179 @@ class AggFunc(object):
         else:
             raise ValueError('Invalid "out_fields" argument - expecting either a field name or a list of field names')
 
+        if isinstance(in_fields, str):
+            in_fields = (in_fields, )
+        elif in_fields is not None:
+            if not is_collection(in_fields):
+                raise ValueError('Invalid "in_fields" argument - expecting either a field name or a list of field names')
+            in_fields = tuple(in_fields)
+
         assert isinstance(apply_per_char, bool)
         assert isinstance(get_prev_aggregations, bool)
 
         self.func = func
         self.out_fields = out_fields
         self.apply_per_char = apply_per_char
-        self.get_prev_aggregations = get_prev_aggregations
+        self.get_prev_aggregations = get_prev_aggregations or in_fields is not None
+        self.in_fields = in_fields
+
+
+#-----------------------------------------------------------------------------------------------------
+class VectorAggFunc(object):
+
+    def __init__(self, func, out_fields):
+        """
+        A vectorized aggregation: it computes its values for all characters of all trials at once.
+
+        :param func: function(char_table, prev_agg) - char_table is a CharacterTable; prev_agg is a dict with the results
+                     of the previous vectorized aggregation functions (field name -> array with one value per character).
+                     Returns an array with one value per character in the table, or a tuple of such arrays (one per
+                     output field). NaN values are saved as empty values.
+        :param out_fields: Name(s) of the function's output fields
+        """
+
+        if isinstance(out_fields, str):
+            out_fields = [out_fields]
+        elif is_collection(out_fields):
+            out_fields = tuple(out_fields)
+        else:
+            raise ValueError('Invalid "out_fields" argument - expecting either a field name or a list of field names')
+
+        self.func = func
+        self.out_fields = out_fields
+
+
+#-----------------------------------------------------------------------------------------------------
+class CharacterTable(object):
+    """
+    Columnar data of all characters of several trials, for vectorized aggregation functions.
+
+    Character #i of the table is characters[i], which belongs to trials[trial_ind[i]].
+    Its on-paper points are x[offsets[i]:offsets[i+1]], y[offsets[i]:offsets[i+1]] (possibly none).
+    pre_char_delay and post_char_delay are the durations of the above-paper strokes before/after the character.
+    """
+
+    def __init__(self, trials, char_filter=None):
+
+        self.trials = list(trials)
+        self.characters = []
+        trial_ind = []
+        n_points = [0]
+        x_parts = []
+        y_parts = []
+        space_times = []
+
+        for i, trial in enumerate(self.trials):
+            characters = trial.characters if (char_filter is None) else [c for c in trial.characters if char_filter(c, trial)]
+            for character in characters:
+                self.characters.append(character)
+                trial_ind.append(i)
+
+                n = 0
+                for stroke in character.strokes:
+                    if stroke.on_paper:
+                        traj = _columnar(stroke.trajectory)
+                        x_parts.append(traj.x)
+                        y_parts.append(traj.y)
+                        n += len(traj)
+                n_points.append(n)
+
+                space_times.append(_space_start_end(character.pre_char_space) + _space_start_end(character.post_char_space))
+
+        self.trial_ind = np.array(trial_ind, dtype=int)
+        self.char_num = np.array([c.char_num for c in self.characters], dtype=int)
+        self.offsets = np.cumsum(n_points)
+        self.x = np.concatenate(x_parts) if len(x_parts) > 0 else np.zeros(0)
+        self.y = np.concatenate(y_parts) if len(y_parts) > 0 else np.zeros(0)
+
+        space_times = np.array(space_times, dtype=float).reshape(-1, 4)
+        self.pre_char_delay = np.nan_to_num(space_times[:, 1] - space_times[:, 0], nan=0.0)
+        self.post_char_delay = np.nan_to_num(space_times[:, 3] - space_times[:, 2], nan=0.0)
+
+
+    @property
+    def n_chars(self):
+        return len(self.characters)
+
+
+    @property
+    def n_points(self):
+        """ The number of on-paper points per character """
+        return np.diff(self.offsets)
+
+
+    def segment_min(self, values):
+        """ The minimal value per character (NaN for characters without points) """
+        return segment_reduce(np.minimum, values, self.offsets)
+
+
+    def segment_max(self, values):
+        """ The maximal value per character (NaN for characters without points) """
+        return segment_reduce(np.maximum, values, self.offsets)
+
+
+    def prev_char_ind(self):
+        """
+        For each character, the index of the character with the previous char_num in the same trial (-1 if there
+        is no such character in the table)
+        """
+        return self._neighbor_char_ind(-1)
+
+
+    def next_char_ind(self):
+        """
+        For each character, the index of the character with the next char_num in the same trial (-1 if there
+        is no such character in the table)
+        """
+        return self._neighbor_char_ind(1)
+
+
+    def _neighbor_char_ind(self, delta):
+        key_to_ind = {key: i for i, key in enumerate(zip(self.trial_ind.tolist(), self.char_num.tolist()))}
+        return np.array([key_to_ind.get((t, c + delta), -1) for t, c in zip(self.trial_ind.tolist(), self.char_num.tolist())], dtype=int)
+
+
+#--------------------------------------------------
+def _columnar(trajectory):
+    return trajectory if isinstance(trajectory, data.Trajectory) else data.Trajectory.from_points(trajectory)
+
+
+def _space_start_end(space_stroke):
+    """ The times of the first and last points of an above-paper stroke (NaN if there is no such stroke) """
+    if space_stroke is None:
+        return np.nan, np.nan
+    t = _columnar(space_stroke.trajectory).t
+    return (t[0], t[-1]) if len(t) > 0 else (np.nan, np.nan)
 
 
 #-----------------------------------------------------------------------------------------------------
-def aggregate_characters(trials, agg_func_specs=(), subj_id=None, trial_filter=None, char_filter=None, out_filename=None, save_as_attr=False):
+def aggregate_characters(trials, agg_func_specs=(), subj_id=None, trial_filter=None, char_filter=None, out_filename=None, save_as_attr=False,
+                         n_workers=1):
     """
     Compute an aggregate value (or values) per trajectory section, and potentially save to CSV
 
     :param trials: A list of :class:`Trial` objects
     :param agg_func_specs: A list of functions that compute the aggregate values.
-             Each element in the list is an AggFunc object.
+             Each element in the list is an AggFunc object or a VectorAggFunc object. The vectorized (VectorAggFunc)
+             aggregations are computed first, for all trials at once, so AggFunc functions see their results.
+             The AggFunc functions run in an order that respects their dependencies (see AggFunc's in_fields).
     :param trial_filter: Function for filtering trials: function(trial) -> bool (return False for trials to exclude)
     :param char_filter: Function for filtering trials: function(character, trial) -> bool (return False for trials to exclude)
                              (return False for trajectory sections to exclude)
     :param out_filename: File name in which the return value will be saved (CSV format)
     :param save_as_attr: Whether to save the aggregate values as attributes of each character. The attribute name is identical with
                          the CSV field name.
+    :param n_workers: The number of processes that apply the AggFunc functions, each to a chunk of trials. This
+                      requires the AggFunc functions and char_filter to be picklable (module-level functions, not
+                      lambdas or closures) and save_as_attr=False; otherwise, the functions are applied serially
+                      (with a warning).
+    :return: The aggregated rows (a list of dicts, one per character)
     """
 
     assert len(agg_func_specs) > 0, "No aggregation functions were provided"
     for func_spec in agg_func_specs:
-        assert isinstance(func_spec, AggFunc), \
-            'Invalid aggregation function specification ({:}): expecting an AggFunc object'.format(func_spec)
+        assert isinstance(func_spec, (AggFunc, VectorAggFunc)), \
+            'Invalid aggregation function specification ({:}): expecting an AggFunc or VectorAggFunc object'.format(func_spec)
 
     #-- Filter trials
     if trial_filter is not None:
@@ -71,8 +224,12 @@ def aggregate_characters(trials, agg_func_specs=(), subj_id=None, trial_filter=N
     csv_rows = []
     n_errors = 0
 
-    for trial in trials:
+    vector_specs = [f for f in agg_func_specs if isinstance(f, VectorAggFunc)]
+    callback_specs = [f for f in agg_func_specs if isinstance(f, AggFunc)]
+    schedule = _schedule_aggregations(callback_specs, [field for f in vector_specs for field in f.out_fields])
 
+    trials_with_chars = []
+    for trial in trials:
 
         if len(trial.characters) == 0:
             continue
@@ -83,7 +240,35 @@ def aggregate_characters(trials, agg_func_specs=(), subj_id=None, trial_filter=N
         #     n_errors += 1
         #     continue
 
-        trial_rows = _apply_aggregation_functions_to_trial(agg_func_specs, trial, subj_id, char_filter, save_as_attr)
+        trials_with_chars.append(trial)
+
+    trials = trials_with_chars
+
+    #-- Vectorized aggregations are computed for all trials at once; the callback aggregations are then applied per trial
+    if len(vector_specs) > 0:
+        vector_rows = _apply_vector_aggregation_functions(vector_specs, trials, subj_id, char_filter, save_as_attr)
+    else:
+        vector_rows = None
+
+    if len(callback_specs) == 0:
+        rows_per_trial = [vector_rows[id(trial)] for trial in trials]
+
+    else:
+        trial_vector_rows = [None if vector_rows is None else vector_rows[id(trial)] for trial in trials]
+
+        if n_workers > 1 and len(trials) > 1 and not _can_apply_in_processes(schedule, char_filter, save_as_attr):
+            warnings.warn('aggregate_characters(): n_workers={:} was ignored and the aggregation functions are applied '
+                          'serially, because save_as_attr=True or the functions cannot be pickled'.format(n_workers))
+            n_workers = 1
+
+        if n_workers > 1 and len(trials) > 1:
+            rows_per_trial = _apply_aggregation_functions_in_processes(schedule, trials, subj_id, char_filter,
+                                                                       trial_vector_rows, n_workers)
+        else:
+            rows_per_trial = _apply_aggregation_functions_to_trials(schedule, trials, subj_id, char_filter, save_as_attr,
+                                                                    trial_vector_rows)
+
+    for trial_rows in rows_per_trial:
         csv_rows.extend(trial_rows)
 
     if n_errors > 0:
@@ -91,34 +276,235 @@ def aggregate_characters(trials, agg_func_specs=(), subj_id=None, trial_filter=N
 
     #-- Save to CSV
     if out_filename is not None:
-        csv_fieldnames = ([] if subj_id is None else ['subject']) + \
-                        ['trial_id', 'target_id', 'target', 'char_num', 'char'] + \
-                        [field for func_spec in agg_func_specs for field in func_spec.out_fields]
-        with open(out_filename, 'w') as fp:
-            writer = csv.DictWriter(fp, csv_fieldnames, lineterminator='\n')
-            writer.writeheader()
-            for row in csv_rows:
-                writer.writerow(row)
+        save_aggregations(csv_rows, agg_func_specs, out_filename, subject_column=subj_id is not None)
+
+    return csv_rows
+
+
+#--------------------------------------------------
+def upsert_aggregations(csv_rows, trial_ids, agg_func_specs, out_filename, subj_id=None, valid_trial_ids=None):
+    """
+    Update a CSV file that was created by aggregate_characters() without re-processing all trials:
+    replace the rows of the given trials with the given (newly aggregated) rows.
+
+    :param csv_rows: The rows returned by aggregate_characters() for the updated trials
+    :param trial_ids: The IDs of the updated trials. Their old rows are removed from the file.
+    :param agg_func_specs: The aggregation functions that were used (to determine the CSV fields)
+    :param out_filename: The CSV file. If it doesn't exist, it will be created.
+    :param valid_trial_ids: If provided, rows of any other trial are removed from the file too
+    """
+
+    csv_fieldnames = _aggregations_csv_fieldnames(agg_func_specs, subj_id is not None)
+    trial_ids = set(str(tid) for tid in trial_ids)
+    valid_trial_ids = None if valid_trial_ids is None else set(str(tid) for tid in valid_trial_ids)
+
+    old_rows = []
+    if os.path.isfile(out_filename):
+        with open(out_filename, 'r') as fp:
+            reader = csv.DictReader(fp)
+            if reader.fieldnames is not None and list(reader.fieldnames) != csv_fieldnames:
+                raise ValueError('Invalid format for CSV file {:}: expecting fields {:} but found {:}'
+                                 .format(out_filename, ", ".join(csv_fieldnames), ", ".join(reader.fieldnames)))
+            old_rows = list(reader)
+
+    #-- The new rows are placed where the trial's old rows were (or at the end, for a new trial)
+    new_rows = []
+    inserted = False
+    for row in old_rows:
+        if row['trial_id'] in trial_ids:
+            if not inserted:
+                new_rows.extend(csv_rows)
+                inserted = True
+        elif valid_trial_ids is None or row['trial_id'] in valid_trial_ids:
+            new_rows.append(row)
+
+    if not inserted:
+        new_rows.extend(csv_rows)
+
+    _save_aggregations_csv(new_rows, csv_fieldnames, out_filename)
+
+
+#--------------------------------------------------
+def save_aggregations(csv_rows, agg_func_specs, out_filename, subject_column=True):
+    """
+    Save rows returned by aggregate_characters() to a CSV file - e.g., the rows of several subjects in one file.
+
+    :param agg_func_specs: The aggregation functions that were used (to determine the CSV fields)
+    :param subject_column: Whether the file has a 'subject' column (the rows were aggregated with a subj_id)
+    """
+    _save_aggregations_csv(csv_rows, _aggregations_csv_fieldnames(agg_func_specs, subject_column), out_filename)
+
+
+#--------------------------------------------------
+def _aggregations_csv_fieldnames(agg_func_specs, subject_column):
+    return (['subject'] if subject_column else []) + \
+           ['trial_id', 'target_id', 'target', 'char_num', 'char'] + \
+           [field for func_spec in agg_func_specs for field in func_spec.out_fields]
+
+
+#--------------------------------------------------
+def _save_aggregations_csv(csv_rows, csv_fieldnames, out_filename):
+    """
+    Write the file under a temporary name and then rename it, so a crash never leaves a truncated file
+    """
+    tmp_filename = out_filename + '.tmp'
+    with open(tmp_filename, 'w') as fp:
+        writer = csv.DictWriter(fp, csv_fieldnames, lineterminator='\n')
+        writer.writeheader()
+        for row in csv_rows:
+            writer.writerow(row)
+    os.replace(tmp_filename, out_filename)
+
+
+#--------------------------------------------------
+_char_id_fields = ('subject', 'trial_id', 'target_id', 'target', 'char_num', 'char')
+
+
+#--------------------------------------------------
+def _schedule_aggregations(agg_func_specs, available_fields=()):
+    """
+    Order the AggFunc functions so that each function runs after the functions that produce its input fields.
+    Functions that don't depend on each other keep their original order.
+
+    :param available_fields: Fields that were computed before these functions run
+    :return: A list of (agg_func_spec, prev_fields) in execution order. prev_fields are the fields that the function
+             can see in its "prev_agg" argument (None if the function doesn't get this argument).
+    """
+
+    available_fields = set(_char_id_fields) | set(available_fields)
+
+    producer = {}
+    for i, spec in enumerate(agg_func_specs):
+        for field in spec.out_fields:
+            if field in producer or field in available_fields:
+                raise ValueError('The field "{:}" is produced by more than one aggregation function'.format(field))
+            producer[field] = i
+
+    dependencies = []
+    prev_fields = []
+    for i, spec in enumerate(agg_func_specs):
+
+        if not spec.get_prev_aggregations:
+            dependencies.append(set())
+            prev_fields.append(None)
+
+        elif spec.in_fields is None:
+            #-- The function sees all fields of the functions that precede it
+            dependencies.append(set(range(i)))
+            prev_fields.append(frozenset(available_fields.union(*[agg_func_specs[j].out_fields for j in range(i)])))
+
+        else:
+            missing = [f for f in spec.in_fields if f not in producer and f not in available_fields]
+            if len(missing) > 0:
+                raise ValueError('The aggregation function {:} needs the field(s) {:}, which no aggregation function produces'
+                                 .format(spec.func, ", ".join(missing)))
+            dependencies.append({producer[f] for f in spec.in_fields if f in producer})
+            prev_fields.append(frozenset(available_fields.union(spec.in_fields)))
+
+    order = []
+    done = set()
+    while len(order) < len(agg_func_specs):
+        ready = [i for i in range(len(agg_func_specs)) if i not in done and dependencies[i] <= done]
+        if len(ready) == 0:
+            raise ValueError('Circular dependency between the aggregation functions {:}'
+                             .format(", ".join(str(agg_func_specs[i].func) for i in range(len(agg_func_specs)) if i not in done)))
+        order.extend(ready)
+        done.update(ready)
+
+    return [(agg_func_specs[i], prev_fields[i]) for i in order]
+
+
+#--------------------------------------------------
+class _FieldsView(Mapping):
+    """
+    Read-only access to some of the fields of a CSV row, without copying it
+    """
+
+    __slots__ = ('_row', '_fields')
+
+    def __init__(self, row, fields):
+        self._row = row
+        self._fields = fields
+
+    def __getitem__(self, field):
+        if field not in self._fields:
+            raise KeyError(field)
+        return self._row[field]
+
+    def __iter__(self):
+        return (field for field in self._row if field in self._fields)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+#--------------------------------------------------
+def _can_apply_in_processes(schedule, char_filter, save_as_attr):
+    """
+    Whether the AggFunc functions can run in worker processes: the values they save as attributes would be lost,
+    and lambdas/closures cannot be sent to the processes
+    """
+    if save_as_attr:
+        return False
+    try:
+        pickle.dumps((schedule, char_filter))
+        return True
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+
+
+#--------------------------------------------------
+def _apply_aggregation_functions_in_processes(schedule, trials, subj_id, char_filter, trial_vector_rows, n_workers):
+    """
+    Apply the AggFunc functions by a pool of processes, each process to a chunk of consecutive trials.
+    Return the rows per trial, in the trials' order.
+    """
+
+    n_chunks = min(len(trials), n_workers * 4)
+    bounds = np.linspace(0, len(trials), n_chunks + 1).astype(int)
+    chunks = [(trials[start:end], trial_vector_rows[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    rows_per_trial = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for chunk_rows in executor.map(_apply_aggregation_functions_to_trials, [schedule] * n_chunks, [c[0] for c in chunks],
+                                       [subj_id] * n_chunks, [char_filter] * n_chunks, [False] * n_chunks, [c[1] for c in chunks]):
+            rows_per_trial.extend(chunk_rows)
+
+    return rows_per_trial
+
+
+#--------------------------------------------------
+def _apply_aggregation_functions_to_trials(schedule, trials, subj_id, char_filter, save_as_attr, trial_vector_rows):
+    """
+    :param trial_vector_rows: Per trial, its rows with the vectorized aggregations (or None)
+    :return: The rows per trial
+    """
+    return [_apply_aggregation_functions_to_trial(schedule, trial, subj_id, char_filter, save_as_attr, csv_rows=rows)
+            for trial, rows in zip(trials, trial_vector_rows)]
 
 
 #--------------------------------------------------
-def _apply_aggregation_functions_to_trial(agg_func_specs, trial, subj_id, char_filter, save_as_attr):
+def _apply_aggregation_functions_to_trial(schedule, trial, subj_id, char_filter, save_as_attr, csv_rows=None):
+    """
+    :param schedule: The aggregation functions to apply (see _schedule_aggregations)
+    :param csv_rows: The trial's rows, if some aggregations were already computed (one row per filtered character)
+    """
     print("trial: "+ str(trial))
     characters = trial.characters if (char_filter is None) else [c for c in trial.characters if char_filter(c, trial)]
 
     #-- Create result object (not yet filled) per character
-    char_infos = [CharInfo(character,
-                           dict(subject='' if subj_id is None else subj_id,
-                                trial_id=trial.trial_id,
-                                target_id=trial.target_id,
-                                target=trial.stimulus,
-                                char_num=character.char_num,
-                                char=trial.response[character.char_num-1])) for character in characters]
-    #char=trial.response[character.char_num - 1]
+    if csv_rows is None:
+        csv_rows = [_new_csv_row(trial, character, subj_id) for character in characters]
+    char_infos = [CharInfo(character, csv_row) for character, csv_row in zip(characters, csv_rows)]
+    char_info_per_char_num = {ci.csv_row['char_num']: ci for ci in char_infos}
+
     #-- Apply aggregation functions
-    for agg_func_spec in agg_func_specs:
+    for agg_func_spec, prev_fields in schedule:
 
-        csv_row_per_char = {ci.csv_row['char_num']: copy(ci.csv_row) for ci in char_infos} if agg_func_spec.get_prev_aggregations else None
+        if prev_fields is None:
+            csv_row_per_char = None
+        else:
+            csv_row_per_char = {char_num: _FieldsView(ci.csv_row, prev_fields) for char_num, ci in char_info_per_char_num.items()}
 
         if agg_func_spec.apply_per_char:
             #-- The aggregation fuction should be called per character
@@ -140,14 +526,73 @@ def _apply_aggregation_functions_to_trial(agg_func_specs, trial, subj_id, char_f
             assert len(agg_values) == len(trial.characters)
 
             for agg_value, character in zip(agg_values, trial.characters):
-                if characters.char_num in csv_row_per_char:
-                    _save_aggregated_value_on_character(agg_value, character, csv_row_per_char[character.char_num],
+                if character.char_num in char_info_per_char_num:
+                    _save_aggregated_value_on_character(agg_value, character, char_info_per_char_num[character.char_num].csv_row,
                                                         agg_func_spec.out_fields, agg_func_spec.func, save_as_attr)
 
 
     return [ci.csv_row for ci in char_infos]
 
 
+#--------------------------------------------------
+def _new_csv_row(trial, character, subj_id):
+    return dict(subject='' if subj_id is None else subj_id,
+                trial_id=trial.trial_id,
+                target_id=trial.target_id,
+                target=trial.stimulus,
+                char_num=character.char_num,
+                char=trial.response[character.char_num-1])
+
+
+#--------------------------------------------------
+def _apply_vector_aggregation_functions(agg_func_specs, trials, subj_id, char_filter, save_as_attr):
+    """
+    Apply the vectorized aggregation functions to all characters of all trials.
+
+    :return: dict: id(trial) -> the trial's rows
+    """
+
+    table = CharacterTable(trials, char_filter)
+
+    rows_per_trial = {id(trial): [] for trial in trials}
+    csv_rows = []
+    for trial_ind, character in zip(table.trial_ind.tolist(), table.characters):
+        trial = table.trials[trial_ind]
+        csv_row = _new_csv_row(trial, character, subj_id)
+        rows_per_trial[id(trial)].append(csv_row)
+        csv_rows.append(csv_row)
+
+    prev_agg = {}
+
+    for agg_func_spec in agg_func_specs:
+
+        agg_values = agg_func_spec.func(table, prev_agg)
+        if len(agg_func_spec.out_fields) == 1:
+            agg_values = [agg_values]
+        elif len(agg_values) != len(agg_func_spec.out_fields):
+            raise ValueError("the aggregation function {:} was expected to return {:} arrays ({:}) but it returned {:} arrays".
+                             format(agg_func_spec.func, len(agg_func_spec.out_fields), ", ".join(agg_func_spec.out_fields), len(agg_values)))
+
+        for field, values in zip(agg_func_spec.out_fields, agg_values):
+            values = np.asarray(values)
+            if len(values) != table.n_chars:
+                raise ValueError("the aggregation function {:} returned {:} values for field '{:}', expecting one value per character ({:})".
+                                 format(agg_func_spec.func, len(values), field, table.n_chars))
+            prev_agg[field] = values
+
+            missing = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(len(values), dtype=bool)
+            for csv_row, character, value, is_missing in zip(csv_rows, table.characters, values.tolist(), missing.tolist()):
+                value = None if is_missing else value
+                csv_row[field] = value
+                if save_as_attr:
+                    try:
+                        setattr(character, field, value)
+                    except AttributeError:
+                        raise AttributeError("Can't set attribute '{:}' of character".format(field))
+
+    return rows_per_trial
+
+
 #--------------------------------------------------
 def _save_aggregated_value_on_character(agg_values, character, csv_row, field_names, func, save_as_char_attr):
 
@@ -188,6 +633,68 @@ class GetBoundingBox(object):
         return result[:4]
 
 
+#-----------------------------------------------------------------------------------------------------
+class VectorBoundingBox(object):
+    """
+    Get the bounding-box of each character (like GetBoundingBox), for all characters at once.
+    Use it with VectorAggFunc and the output fields ('x', 'width', 'y', 'height').
+    """
+
+    def __init__(self, fraction_of_x_points=None, fraction_of_y_points=None):
+        assert fraction_of_x_points is None or 0 < fraction_of_x_points <= 1
+        assert fraction_of_y_points is None or 0 < fraction_of_y_points <= 1
+        self.fraction_of_x_points = fraction_of_x_points
+        self.fraction_of_y_points = fraction_of_y_points
+
+
+    def __call__(self, char_table, prev_agg):
+        xmin, xmax = find_intervals_containing(char_table.x, char_table.offsets, self.fraction_of_x_points)
+        ymin, ymax = find_intervals_containing(char_table.y, char_table.offsets, self.fraction_of_y_points)
+
+        w = xmax - xmin
+        h = ymax - ymin
+
+        return xmin + w / 2, w, ymin + h / 2, h
+
+
+#----------------------------------------------------------------
+def vector_pre_char_delay(char_table, prev_agg):
+    """ The delay between each character and the previous one (rounded) """
+    return np.round(char_table.pre_char_delay).astype(int)
+
+
+def vector_post_char_delay(char_table, prev_agg):
+    """ The delay between each character and the next one (rounded) """
+    return np.round(char_table.post_char_delay).astype(int)
+
+
+#----------------------------------------------------------------
+def vector_pre_char_distance(char_table, prev_agg):
+    """
+    The horizontal distance between each character and the previous one. This relies on the bounding box
+    ('x' and 'width' fields), which must be computed by a previous aggregation function.
+    """
+    return _neighbor_distance(char_table.prev_char_ind(), np.arange(char_table.n_chars), prev_agg)
+
+
+def vector_post_char_distance(char_table, prev_agg):
+    """
+    The horizontal distance between each character and the next one. This relies on the bounding box
+    ('x' and 'width' fields), which must be computed by a previous aggregation function.
+    """
+    return _neighbor_distance(np.arange(char_table.n_chars), char_table.next_char_ind(), prev_agg)
+
+
+def _neighbor_distance(left_ind, right_ind, prev_agg):
+    x = np.asarray(prev_agg['x'], dtype=float)
+    width = np.asarray(prev_agg['width'], dtype=float)
+
+    result = np.full(len(x), np.nan)
+    ok = (left_ind >= 0) & (right_ind >= 0)
+    result[ok] = x[right_ind[ok]] - (x[left_ind[ok]] + width[left_ind[ok]])
+    return result
+
+
 #----------------------------------------------------------------
 def get_bounding_box(character, fraction_of_x_points=None, fraction_of_y_points=None):
     """
@@ -200,8 +707,10 @@ def get_bounding_box(character, fraction_of_x_points=None, fraction_of_y_points=
     :param fraction_of_x_points: Percentage of x coordinates that must be in the trajectory. Value between 0 and 1.
     :param fraction_of_y_points: Percentage of y coordinates that must be in the trajectory. Value between 0 and 1.
     """
-    points = [pt for stroke in character.strokes if stroke.on_paper for pt in stroke.trajectory]
-    return _get_bounding_box_traj(points, fraction_of_x_points=fraction_of_x_points, fraction_of_y_points=fraction_of_y_points)
+    trajectories = [_columnar(stroke.trajectory) for stroke in character.strokes if stroke.on_paper]
+    x = np.concatenate([t.x for t in trajectories]) if len(trajectories) > 0 else np.zeros(0)
+    y = np.concatenate([t.y for t in trajectories]) if len(trajectories) > 0 else np.zeros(0)
+    return _get_bounding_box_xy(x, y, fraction_of_x_points=fraction_of_x_points, fraction_of_y_points=fraction_of_y_points)
 
 
 #----------------------------------------------------------------
@@ -212,25 +721,25 @@ def _get_bounding_box_traj(trajectory, fraction_of_x_points=None, fraction_of_y_
     The function returns a tuple: (x, width, y, height)
     x and y indicate the rectangle's midpoint
 
-    :param trajectory: List of trajectory points
+    :param trajectory: List of trajectory points, or a data.Trajectory
     :param fraction_of_x_points: Percentage of x coordinates that must be in the trajectory. Value between 0 and 1.
     :param fraction_of_y_points: Percentage of y coordinates that must be in the trajectory. Value between 0 and 1.
     """
 
-    (x) = ([float(pt.x) for pt in trajectory])
-    (y) = ([float(pt.y) for pt in trajectory])
-
-    if fraction_of_x_points is not None:
-        xmin, xmax = find_interval_containing(x, fraction_of_x_points, in_place=True)
+    if isinstance(trajectory, data.Trajectory):
+        x, y = trajectory.x, trajectory.y
     else:
-        xmin = min(x)
-        xmax = max(x)
+        x = np.array([pt.x for pt in trajectory], dtype=float)
+        y = np.array([pt.y for pt in trajectory], dtype=float)
 
-    if fraction_of_y_points is not None:
-        ymin, ymax = find_interval_containing(y, fraction_of_y_points, in_place=True)
-    else:
-        ymin = min(y)
-        ymax = max(y)
+    return _get_bounding_box_xy(x, y, fraction_of_x_points=fraction_of_x_points, fraction_of_y_points=fraction_of_y_points)
+
+
+#----------------------------------------------------------------
+def _get_bounding_box_xy(x, y, fraction_of_x_points=None, fraction_of_y_points=None):
+
+    xmin, xmax = find_interval_containing(x, 1 if fraction_of_x_points is None else fraction_of_x_points)
+    ymin, ymax = find_interval_containing(y, 1 if fraction_of_y_points is None else fraction_of_y_points)
 
     w = xmax - xmin
     h = ymax - ymin
@@ -243,37 +752,96 @@ def find_interval_containing(values, p_contained, in_place=False):
     """
     Find the smallest interval that contains a given percentage of the given list of values
 
-    :param values: List of numbers
+    :param values: List or array of numbers
     :param p_contained: The percentage of values we want contained in the interval (value between 0 and 1).
-    :param in_place: If True, the "values" parameter will be modified
+    :param in_place: Not used (the values are never modified); kept for compatibility
+    :return: (min, max) of the interval
     """
     assert p_contained > 0
     assert p_contained <= 1
 
-    if p_contained == 1:
-        return min(values), max(values)
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        raise ValueError('find_interval_containing() got an empty list of values')
 
-    n_values = len(values)
-    n_required_values = round(math.ceil(n_values * p_contained))
+    lo, hi = find_intervals_containing(values, [0, len(values)], p_contained)
+    return float(lo[0]), float(hi[0])
 
-    if in_place:
-        values.sort()
-    else:
-        values = sorted(values)
-
-    #-- Now we find, within "values" array, a sub-array of length n_required_values, with minimal difference between start and end.
-    #-- Namely, we need to find the i for which (values[i+n_required_values] - values[i]) is minimal
-    values = np.array(values)
-    diffs = values[(n_required_values-1):] - values[:(len(values) - n_required_values + 1)]
-    minval = min(diffs)
-    min_inds = np.where(diffs == minval)[0]
-    if len(min_inds) == 1:
-        ind = min_inds[0]
-    else:
-        i = int(math.floor((len(min_inds) + 1) / 2))
-        ind = min_inds[i - 1]
 
-    return values[ind], values[ind + n_required_values - 1]
+#----------------------------------------------------------------
+def find_intervals_containing(values, offsets, p_contained):
+    """
+    Like find_interval_containing(), for many segments of an array at once: segment #i is
+    values[offsets[i]:offsets[i+1]].
+
+    The smallest interval that contains n_required = ceil(n * p_contained) of a segment's n values starts at one of
+    the segment's sorted values: the one for which (sorted[i + n_required - 1] - sorted[i]) is minimal. If there are
+    several such intervals, the middle one is chosen (the lower-middle one if their number is even).
+
+    :param values: Array of numbers
+    :param offsets: The index of the first value of each segment, plus the total number of values
+    :param p_contained: The percentage of values we want contained in each interval (value between 0 and 1).
+                        None means 1.
+    :return: (min, max) - arrays with one value per segment (NaN for empty segments)
+    """
+
+    values = np.asarray(values, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+
+    if p_contained is None or p_contained == 1:
+        return segment_reduce(np.minimum, values, offsets), segment_reduce(np.maximum, values, offsets)
+
+    assert 0 < p_contained < 1
+
+    n_segments = len(offsets) - 1
+    n_values = np.diff(offsets)
+    lo = np.full(n_segments, np.nan)
+    hi = np.full(n_segments, np.nan)
+
+    segments = np.flatnonzero(n_values > 0)
+    if len(segments) == 0:
+        return lo, hi
+
+    #-- Sort the values of each segment
+    value_segment = np.repeat(np.arange(n_segments), n_values)
+    sorted_values = values[offsets[0]:offsets[-1]][np.lexsort((values[offsets[0]:offsets[-1]], value_segment))]
+    starts = offsets[:-1] - offsets[0]
+
+    #-- Each segment's candidate intervals ("windows") span n_required consecutive sorted values
+    n_required = np.ceil(n_values[segments] * p_contained).astype(int)
+    n_windows = n_values[segments] - n_required + 1
+    window_offsets = np.concatenate([[0], np.cumsum(n_windows)])
+    window_segment = np.repeat(np.arange(len(segments)), n_windows)
+    window_start = starts[segments][window_segment] + np.arange(window_offsets[-1]) - window_offsets[:-1][window_segment]
+    window_end = window_start + n_required[window_segment] - 1
+    diffs = sorted_values[window_end] - sorted_values[window_start]
+
+    #-- Choose the shortest window; if there are several, choose the middle one
+    min_diff = np.minimum.reduceat(diffs, window_offsets[:-1])
+    is_min = diffs == min_diff[window_segment]
+    min_rank = np.cumsum(is_min)
+    min_rank -= np.concatenate([[0], min_rank[window_offsets[1:-1] - 1]])[window_segment]
+    n_min = np.add.reduceat(is_min, window_offsets[:-1])
+    chosen = is_min & (min_rank == ((n_min + 1) // 2)[window_segment])
+
+    lo[segments] = sorted_values[window_start[chosen]]
+    hi[segments] = sorted_values[window_end[chosen]]
+    return lo, hi
+
+
+#----------------------------------------------------------------
+def segment_reduce(ufunc, values, offsets):
+    """
+    Apply a reduction (e.g. np.minimum) to each segment of an array: segment #i is values[offsets[i]:offsets[i+1]].
+    Return an array with one value per segment (NaN for empty segments).
+    """
+    offsets = np.asarray(offsets, dtype=int)
+    result = np.full(len(offsets) - 1, np.nan)
+    non_empty = offsets[1:] > offsets[:-1]
+    if np.any(non_empty):
+        #-- reduceat() of an empty segment returns a value of the next segment, so only non-empty ones are reduced
+        result[non_empty] = ufunc.reduceat(values, offsets[:-1][non_empty])
+    return result
 
 
 #--------------------------------------
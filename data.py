@@ -2,6 +2,7 @@
 Markup data for stimuli
 """
 from operator import attrgetter
+import numpy as np
 
 
 #--------------------------------------------------------------------------------------------------------------------
@@ -72,7 +73,7 @@ class RawTrial(object):
     #-----------------------------------------------------------------
     @property
     def on_paper_points(self):
-        return [pt for pt in self.traj_points if pt.z > 0]
+        return _on_paper_points(self.traj_points)
 
 
     #-----------------------------------------------------------------
@@ -121,7 +122,7 @@ class CodedTrial(object):
     # def on_paper_points(self):
     #     return [pt for stroke in self.strokes if stroke.on_paper for pt in stroke.trajectory]
     def on_paper_points(self):
-        return [pt for pt in self.traj_points if pt.z > 0]
+        return _on_paper_points(self.traj_points)
 
     #-----------------------------------------------------------------
     @property
@@ -132,6 +133,13 @@ class CodedTrial(object):
         return sum([s.n_traj_points for s in self.strokes])
 
 
+#-----------------------------------------------------------------
+def _on_paper_points(traj_points):
+    if isinstance(traj_points, Trajectory):
+        return traj_points[traj_points.z > 0]
+    return [pt for pt in traj_points if pt.z > 0]
+
+
 #--------------------------------------------------------------------------------------------------------------------
 class Character(object):
     """
@@ -162,6 +170,17 @@ class Character(object):
         t_n = self.strokes[-1].trajectory[-1].t
         return t_n - t_0
 
+    @property
+    def trajectory(self):
+        """
+        All the points of the character's strokes. When the strokes are slices of one columnar Trajectory,
+        this is a (zero-copy) slice too.
+        """
+        trajectories = [s.trajectory for s in self.strokes]
+        if len(trajectories) > 0 and all(isinstance(t, Trajectory) for t in trajectories):
+            return Trajectory.span(trajectories)
+        return [pt for t in trajectories for pt in t]
+
     @property
     def pre_char_delay(self):
         return 0 if self.pre_char_space is None else self.pre_char_space.duration
@@ -218,3 +237,181 @@ class TrajectoryPoint(object):
         self.y = y
         self.z = z
         self.t = t
+
+
+#--------------------------------------------------------------------------------------------------------------------
+class Trajectory(object):
+    """
+    Columnar storage of a series of trajectory points: the x, y, z (pressure) and t values are kept in contiguous
+    numpy arrays, and the stroke boundaries are kept as an array of offsets.
+
+    Slicing a trajectory (e.g. to get one stroke or one character) returns a Trajectory that shares the arrays
+    of the original one - no data is copied. Accessing a single point returns a light-weight TrajectoryPointView,
+    so code that works with TrajectoryPoint objects (pt.x, pt.y, ...) keeps working.
+    """
+
+    #-----------------------------------------------------------------
+    def __init__(self, x=(), y=(), z=(), t=(), stroke_offsets=None):
+        """
+        :param x: x coordinates
+        :param y: y coordinates
+        :param z: Pen pressure
+        :param t: Time (ms)
+        :param stroke_offsets: The index of the first point of each stroke, plus the total number of points.
+                               By default, the whole trajectory is a single stroke.
+        """
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.z = np.asarray(z, dtype=float)
+        self.t = np.asarray(t, dtype=float)
+
+        n = len(self.x)
+        if not (len(self.y) == len(self.z) == len(self.t) == n):
+            raise ValueError('Invalid trajectory: x, y, z and t must have the same length ({:}, {:}, {:}, {:})'
+                             .format(n, len(self.y), len(self.z), len(self.t)))
+
+        if stroke_offsets is None:
+            stroke_offsets = (0, n) if n > 0 else (0, )
+        self.stroke_offsets = np.asarray(stroke_offsets, dtype=int)
+
+        #-- The trajectory whose arrays are shared by this one, and where this trajectory starts in it
+        self._root = self
+        self._start = 0
+
+
+    #-----------------------------------------------------------------
+    @classmethod
+    def from_points(cls, points):
+        """
+        Create a columnar trajectory from a list of point objects (each with x, y, z, t attributes)
+        """
+        if isinstance(points, Trajectory):
+            return points
+        points = list(points)
+        return Trajectory([pt.x for pt in points], [pt.y for pt in points], [pt.z for pt in points], [pt.t for pt in points])
+
+
+    #-----------------------------------------------------------------
+    @staticmethod
+    def span(trajectories):
+        """
+        Get the smallest slice that contains all the given trajectory slices. All slices must share the same arrays.
+        """
+        root = trajectories[0].root
+        if any(t.root is not root for t in trajectories):
+            raise ValueError('Trajectory.span() can only merge slices of the same trajectory')
+        start = min(t.start for t in trajectories)
+        stop = max(t.start + len(t) for t in trajectories)
+        return root[start:stop]
+
+
+    #-----------------------------------------------------------------
+    @property
+    def root(self):
+        """ The trajectory whose arrays are shared by this one (self, unless this is a slice) """
+        return self._root
+
+
+    @property
+    def start(self):
+        """ The index, in the root trajectory, of this trajectory's first point """
+        return self._start
+
+
+    #-----------------------------------------------------------------
+    @property
+    def n_strokes(self):
+        return len(self.stroke_offsets) - 1
+
+
+    def stroke(self, stroke_ind):
+        """ Get one stroke's points (a zero-copy slice) """
+        return self[self.stroke_offsets[stroke_ind]:self.stroke_offsets[stroke_ind + 1]]
+
+
+    def strokes(self):
+        """ Get a list of all strokes (zero-copy slices) """
+        return [self.stroke(i) for i in range(self.n_strokes)]
+
+
+    #-----------------------------------------------------------------
+    def __len__(self):
+        return len(self.x)
+
+
+    def __iter__(self):
+        root = self._root
+        for i in range(self._start, self._start + len(self.x)):
+            yield TrajectoryPointView(root, i)
+
+
+    def __getitem__(self, item):
+
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self.x))
+            if step == 1:
+                return self._slice(start, max(start, stop))
+            item = np.arange(start, stop, step)
+
+        elif isinstance(item, (int, np.integer)):
+            n = len(self.x)
+            if item < 0:
+                item += n
+            if not 0 <= item < n:
+                raise IndexError('Trajectory index out of range')
+            return TrajectoryPointView(self._root, self._start + item)
+
+        #-- A boolean mask or a list of indices: the data must be copied
+        item = np.asarray(item)
+        return Trajectory(self.x[item], self.y[item], self.z[item], self.t[item])
+
+
+    #-----------------------------------------------------------------
+    def _slice(self, start, stop):
+        offsets = self.stroke_offsets
+        inner = offsets[(offsets > start) & (offsets < stop)]
+
+        result = Trajectory.__new__(Trajectory)
+        result.x = self.x[start:stop]
+        result.y = self.y[start:stop]
+        result.z = self.z[start:stop]
+        result.t = self.t[start:stop]
+        result.stroke_offsets = np.concatenate([[0], inner - start, [stop - start]]) if stop > start else np.zeros(1, dtype=int)
+        result._root = self._root
+        result._start = self._start + start
+        return result
+
+
+#--------------------------------------------------------------------------------------------------------------------
+class TrajectoryPointView(object):
+    """
+    A single point in a columnar Trajectory. Behaves like a (read-only) TrajectoryPoint.
+    """
+
+    __slots__ = ('_traj', '_ind')
+
+    def __init__(self, traj, ind):
+        self._traj = traj
+        self._ind = ind
+
+    @property
+    def x(self):
+        return self._traj.x[self._ind]
+
+    @property
+    def y(self):
+        return self._traj.y[self._ind]
+
+    @property
+    def z(self):
+        return self._traj.z[self._ind]
+
+    @property
+    def t(self):
+        return self._traj.t[self._ind]
+
+    def __eq__(self, other):
+        return isinstance(other, TrajectoryPointView) and other._traj is self._traj and other._ind == self._ind
+
+    def __hash__(self):
+        return hash((id(self._traj), self._ind))
@@ -1,7 +1,13 @@
-from encoder import dataio
-from encoder import trialcoder
-from encoder import expcoder
+import importlib
 
+from encoder import segmentation
+from encoder import dataio
 
+#-- The coders import the GUI libraries, so they are imported on first use (e.g. encoder.trialcoder)
+_lazy_modules = ('trialcoder', 'expcoder', 'extract_aggregate_measures', 'build_trajstore')
 
 
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module('encoder.' + name)
+    raise AttributeError("module 'encoder' has no attribute '{:}'".format(name))
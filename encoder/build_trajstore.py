@@ -0,0 +1,73 @@
+"""
+Build the binary trajectory store (see trajstore) of a session directory from its trajectory CSV files.
+The CSV files are not modified.
+"""
+import os
+import trajstore
+from encoder import dataio
+from encoder import dataiooldrecorder
+
+
+#-------------------------------------------------------------------------------------
+def build_trajstore(dir_name):
+    """
+    Create the binary trajectory store of a coded-data directory or a raw-data directory.
+
+    Return the number of trials in the store
+    """
+
+    if len(dataio._load_encoded_trajectory_filenames(dir_name)) > 0:
+        trials = _coded_trials(dir_name)
+    else:
+        trials = _raw_trials(dir_name)
+
+    trajstore.create(dir_name, trials)
+    return len(trials)
+
+
+#-------------------------------------------------------------------------------------
+def _coded_trials(dir_name):
+
+    trials = []
+
+    for (trial_id, sub_trial_num), filename in sorted(dataio._load_encoded_trajectory_filenames(dir_name).items()):
+        full_filename = dir_name + os.sep + filename
+        columns = dataio.read_csv_columns(full_filename, float_columns=('x', 'y', 'pressure', 'time'),
+                                          int_columns=('char_num', 'pen_down', 'stroke'), optional_columns=('correction', ))
+
+        points = trajstore.create_points(columns['x'], columns['y'], columns['pressure'], columns['time'],
+                                         stroke=columns['stroke'], char_num=columns['char_num'], pen_down=columns['pen_down'],
+                                         correction=columns['correction'] if 'correction' in columns else 0)
+        trials.append((trial_id, sub_trial_num, points, full_filename))
+
+    return trials
+
+
+#-------------------------------------------------------------------------------------
+def _raw_trials(dir_name):
+
+    trials_info = dataiooldrecorder.load_trials_index(dir_name)
+    traj_filenames = dataiooldrecorder._traj_filename_per_trial(dir_name, trials_info)
+
+    trials = []
+
+    for trial_id, filename in sorted(traj_filenames.items()):
+        full_filename = dir_name + os.sep + filename
+        traj = dataiooldrecorder.load_trajectory(full_filename)
+        trials.append((trial_id, 1, trajstore.create_points(traj.x, traj.y, traj.z, traj.t), full_filename))
+
+    return trials
+
+
+#-------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        print('Usage: python -m encoder.build_trajstore <raw-data or coded-data directory>')
+        print('Creates the binary trajectory store ({:}, {:}) from the trajectory CSV files'
+              .format(trajstore.POINTS_FILENAME, trajstore.INDEX_FILENAME))
+        sys.exit(1)
+
+    n = build_trajstore(sys.argv[1])
+    print('Saved {:} trials'.format(n))
@@ -5,18 +5,22 @@ Load and save coded files
 import re
 import csv
 import os
+import json
 import numpy as np
 from collections import namedtuple
 import data
+import trajstore
+import utils as u
 from encoder import dataiooldrecorder
-from encoder import trialcoder
 
 # noinspection PyProtectedMember
 from encoder.dataiooldrecorder import _parse_config_int_value, _parse_config_float_value
-from encoder import extract_aggregate_measures
 
 StrokeInfo = namedtuple('StrokeInfo', ['stroke', 'char_num'])
 
+#-- Whether save_trajectory() also saves the trial in the session's binary trajectory store (see trajstore)
+save_binary_trajectories = False
+
 
 #-------------------------------------------------------------------------------------
 
@@ -77,7 +81,7 @@ def _set_char_num_in_each_stroke(trial):
 
 
 #-------------------------------------------------------------------------------------
-def save_trajectory(strokes, trial_id, sub_trial_num, out_dir, trial):
+def save_trajectory(strokes, trial_id, sub_trial_num, out_dir, trial, save_to_store=None):
     """
     Save a single trial's trajectory to one file
 
@@ -85,6 +89,8 @@ def save_trajectory(strokes, trial_id, sub_trial_num, out_dir, trial):
     :param trial_id: Trial's serial number
     :param sub_trial_num: Usually 1, unless during coding we decided to split the trial into several sub-trials
     :param out_dir: Output directory
+    :param save_to_store: Whether to also save the trajectory in the binary trajectory store.
+                          Default: the save_binary_trajectories setting.
     """
 
     trial_num_portion = "trial_{:}_target_{:}".format(trial_id, trial.target_id) if sub_trial_num == 1\
@@ -106,9 +112,29 @@ def save_trajectory(strokes, trial_id, sub_trial_num, out_dir, trial):
                            x=dot.x, y=dot.y, pressure=max(0, dot.z), time="{:.0f}".format(dot.t), correction = stroke.correction)
                 writer.writerow(row)
 
+    if save_binary_trajectories if save_to_store is None else save_to_store:
+        trajstore.save_trial(out_dir, trial_id, sub_trial_num, _strokes_to_store_points(strokes), filename)
+
     return filename
 
 
+#-------------------------------------------------------------------------------------
+def _strokes_to_store_points(strokes):
+    """
+    Convert strokes to the binary store's format, with the same values as in the trajectory CSV file
+    """
+    all_points = []
+    stroke_num = 0
+    for stroke in strokes:
+        stroke_num += 1
+        traj = stroke.trajectory
+        all_points.append(trajstore.create_points(
+            [dot.x for dot in traj], [dot.y for dot in traj], [max(0, dot.z) for dot in traj], [round(dot.t) for dot in traj],
+            stroke=stroke_num, char_num=stroke.char_num, pen_down=1 if stroke.on_paper else 0, correction=stroke.correction))
+
+    return np.concatenate(all_points) if len(all_points) > 0 else trajstore.create_points([], [], [], [])
+
+
 #-------------------------------------------------------------------------------------
 
 def save_strokes_file(strokes, trial_id, sub_trial_num, out_dir, trial):
@@ -132,8 +158,14 @@ def save_strokes_file(strokes, trial_id, sub_trial_num, out_dir, trial):
 # -------------------------------------------------------------------------------------
 
 def save_characters_file(characters, strokes, trial_id, sub_trial_num, out_dir, trial):
+    """
+    Update the characters file with the aggregate measures of the saved trial. Only this trial is re-processed;
+    to rebuild the file from all trials, use extract_aggregate_measures.execute_agg_measures()
+    """
 
-    extract_aggregate_measures.execute_agg_measures(out_dir)
+    #-- Imported here, so that loading data does not import the analysis modules
+    from encoder import extract_aggregate_measures
+    extract_aggregate_measures.update_agg_measures(out_dir, trial_id)
 
 '''
     index_fn = out_dir + os.sep + 'encoded_characters.csv'
@@ -158,7 +190,7 @@ def _load_trajectory_filenames(dir_name):
 
     filenames = dict()
 
-    for fn in os.listdir(dir_name):
+    for fn in sorted(u.list_dir(dir_name)):
     #for traj_name in trials.raw_file_name:
         m = re.match('trajectory_(\\d+)(_part(\\d+))?.csv', fn)
         if m is None:
@@ -180,7 +212,7 @@ def _load_encoded_trajectory_filenames(dir_name):
 
     filenames = dict()
 
-    for fn in os.listdir(dir_name):
+    for fn in sorted(u.list_dir(dir_name)):
     #for traj_name in trials.raw_file_name:
     #(_part(\\d+))?
         m = re.match('trajectory_trial_(\d+)_target_(\w+)(_part(\\d+))?.csv', fn)
@@ -197,12 +229,16 @@ def _load_encoded_trajectory_filenames(dir_name):
 
 
 
-def _load_trajectory(trial_id, filename):
+def _load_trajectory(trial_id, filename, columns=None):
+    """
+    :param columns: The trajectory's columns (if they were already loaded, e.g. from the binary store); if None,
+                    they are loaded from the file
+    """
 
-    if not os.path.isfile(filename):
+    if columns is None and not os.path.isfile(filename):
         raise Exception('Error loading trial #{}: File {} does not exist'.format(trial_id, filename))
 
-    strokes_info = _load_strokes(filename)
+    strokes_info = _load_strokes(filename, columns)
     _validate_char_nums(strokes_info, filename)
     characters = _strokes_to_characters(filename, strokes_info)
 
@@ -210,50 +246,43 @@ def _load_trajectory(trial_id, filename):
 
 
 #---------------------------------
-def _load_strokes(filename):
+coded_trajectory_columns = 'x', 'y', 'pressure', 'time', 'char_num', 'pen_down', 'stroke'
+
+
+def read_coded_trajectory_columns(filename):
+    """
+    Read the columns of a coded trajectory file (coded_trajectory_columns)
+    """
+    return read_csv_columns(filename, float_columns=('x', 'y', 'pressure', 'time'), int_columns=('char_num', 'pen_down'),
+                            other_columns=('stroke', ))
+
+
+#---------------------------------
+def _load_strokes(filename, columns=None):
     """
     Load strokes and between-stroke spaces
     Return a list of dictionaries, each containing a Stroke object and its character num (or 0 for spaces)
+
+    All points of the file are stored in one columnar data.Trajectory; each stroke's trajectory is a slice of it.
+
+    :param columns: The file's columns, if they were already loaded
     """
 
-    strokes_info = []
+    if columns is None:
+        columns = read_coded_trajectory_columns(filename)
 
-    last_char_num = None
-    last_stroke_num = None
-    curr_stroke = None
+    #-- A new stroke starts wherever the stroke number changes
+    stroke_nums = columns['stroke']
+    stroke_starts = np.flatnonzero(stroke_nums[1:] != stroke_nums[:-1]) + 1
+    stroke_offsets = np.concatenate([[0], stroke_starts, [len(stroke_nums)]]) if len(stroke_nums) > 0 else np.array([0])
 
-    with open(filename, 'r') as fp:
-        reader = csv.DictReader(fp)
-        _validate_csv_format(filename, reader, ('char_num', 'x', 'y', 'pressure', 'time'))
+    trajectory = data.Trajectory(columns['x'], columns['y'], columns['pressure'], columns['time'], stroke_offsets=stroke_offsets)
 
-        for row in reader:
-            char_num = _parse_int(row['char_num'], 'char_num', filename, reader.line_num)
-            stroke_num = row['stroke']
-            on_paper = _parse_int(row['pen_down'], 'pen_down', filename, reader.line_num) != 0
-            # x = _parse_int(row['x'], 'x', filename, reader.line_num)
-            # y = _parse_int(row['y'], 'y', filename, reader.line_num)
-            # prs = _parse_int(row['pressure'], 'pressure', filename, reader.line_num)
-            x = row['x']
-            y = row['y']
-            prs = row['pressure']
-            t = row['time']
-
-            #-- New stroke
-            if stroke_num != last_stroke_num:
-                if curr_stroke is not None:
-                    strokes_info.append(StrokeInfo(curr_stroke, last_char_num))
-                last_stroke_num = stroke_num
-                last_char_num = char_num
-                curr_stroke = data.Stroke(on_paper, char_num, [])
-
-            #-- Append point
-            pt = data.TrajectoryPoint(x, y, prs, t)
-            curr_stroke.trajectory.append(pt)
-
-    if curr_stroke is not None:
-        strokes_info.append(StrokeInfo(curr_stroke, last_char_num))
-
-    return strokes_info
+    char_nums = columns['char_num'][stroke_offsets[:-1]].tolist()
+    on_paper = (columns['pen_down'][stroke_offsets[:-1]] != 0).tolist()
+
+    return [StrokeInfo(data.Stroke(on_paper[i], char_nums[i], trajectory.stroke(i)), char_nums[i])
+            for i in range(len(char_nums))]
 
 
 #---------------------------------
@@ -316,8 +345,11 @@ def _strokes_to_characters(filename, strokes_info):
 
 
 #------------------------------
-def _validate_csv_format(filename, reader, expected_fields):
-    missing_fields = [f for f in expected_fields if f not in reader.fieldnames]
+def _validate_csv_format(filename, fieldnames, expected_fields):
+    """
+    :param fieldnames: The names of the file's columns
+    """
+    missing_fields = [f for f in expected_fields if f not in fieldnames]
 
     #if (missing_fields == 'sub_trial_num' or 'self_correction' or 'response')
 
@@ -328,39 +360,87 @@ def _validate_csv_format(filename, reader, expected_fields):
 
 
 #------------------------------
-def _parse_int(value, col_name, filename, line_num):
-    try:
-        return int(value)
-    except ValueError:
-        raise ValueError("Invalid format for column '{:}' in line {:} in {:}: expecting an integer value".format(col_name, line_num, filename))
+def read_csv_columns(filename, float_columns=(), int_columns=(), other_columns=(), optional_columns=()):
+    """
+    Read columns of a CSV file in one vectorized call.
+
+    :param float_columns: Columns that must contain numbers
+    :param int_columns: Columns that must contain whole numbers
+    :param other_columns: Columns that are loaded as they are
+    :param optional_columns: Columns that are loaded as they are, if they exist in the file
+    :return: dict with a numpy array per column
+    """
+    #-- pandas is imported on first use, as it takes long to import
+    import pandas as pd
+
+    df = pd.read_csv(filename, engine='c', skipinitialspace=True, float_precision='round_trip')
+
+    expected_fields = tuple(float_columns) + tuple(int_columns) + tuple(other_columns)
+    _validate_csv_format(filename, list(df.columns), expected_fields)
+
+    result = {}
+
+    for col_name in float_columns:
+        result[col_name] = _numeric_column(df[col_name], col_name, filename, float, 'expecting a number')
+
+    for col_name in int_columns:
+        result[col_name] = _numeric_column(df[col_name], col_name, filename, int, 'expecting an integer value')
+
+    for col_name in other_columns:
+        result[col_name] = df[col_name].to_numpy()
+
+    for col_name in optional_columns:
+        if col_name in df.columns:
+            result[col_name] = df[col_name].to_numpy()
+
+    return result
 
 
 #------------------------------
-def _parse_float(value, col_name, filename, line_num):
-    try:
-        return float(value)
-    except ValueError:
-        raise ValueError("Invalid format for column '{:}' in line {:} in {:}: expecting an integer value".format(col_name, filename, line_num))
+def _numeric_column(column, col_name, filename, value_type, expected):
+    """
+    Convert a pandas column to a numpy array of the given type (int or float). The parsing is done by pandas when
+    the file is read; the invalid rows are searched for only if the column could not be parsed.
+    """
+    import pandas as pd
+
+    if value_type is int and pd.api.types.is_integer_dtype(column.dtype):
+        return column.to_numpy(dtype=int)
+
+    if value_type is float and pd.api.types.is_numeric_dtype(column.dtype) and not pd.api.types.is_bool_dtype(column.dtype) \
+            and not column.isna().any():
+        return column.to_numpy(dtype=float)
+
+    values = pd.to_numeric(column, errors='coerce')
+    invalid = values.isna().to_numpy()
+    if value_type is int:
+        invalid |= (values != np.round(values)).to_numpy()
+
+    if invalid.any():
+        #-- Line 1 is the header
+        line_nums = np.flatnonzero(invalid) + 2
+        raise ValueError("Invalid format for column '{:}' in line {:} in {:}: {:}"
+                         .format(col_name, ", ".join(str(n) for n in line_nums[:10]) + (", ..." if len(line_nums) > 10 else ""),
+                                 filename, expected))
+
+    return values.to_numpy(dtype=value_type)
 
 
 #-------------------------------------------------------------------------------------------------
 def reset_trial_info_file(dir_name):
+    close_trial_index(dir_name)
     trials_fn = trial_index_filename(dir_name)
-    if os.path.isfile(trials_fn):
-        os.remove(trials_fn)
+    for filename in (trials_fn, trials_fn + TrialIndex.log_suffix):
+        if os.path.isfile(filename):
+            os.remove(filename)
 
 
 #-------------------------------------------------------------------------------------------------
 def append_to_trial_index(dir_name, trial_id, sub_trial_num, target_id, target, response, trial_start_time, rc,self_correction, sound_file_length,raw_file_name,time_in_day,date):
     """
-    Append a line to the trials.csv file
+    Add a trial to the trials index. If the trial is already there, it is replaced.
     """
 
-    remove_from_trial_index(dir_name, trial_id, sub_trial_num)
-
-    index_fn = trial_index_filename(dir_name)
-    file_exists = os.path.isfile(index_fn)
-
     entry = dict(trial_id=trial_id,
                  sub_trial_num=sub_trial_num,
                  target_id=target_id,
@@ -375,35 +455,19 @@ def append_to_trial_index(dir_name, trial_id, sub_trial_num, target_id, target,
                  date=date
                  )
 
-
-    with open(index_fn, 'a' if file_exists else 'w', encoding="cp437", errors='ignore') as fp:
-        writer = csv.DictWriter(fp, trials_index_fields, lineterminator='\n')
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(entry)
+    open_trial_index(dir_name).upsert(entry)
 
 
 #----------------------------------------------------------
 def remove_from_trial_index(dir_name, trial_id, sub_trial_num=None):
     """
-    Remove a trial from the trials.csv index file
+    Remove a trial from the trials index
     """
 
-    index_fn = trial_index_filename(dir_name)
-    file_exists = os.path.isfile(index_fn)
-
-    if not file_exists:
+    if not os.path.isfile(trial_index_filename(dir_name)) and get_open_trial_index(dir_name) is None:
         return
 
-    index = load_trials_index(dir_name)
-
-    with open(index_fn, 'w', encoding="cp437", errors='ignore') as fp:
-        writer = csv.DictWriter(fp, trials_index_fields, lineterminator='\n')
-        writer.writeheader()
-        for entry in index:
-            to_remove = trial_id == entry['trial_id'] and (sub_trial_num is None or entry['sub_trial_num'] == sub_trial_num)
-            if not to_remove:
-                writer.writerow(entry)
+    open_trial_index(dir_name).remove(trial_id, sub_trial_num)
 
 
 #----------------------------------------------------------
@@ -414,17 +478,32 @@ def trial_index_filename(dir_name):
 #----------------------------------------------------------
 def load_trials_index(dir_name):
     """
-    Load information from the trials.csv file
+    Load information from the trials.csv file (including changes that were not written to it yet)
+    """
+
+    index = get_open_trial_index(dir_name)
+    if index is not None:
+        return index.entries()
+
+    entries = _load_trials_index_file(dir_name)
+    _replay_trial_index_log(trial_index_filename(dir_name) + TrialIndex.log_suffix, entries)
+    return list(entries.values())
+
+
+#----------------------------------------------------------
+def _load_trials_index_file(dir_name):
+    """
+    Load the trials.csv file. Return an ordered dict: (trial_id, sub_trial_num) -> entry
     """
     index_fn = trial_index_filename(dir_name)
     if not os.path.isfile(index_fn):
-        return []
+        return {}
 
     with open(index_fn, 'r', encoding="cp437", errors='ignore') as fp:
         reader = csv.DictReader(fp)
-        _validate_csv_format(index_fn, reader, trials_index_fields)
+        _validate_csv_format(index_fn, reader.fieldnames or [], trials_index_fields)
 
-        result = []
+        result = {}
         for row in reader:
             location = 'line {:} in {:}'.format(reader.line_num, index_fn)
             trial_id = _parse_config_int_value('trial_id', row['trial_id'], location)
@@ -442,8 +521,179 @@ def load_trials_index(dir_name):
             self_correction = row['self_correction']
             sound_file_length = row['sound_file_length']
 
+            #-- If a trial appears twice, the later line wins
+            result.pop((trial_id, sub_trial_num), None)
+            result[(trial_id, sub_trial_num)] = dict(trial_id=trial_id,target_id=target_id,sub_trial_num=sub_trial_num,target=target,response=response
+                               ,time_in_session=time_in_session,rc=rc,raw_file_name=raw_file_name,time_in_day=time_in_day,date=date,self_correction = self_correction, sound_file_length = sound_file_length)
+
+    return result
+
+
+#----------------------------------------------------------
+def _replay_trial_index_log(log_filename, entries):
+    """
+    Apply the changes saved in a trial index's log file to the entries (see _load_trials_index_file)
+    Return the number of changes applied.
+    """
+    if not os.path.isfile(log_filename):
+        return 0
+
+    n_changes = 0
+    with open(log_filename, 'r', encoding='utf-8') as fp:
+        for line in fp:
+            try:
+                change = json.loads(line)
+            except ValueError:
+                #-- The last line may be incomplete if the app crashed while writing it
+                break
+            if change['op'] == 'upsert':
+                TrialIndex.apply_upsert(entries, change['entry'])
+            else:
+                TrialIndex.apply_remove(entries, change['trial_id'], change['sub_trial_num'])
+            n_changes += 1
+
+    return n_changes
+
+
+#-------------------------------------------------------------------------------------------------
+_open_trial_indexes = {}
+
+
+def open_trial_index(dir_name):
+    """
+    Get the TrialIndex of the given directory (it's opened if needed). Close it with close_trial_index().
+    """
+    key = os.path.abspath(dir_name)
+    if key not in _open_trial_indexes:
+        _open_trial_indexes[key] = TrialIndex(dir_name)
+    return _open_trial_indexes[key]
+
+
+def get_open_trial_index(dir_name):
+    """ Return the directory's TrialIndex if it's open, or None """
+    return _open_trial_indexes.get(os.path.abspath(dir_name))
+
+
+def close_trial_index(dir_name):
+    """ Write all changes to the directory's trials.csv file, and close its TrialIndex (if it's open) """
+    index = _open_trial_indexes.pop(os.path.abspath(dir_name), None)
+    if index is not None:
+        index.close()
+
+
+#-------------------------------------------------------------------------------------------------
+class TrialIndex(object):
+    """
+    The trials index (trials.csv) of a coded-data directory, kept in memory and keyed by (trial_id, sub_trial_num).
+
+    Each change is appended to a log file (trials.csv.log). The trials.csv file itself is rewritten only on close()
+    and after every compact_every changes; it is written to a temporary file, which then replaces trials.csv, so a
+    crash never leaves a truncated index. Changes that are in the log but not in trials.csv (e.g. after a crash)
+    are applied when the index is loaded again.
+    """
 
-            result.append(dict(trial_id=trial_id,target_id=target_id,sub_trial_num=sub_trial_num,target=target,response=response
-                               ,time_in_session=time_in_session,rc=rc,raw_file_name=raw_file_name,time_in_day=time_in_day,date=date,self_correction = self_correction, sound_file_length = sound_file_length))
+    log_suffix = '.log'
 
+    def __init__(self, dir_name, compact_every=50):
+        self.dir_name = dir_name
+        self.filename = trial_index_filename(dir_name)
+        self.log_filename = self.filename + self.log_suffix
+        self.compact_every = compact_every
+
+        self._entries = _load_trials_index_file(dir_name)
+        self._n_logged = _replay_trial_index_log(self.log_filename, self._entries)
+        self._log_fp = None
+
+        if self._n_logged > 0 or not os.path.isfile(self.filename):
+            self.compact()
+
+
+    def entries(self):
+        """ All entries, in the order they were added """
+        return [dict(e) for e in self._entries.values()]
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def upsert(self, entry):
+        """ Add an entry, or replace the entry with the same trial_id and sub_trial_num """
+        entry = _normalize_trial_index_entry(entry)
+        self.apply_upsert(self._entries, entry)
+        self._log(dict(op='upsert', entry=entry))
+
+
+    def remove(self, trial_id, sub_trial_num=None):
+        """ Remove a trial's entry (sub_trial_num=None: remove all sub-trials) """
+        self.apply_remove(self._entries, trial_id, sub_trial_num)
+        self._log(dict(op='remove', trial_id=trial_id, sub_trial_num=sub_trial_num))
+
+
+    def compact(self):
+        """ Write all entries to trials.csv and clear the log """
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding="cp437", errors='ignore') as fp:
+            writer = csv.DictWriter(fp, trials_index_fields, lineterminator='\n')
+            writer.writeheader()
+            for entry in self._entries.values():
+                row = dict(entry)
+                row['rc'] = '' if row['rc'] is None else row['rc']
+                writer.writerow(row)
+        os.replace(tmp_filename, self.filename)
+
+        #-- A crash before the log is removed is harmless: applying the log again yields the same entries
+        if self._log_fp is not None:
+            self._log_fp.close()
+            self._log_fp = None
+        if os.path.isfile(self.log_filename):
+            os.remove(self.log_filename)
+        self._n_logged = 0
+
+
+    def close(self):
+        if self._n_logged > 0:
+            self.compact()
+        if self._log_fp is not None:
+            self._log_fp.close()
+            self._log_fp = None
+
+
+    def _log(self, change):
+        if self._log_fp is None:
+            self._log_fp = open(self.log_filename, 'a', encoding='utf-8')
+        self._log_fp.write(json.dumps(change) + '\n')
+        self._log_fp.flush()
+        os.fsync(self._log_fp.fileno())
+
+        self._n_logged += 1
+        if self._n_logged >= self.compact_every:
+            self.compact()
+
+
+    @staticmethod
+    def apply_upsert(entries, entry):
+        key = entry['trial_id'], entry['sub_trial_num']
+        #-- A replaced entry moves to the end, as if it was removed and appended
+        entries.pop(key, None)
+        entries[key] = entry
+
+
+    @staticmethod
+    def apply_remove(entries, trial_id, sub_trial_num):
+        for key in [k for k in entries if k[0] == trial_id and (sub_trial_num is None or k[1] == sub_trial_num)]:
+            del entries[key]
+
+
+#----------------------------------------------------------
+def _normalize_trial_index_entry(entry):
+    """
+    Convert an entry to the format of entries loaded from trials.csv: trial_id and sub_trial_num are int, rc is None
+    if empty, and all other fields are strings
+    """
+    result = {f: '' if entry[f] is None else str(entry[f]) for f in trials_index_fields}
+    result['trial_id'] = int(entry['trial_id'])
+    result['sub_trial_num'] = int(entry['sub_trial_num'])
+    result['rc'] = None if result['rc'] == '' else result['rc']
     return result
@@ -2,9 +2,11 @@ from enum import Enum
 import csv
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import data
+import trajstore
+from encoder import trajcache
 import utils as u
-import pandas as pd
 from encoder import dataio
 
 #-------------------------------------------------------------------------------------------------
@@ -27,34 +29,62 @@ class StartAcquisition(Enum):
 
 #-------------------------------------------------------------------------------------------------
 
-def load_experiment_trajwriter(dir_name, trial_index_filter=None):
+def load_experiment_trajwriter(dir_name, trial_index_filter=None, n_workers=1, use_processes=False, progress=None, use_store=False,
+                               cache=None):
+    """
+    Load a coded experiment
+
+    :param trial_index_filter: A function that gets a trial's entry in the trials index and returns whether to load it
+    :param n_workers: The number of files to load in parallel
+    :param use_processes: Whether parallel loading uses processes (good when parsing is the bottleneck) or threads
+                          (good when file access is the bottleneck, e.g. on network drives)
+    :param progress: A function called as progress(n_loaded, n_total) after each file is loaded, e.g., the
+                     progress() method of a utils.ProgressBar
+    :param use_store: Load the trajectories from the directory's binary trajectory store (see trajstore), if it exists.
+                      Trials that are not in the store, or whose CSV file changed since, are loaded from the CSV files.
+    :param cache: The cache of parsed CSV files (see trajcache): a TrajectoryCache, True for the default cache, or
+                  None/False (default) to always parse the CSV files.
+    """
+
+    store = trajstore.TrajectoryStore(dir_name) if use_store and trajstore.exists(dir_name) else None
+    cache = _get_cache(cache)
 
     encoded_traj_filenames = dataio._load_encoded_trajectory_filenames(dir_name)
     index = load_trials_index(dir_name)
 
-    trials = []
-    #for t in index:
+    if trial_index_filter is not None:
+        index = [trial_spec for trial_spec in index if trial_index_filter(trial_spec)]
+
+    #-- Trials are loaded in order until the first trial without a trajectory file
+    file_args = []
+    missing_trial_key = None
     for trial_spec in index:
-        trial_id = trial_spec['trial_id']
-        sub_trial_num = trial_spec['sub_trial_num']
-        if trial_index_filter is not None and not trial_index_filter(trial_spec):
-            continue
-        #points = load_trajectory(dir_name+"/"+encoded_traj_filenames[(trial_id, sub_trial_num)])
-        points = load_trajectory(dir_name+"/"+encoded_traj_filenames[(trial_id, sub_trial_num)])
+        trial_key = trial_spec['trial_id'], trial_spec['sub_trial_num']
+        if trial_key not in encoded_traj_filenames:
+            missing_trial_key = trial_key
+            break
+        columns = store.columns(*trial_key) if store is not None and trial_key in store else None
+        file_args.append((trial_spec['trial_id'], dir_name + os.sep + encoded_traj_filenames[trial_key], columns, cache))
 
-        trial = data.CodedTrial(trial_id, trial_spec['target_id'], trial_spec['target'], points,
+    #-- Each file is parsed once: the trial's points are the whole-file trajectory that the strokes are slices of
+    loaded = _load_files(_load_coded_trajectory, file_args, n_workers, use_processes, progress, len(index))
+    if cache is not None:
+        cache.evict_if_written()
+
+    if missing_trial_key is not None:
+        raise Exception('Invalid experiment directory {:}: There is no trajectory for trial #{:}, sub-trial #{:}'
+                        .format(dir_name, missing_trial_key[0], missing_trial_key[1]))
+
+    trials = []
+    for trial_spec, (characters, strokes) in zip(index, loaded):
+        points = strokes[0].trajectory.root if len(strokes) > 0 else data.Trajectory([], [], [], [])
+
+        trial = data.CodedTrial(trial_spec['trial_id'], trial_spec['target_id'], trial_spec['target'], points,
                                 time_in_session=trial_spec['time_in_session'], rc=trial_spec['rc'], source=None, response=trial_spec['response'],
                                 self_correction=trial_spec['self_correction'],sound_file_length = trial_spec['sound_file_length'],
                                 raw_file_name=trial_spec['raw_file_name'],time_in_day=trial_spec['time_in_day'],
                                 date=trial_spec['date'], sub_trial_num = trial_spec['sub_trial_num'])
 
-        trial_key = trial.trial_id, trial.sub_trial_num
-        if trial_key not in encoded_traj_filenames:
-            raise Exception('Invalid experiment directory {:}: There is no trajectory for trial #{:}, sub-trial #{:}'
-                            .format(dir_name, trial.trial_id, trial.sub_trial_num))
-
-        characters, strokes = dataio._load_trajectory(trial.trial_id, dir_name + os.sep + encoded_traj_filenames[trial_key])
-
         #dataio.validate_trial(trial, characters, strokes)
 
         trial.characters = characters
@@ -64,22 +94,53 @@ def load_experiment_trajwriter(dir_name, trial_index_filter=None):
     return data.Experiment(trials, source_path=dir_name)
 # #-------------------------------------------------------------------------------------------------
 
-def load_experiment(dir_name):
+def load_experiment(dir_name, n_workers=1, use_processes=False, progress=None, use_store=False, cache=None):
     """
     Load the raw (uncoded) results of one experiment (saved in one directory)
+
+    :param n_workers: The number of files to load in parallel
+    :param use_processes: Whether parallel loading uses processes (good when parsing is the bottleneck) or threads
+                          (good when file access is the bottleneck, e.g. on network drives)
+    :param progress: A function called as progress(n_loaded, n_total) after each file is loaded, e.g., the
+                     progress() method of a utils.ProgressBar
+    :param use_store: Load the trajectories from the directory's binary trajectory store (see trajstore), if it exists.
+                      Trials that are not in the store, or whose CSV file changed since, are loaded from the CSV files.
+    :param cache: The cache of parsed CSV files (see trajcache): a TrajectoryCache, True for the default cache, or
+                  None/False (default) to always parse the CSV files.
     """
 
+    store = trajstore.TrajectoryStore(dir_name) if use_store and trajstore.exists(dir_name) else None
+    cache = _get_cache(cache)
+
     trials_info = load_trials_index(dir_name)                             #trials.csv fields
     traj_filenames = _traj_filename_per_trial(dir_name, trials_info)
 
-    trials = []
+    #-- Trials are loaded in order until the first trial without a trajectory file
+    file_args = []
+    missing_trial_id = None
     for trial_spec in trials_info:
         trial_id = trial_spec['trial_id']
-
         if trial_id not in traj_filenames:
-            raise Exception('Invalid experiment directory {:}: there is no file for trial #{:} '.format(dir_name, trial_id))
+            missing_trial_id = trial_id
+            break
+        file_args.append((dir_name+"/"+traj_filenames[trial_id], cache))
 
-        points = load_trajectory(dir_name+"/"+traj_filenames[trial_id])
+    #-- Trajectories that are in the binary store are not loaded from the CSV files
+    in_store = [store is not None and (trial_spec['trial_id'], 1) in store for trial_spec in trials_info[:len(file_args)]]
+    loaded = _load_files(load_trajectory, [args for args, s in zip(file_args, in_store) if not s],
+                         n_workers, use_processes, progress, len(trials_info) - sum(in_store))
+    if cache is not None:
+        cache.evict_if_written()
+    loaded.reverse()
+    all_points = [store.trajectory(trial_spec['trial_id'], 1) if s else loaded.pop()
+                  for trial_spec, s in zip(trials_info, in_store)]
+
+    if missing_trial_id is not None:
+        raise Exception('Invalid experiment directory {:}: there is no file for trial #{:} '.format(dir_name, missing_trial_id))
+
+    trials = []
+    for trial_spec, points in zip(trials_info, all_points):
+        trial_id = trial_spec['trial_id']
 
         trial = data.RawTrial(trial_id, trial_spec['target_id'], trial_spec['target'], points, time_in_session=trial_spec['time_in_session'], rc=trial_spec['rc'], source = None,
                               self_correction = trial_spec['self_correction'],sound_file_length = trial_spec['sound_file_length'],
@@ -90,22 +151,68 @@ def load_experiment(dir_name):
 
     return data.Experiment(trials, source_path=dir_name)
 
+
+#-------------------------------------------------------------------------------------------------
+def _get_cache(cache):
+    if cache is True:
+        return trajcache.default_cache()
+    return cache or None
+
+
+#-------------------------------------------------------------------------------------------------
+def _load_coded_trajectory(trial_id, filename, columns=None, cache=None):
+    """
+    Load a coded trajectory file (see dataio._load_trajectory), using the cache if provided
+    """
+    if columns is None and cache is not None and os.path.isfile(filename):
+        columns = cache.load(filename, dataio.read_coded_trajectory_columns, dataio.coded_trajectory_columns)
+
+    return dataio._load_trajectory(trial_id, filename, columns)
+
+
+#-------------------------------------------------------------------------------------------------
+def _load_files(load_func, args_per_file, n_workers, use_processes, progress, n_total):
+    """
+    Call load_func(*args) for each file's args, and return the results in the same order.
+
+    With n_workers > 1, the files are loaded in parallel. Still, if loading fails, the error raised is that of the
+    first failing file - as when loading serially.
+    """
+
+    results = []
+
+    if n_workers <= 1 or len(args_per_file) <= 1:
+        for args in args_per_file:
+            results.append(load_func(*args))
+            if progress is not None:
+                progress(len(results), n_total)
+        return results
+
+    executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_type(max_workers=n_workers) as executor:
+        for result in executor.map(load_func, *zip(*args_per_file)):
+            results.append(result)
+            if progress is not None:
+                progress(len(results), n_total)
+
+    return results
+
+
 #-------------------------------------------------------------------------------------------------
 def _traj_filename_per_trial(dir_name, trials):
+    """
+    Find the trajectory file of each trial: a file named after the trial's raw_file_name.
+    Return a dict: trial_id -> filename
+    """
 
-    result = dict()
+    filenames = u.list_dir(dir_name)
 
-    for filename in os.listdir(dir_name):                        #Names of trajectory files
-        match = False
-        for i in range(len(trials)):
-            raw_name = trials[i]['raw_file_name']+".csv"
-            if filename == raw_name:
-                trial_id = trials[i]['trial_id']
-                match = True
-                result[trial_id] = filename
+    result = dict()
 
-        if match is not True:
-            continue
+    for trial in trials:
+        filename = trial['raw_file_name'] + ".csv"
+        if filename in filenames:
+            result[trial['trial_id']] = filename
 
     return result
 
@@ -154,25 +261,26 @@ def save_trajectory(dir_name, trial_id, trajectory):
 
 
 #-------------------------------------------------------------------------------------------------
-def load_trajectory(filename):
+def load_trajectory(filename, cache=None):
     """
-    Load a raw trajectory file
+    Load a raw trajectory file into a columnar data.Trajectory object
 
     The file starts with name=value lines.
     Then, there must be a line saying "trajectory", followed by a CSV format
+
+    :param cache: A trajcache.TrajectoryCache, or None to parse the file
     """
-    with open(filename, 'r') as fp:
-        reader = csv.DictReader(fp)
-        trajectory = []
-        for line in reader:
-            x = _parse_traj_value(line, 'x', reader.line_num, filename)
-            y = _parse_traj_value(line, 'y', reader.line_num, filename)
-            prs = _parse_traj_value(line, 'pressure', reader.line_num, filename)
-            t = _parse_traj_value(line, 'time', reader.line_num, filename)
-            pt = data.TrajectoryPoint(x, y, prs, t)
-            trajectory.append(pt)
+    if cache is None:
+        columns = _read_raw_trajectory_columns(filename)
+    else:
+        columns = cache.load(filename, _read_raw_trajectory_columns, ('x', 'y', 'pressure', 'time'))
 
-    return trajectory
+    return data.Trajectory(columns['x'], columns['y'], columns['pressure'], columns['time'])
+
+
+#--------------------------------------
+def _read_raw_trajectory_columns(filename):
+    return dataio.read_csv_columns(filename, float_columns=('x', 'y', 'pressure', 'time'))
 
 
 #--------------------------------------
@@ -198,14 +306,6 @@ def _parse_traj_config_line(line, config_args, line_num, filename):
         raise ValueError('Unrecognized parameter {:} in line {:} in {:}'.format(arg_name, line_num, filename))
 
 
-#--------------------------------------
-def _parse_traj_value(line, name, line_num, filename):
-    try:
-        return float(line[name])
-    except ValueError:
-        raise ValueError('Invalid value in line {:} in {:}: column {:} should be a number but it''s "{:}"'.format(line_num, filename, name, line[name]))
-
-
 #-------------------------------------------------------------------------------------------------
 def append_trial(out_dir, trial_id, target_id, target, trajectory, trial_start_time, rc):
     """
@@ -249,6 +349,15 @@ def load_trials_index(dir_name):
     Load information from the trials.csv file
     """
 
+    #-- A coded-data index that is being updated (or has unsaved changes in its log) is loaded by dataio
+    if dataio.get_open_trial_index(dir_name) is not None or \
+            os.path.isfile(dataio.trial_index_filename(dir_name) + dataio.TrialIndex.log_suffix):
+        result = dataio.load_trials_index(dir_name)
+        for entry in result:
+            if entry['sound_file_length'] == '':
+                entry['sound_file_length'] = "0"
+        return result
+
     index_fn = dir_name + os.sep + trials_csv_filename
     if not os.path.isfile(index_fn):
         return []
@@ -266,6 +375,8 @@ def load_trials_index(dir_name):
 
         if already_coded == False:
 
+            #-- pandas is imported on first use, as it takes long to import
+            import pandas as pd
             csv_input = pd.read_csv(index_fn, encoding='utf-8')
             csv_input['sub_trial_num'] = '1'
             csv_input['response'] = '0'
@@ -9,6 +9,7 @@ import traceback
 from encoder import dataiooldrecorder
 from encoder import *
 from encoder.trialcoder import encode_one_trial as _markup_one_trial
+from encoder.trialcoder import TrialPrefetcher
 import uiutil as uiu
 
 
@@ -167,7 +168,24 @@ def _trials_to_code(raw_exp, coded_dir):
 
 
 
-def code_experiment(trials, out_dir):
+def code_experiment(trials, out_dir, n_prefetch=3):
+    """
+    Code the trials one by one.
+
+    :param n_prefetch: The number of upcoming trials to prepare in the background while coding the current trial
+    """
+
+    prefetcher = TrialPrefetcher(trials, n_ahead=n_prefetch)
+    try:
+        _code_trials(trials, out_dir, prefetcher)
+    finally:
+        prefetcher.close()
+        #-- Write the trials index changes to trials.csv
+        dataio.close_trial_index(out_dir)
+
+
+#-------------------------------------------------------------------------------------
+def _code_trials(trials, out_dir, prefetcher):
 
     i = 0
     while i < len(trials):
@@ -177,8 +195,11 @@ def code_experiment(trials, out_dir):
         print("trial is: " + str(trial))
         dataio.remove_from_trial_index(out_dir, trial.trial_id)
 
+        prepared = prefetcher.get(i)
+        prefetcher.prefetch(i + 1)
+
         print('Processing trial #{}, source: {}'.format(i + 1, trial.source))
-        rc = _markup_one_trial(trial, out_dir)
+        rc = _markup_one_trial(trial, out_dir, prepared=prepared)
 
         if rc == 'quit':
             break
@@ -1,6 +1,10 @@
+import csv
+import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 import analyze
-from analyze.transform import GetBoundingBox, AggFunc
+from analyze.transform import GetBoundingBox, AggFunc, VectorAggFunc, VectorBoundingBox
 import encoder
 from encoder import dataiooldrecorder
 
@@ -54,25 +58,278 @@ def get_post_char_distance(trial, character, prev_agg):
 
 
 #-------------------------------------------------------
+def _agg_func_specs():
+    """
+    The list of the aggregations to perform (each becomes one or more columns in the resulting CSV file)
+    """
+    return (
+        VectorAggFunc(VectorBoundingBox(1.0, 1.0), ('x', 'width', 'y', 'height')),
+        VectorAggFunc(analyze.transform.vector_pre_char_delay, 'pre_char_delay'),
+        VectorAggFunc(analyze.transform.vector_post_char_delay, 'post_char_delay'),
+        VectorAggFunc(analyze.transform.vector_pre_char_distance, 'pre_char_distance'),
+        VectorAggFunc(analyze.transform.vector_post_char_distance, 'post_char_distance'),
+    )
 
 
-def execute_agg_measures(input_dir):
-
-    #-- The list of the aggregations to perform (each becomes one or more columns in the resulting CSV file)
-    agg_func_specs = (
+#-------------------------------------------------------
+def _callback_agg_func_specs():
+    """
+    The same aggregations as _agg_func_specs(), computed per character by callback functions (slower).
+    This is the reference implementation that check_agg_measures() compares the vectorized aggregations with.
+    """
+    return (
         AggFunc(GetBoundingBox(1.0, 1.0), ('x', 'width', 'y', 'height')),
         AggFunc(get_pre_char_delay, 'pre_char_delay'),
         AggFunc(get_post_char_delay, 'post_char_delay'),
-        AggFunc(get_pre_char_distance, 'pre_char_distance', get_prev_aggregations=True),
-        AggFunc(get_post_char_distance, 'post_char_distance', get_prev_aggregations=True),
+        AggFunc(get_pre_char_distance, 'pre_char_distance', in_fields=('x', 'width')),
+        AggFunc(get_post_char_distance, 'post_char_distance', in_fields=('x', 'width')),
     )
 
-    exp = encoder.dataiooldrecorder.load_experiment_trajwriter(input_dir, trial_index_filter=trial_ok)
 
-    #exp = encoder.dataiooldrecorder.load_experiment(input_dir)
+#-------------------------------------------------------
+def characters_filename(input_dir):
+    return input_dir + '/characters_ADME_main.csv'
 
 
+#-------------------------------------------------------
+def execute_agg_measures(input_dir):
+    """
+    Full rebuild: compute the aggregate measures of all trials in the directory and rewrite the characters file
+    """
+
+    exp = encoder.dataiooldrecorder.load_experiment_trajwriter(input_dir, trial_index_filter=trial_ok)
 
-    analyze.transform.aggregate_characters(exp.trials, agg_func_specs=agg_func_specs, subj_id=os.path.basename(input_dir),
+    analyze.transform.aggregate_characters(exp.trials, agg_func_specs=_agg_func_specs(), subj_id=os.path.basename(input_dir),
                                               trial_filter=lambda trial:trial.rc == 'OK',
-                                              out_filename=input_dir + '/characters_ADME_main.csv', save_as_attr=False)
\ No newline at end of file
+                                              out_filename=characters_filename(input_dir), save_as_attr=False)
+
+
+#-------------------------------------------------------
+def update_agg_measures(input_dir, trial_id):
+    """
+    Incremental update: compute the aggregate measures only for one trial (all its sub-trials), and replace
+    this trial's rows in the characters file. Rows of trials that are no longer in the trials index are removed.
+    """
+
+    index = encoder.dataiooldrecorder.load_trials_index(input_dir)
+    ok_trial_ids = [t['trial_id'] for t in index if trial_ok(t)]
+
+    #-- This runs on every save in the coder, so the parsed-files cache is not used (it's written to the home directory)
+    exp = encoder.dataiooldrecorder.load_experiment_trajwriter(
+        input_dir, trial_index_filter=lambda t: t['trial_id'] == trial_id and trial_ok(t), cache=None)
+
+    agg_func_specs = _agg_func_specs()
+    subj_id = os.path.basename(input_dir)
+
+    csv_rows = analyze.transform.aggregate_characters(exp.trials, agg_func_specs=agg_func_specs, subj_id=subj_id,
+                                                      trial_filter=lambda trial: trial.rc == 'OK', save_as_attr=False)
+
+    analyze.transform.upsert_aggregations(csv_rows, [trial_id], agg_func_specs, characters_filename(input_dir),
+                                          subj_id=subj_id, valid_trial_ids=ok_trial_ids)
+
+
+#-------------------------------------------------------
+def check_agg_measures(input_dir):
+    """
+    Check the vectorized aggregations (_agg_func_specs) against the per-character reference implementation
+    (_callback_agg_func_specs) on all trials in a coded-data directory. No file is written.
+
+    :return: (n_rows, differences) - differences is a list of (vectorized_row, reference_row) pairs that differ
+    """
+
+    exp = encoder.dataiooldrecorder.load_experiment_trajwriter(input_dir, trial_index_filter=trial_ok)
+
+    rows_per_specs = [analyze.transform.aggregate_characters(exp.trials, agg_func_specs=specs, subj_id=os.path.basename(input_dir),
+                                                             trial_filter=lambda trial: trial.rc == 'OK', save_as_attr=False)
+                      for specs in (_agg_func_specs(), _callback_agg_func_specs())]
+
+    if len(rows_per_specs[0]) != len(rows_per_specs[1]):
+        raise Exception('The vectorized aggregations returned {:} rows, but the reference implementation returned {:} rows'
+                        .format(len(rows_per_specs[0]), len(rows_per_specs[1])))
+
+    differences = [(row, ref_row) for row, ref_row in zip(*rows_per_specs) if not _same_row(row, ref_row)]
+
+    return len(rows_per_specs[0]), differences
+
+
+def _same_row(row, ref_row):
+    if row.keys() != ref_row.keys():
+        return False
+    for field, value in row.items():
+        ref_value = ref_row[field]
+        if isinstance(value, float) and isinstance(ref_value, (int, float)):
+            if not math.isclose(value, ref_value, rel_tol=1e-9, abs_tol=1e-9):
+                return False
+        elif value != ref_value:
+            return False
+    return True
+
+
+#-------------------------------------------------------
+def find_coded_dirs(root_dir):
+    """
+    Find all coded-data directories under the given root directory (including the root itself): directories
+    that contain a trials index and encoded trajectory files.
+
+    :return: A sorted list of directory names
+    """
+
+    dirs = []
+
+    for dir_name, sub_dirs, filenames in os.walk(root_dir):
+        sub_dirs.sort()
+        if 'trials.csv' in filenames and any(fn.startswith('trajectory_trial_') and fn.endswith('.csv') for fn in filenames):
+            dirs.append(dir_name)
+
+    return sorted(dirs)
+
+
+#-------------------------------------------------------
+def subject_id(root_dir, input_dir):
+    """
+    The subject ID of a directory found by find_coded_dirs(): its path relative to the root directory (so subjects
+    with the same directory name in different groups are not mixed up)
+    """
+    rel_path = os.path.relpath(input_dir, root_dir)
+    if rel_path == os.curdir:
+        return os.path.basename(os.path.abspath(input_dir))
+    return rel_path.replace(os.sep, '/')
+
+
+#-------------------------------------------------------
+def _aggregate_subject(input_dir, subj_id, use_cache=False):
+    """
+    Compute the aggregate measures of one subject (this runs in a worker process)
+
+    :param use_cache: Whether to use the default cache of parsed trajectory files (see encoder.trajcache)
+
+    :return: (csv_rows, stats) - stats is a dict with the subject's timing information. If the subject could not be
+             processed, csv_rows is empty and stats['error'] describes the error.
+    """
+
+    stats = dict(subject=subj_id, directory=input_dir, n_trials=0, n_characters=0,
+                 load_time=0.0, aggregate_time=0.0, total_time=0.0, error='')
+
+    start_time = time.perf_counter()
+
+    try:
+        exp = encoder.dataiooldrecorder.load_experiment_trajwriter(input_dir, trial_index_filter=trial_ok, cache=use_cache)
+        load_end_time = time.perf_counter()
+
+        csv_rows = analyze.transform.aggregate_characters(exp.trials, agg_func_specs=_agg_func_specs(), subj_id=subj_id,
+                                                          trial_filter=lambda trial: trial.rc == 'OK', save_as_attr=False)
+        end_time = time.perf_counter()
+
+    except Exception as e:
+        stats['error'] = '{:}: {:}'.format(type(e).__name__, e)
+        stats['total_time'] = round(time.perf_counter() - start_time, 3)
+        return [], stats
+
+    stats['n_trials'] = len(exp.trials)
+    stats['n_characters'] = len(csv_rows)
+    stats['load_time'] = round(load_end_time - start_time, 3)
+    stats['aggregate_time'] = round(end_time - load_end_time, 3)
+    stats['total_time'] = round(end_time - start_time, 3)
+
+    return csv_rows, stats
+
+
+_timing_fieldnames = ['subject', 'directory', 'n_trials', 'n_characters', 'load_time', 'aggregate_time', 'total_time', 'error']
+
+
+#-------------------------------------------------------
+def timing_filename(out_filename):
+    return os.path.splitext(out_filename)[0] + '_timing.csv'
+
+
+#-------------------------------------------------------
+def execute_agg_measures_batch(root_dir, out_filename, n_workers=None, progress=None, use_cache=False):
+    """
+    Compute the aggregate measures of all coded-data directories under a root directory (one directory per subject),
+    and save them in a single characters file with a 'subject' column. The subjects are processed in parallel,
+    by a pool of processes.
+
+    Per-subject timing information is saved in another file (see timing_filename()). A subject that fails does not
+    stop the others: its error is reported in the timing file.
+
+    :param n_workers: The number of worker processes (default: the number of CPUs)
+    :param progress: If provided, this function is called with (n_done, n_total) after each subject
+    :param use_cache: Whether to cache the parsed trajectory files (see encoder.trajcache), so that running the
+                      batch again is faster
+    :return: A list of the per-subject stats (dicts)
+    """
+
+    input_dirs = find_coded_dirs(root_dir)
+    if len(input_dirs) == 0:
+        raise ValueError('No coded-data directories were found in {:}'.format(root_dir))
+
+    subj_ids = [subject_id(root_dir, d) for d in input_dirs]
+
+    all_rows = []
+    all_stats = []
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        #-- map() returns the results in the subjects' order
+        for csv_rows, stats in executor.map(_aggregate_subject, input_dirs, subj_ids, [use_cache] * len(input_dirs)):
+            all_rows.extend(csv_rows)
+            all_stats.append(stats)
+            if progress is not None:
+                progress(len(all_stats), len(input_dirs))
+
+    analyze.transform.save_aggregations(all_rows, _agg_func_specs(), out_filename, subject_column=True)
+    _save_timing_csv(all_stats, timing_filename(out_filename))
+
+    return all_stats
+
+
+#-------------------------------------------------------
+def _save_timing_csv(all_stats, out_filename):
+    with open(out_filename, 'w') as fp:
+        writer = csv.DictWriter(fp, _timing_fieldnames, lineterminator='\n')
+        writer.writeheader()
+        for stats in all_stats:
+            writer.writerow(stats)
+
+
+#-------------------------------------------------------
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog='python -m encoder.extract_aggregate_measures',
+                                     description='Rebuild the characters file of a coded-data directory from all its coded trials, '
+                                                 'or (with --batch) create one characters file for all subjects under a root directory')
+    parser.add_argument('dir', help='The coded-data directory (with --batch: the root directory)')
+    parser.add_argument('--batch', action='store_true', help='Process all coded-data directories under the given root directory')
+    parser.add_argument('--check', action='store_true', help='Compare the vectorized aggregations with the per-character reference '
+                                                             'implementation, without saving anything')
+    parser.add_argument('--out', help='With --batch: the combined characters file (default: <root>/characters_all_subjects.csv)')
+    parser.add_argument('--workers', type=int, default=None, help='With --batch: the number of worker processes (default: number of CPUs)')
+    parser.add_argument('--cache', action='store_true', help='With --batch: cache the parsed trajectory files, to speed up later runs '
+                                                             '(in $WRITRACKER_CACHE_DIR, default: ~/.writracker/cache)')
+    args = parser.parse_args()
+
+    if args.check:
+        n_rows, differences = check_agg_measures(args.dir)
+        for row, ref_row in differences:
+            print('Difference in trial #{:}, character #{:}:\n  vectorized: {:}\n  reference:  {:}'
+                  .format(row['trial_id'], row['char_num'], row, ref_row))
+        print('Checked {:} characters: {:} differences'.format(n_rows, len(differences)))
+        if len(differences) > 0:
+            sys.exit(1)
+
+    elif args.batch:
+        out_filename = args.out or os.path.join(args.dir, 'characters_all_subjects.csv')
+        subj_stats = execute_agg_measures_batch(args.dir, out_filename, n_workers=args.workers, use_cache=args.cache,
+                                                progress=lambda n, total: print('{:}/{:} subjects done'.format(n, total)))
+
+        failed = [s for s in subj_stats if s['error'] != '']
+        print('Saved {:} characters of {:} subjects to {:} (timing: {:})'.format(
+            sum(s['n_characters'] for s in subj_stats), len(subj_stats) - len(failed), out_filename, timing_filename(out_filename)))
+        for s in failed:
+            print('ERROR in {:}: {:}'.format(s['directory'], s['error']))
+        if len(failed) > 0:
+            sys.exit(1)
+
+    else:
+        execute_agg_measures(args.dir)
@@ -0,0 +1,135 @@
+"""
+Default segmentation of a trial's trajectory into strokes and characters.
+
+This module does not depend on any UI package, so it can be used by batch jobs as well as by the coding app.
+"""
+import numpy as np
+
+
+#-------------------------------------------------------------------------------------
+class DefaultSegmentation(object):
+    """
+    The default segmentation of a trajectory.
+
+    Stroke #i consists of the points stroke_offsets[i]:stroke_offsets[i+1] and is on paper if stroke_on_paper[i].
+    stroke_char[i] is the (0-based) index of the character that stroke #i belongs to.
+    """
+
+    def __init__(self, stroke_offsets, stroke_on_paper, stroke_char):
+        self.stroke_offsets = stroke_offsets
+        self.stroke_on_paper = stroke_on_paper
+        self.stroke_char = stroke_char
+
+    @property
+    def n_strokes(self):
+        return len(self.stroke_on_paper)
+
+    @property
+    def n_chars(self):
+        return 0 if len(self.stroke_char) == 0 else self.stroke_char[-1] + 1
+
+    def stroke_range(self, i):
+        return self.stroke_offsets[i], self.stroke_offsets[i + 1]
+
+
+#-------------------------------------------------------------------------------------
+def split_into_strokes(z, min_on_paper_z=5):
+    """
+    Split a trajectory into strokes: a new stroke starts whenever the pen is lifted from the paper or put on it.
+
+    As in the coding app, the trajectory is assumed to start off paper, so if the first point is on paper, the first
+    stroke is an empty off-paper stroke.
+
+    :param z: The pen pressure per point
+    :param min_on_paper_z: A point is on paper if its z is higher than this
+    :return: (stroke_offsets, stroke_on_paper)
+    """
+
+    on_paper = np.asarray(z) > min_on_paper_z
+    n = len(on_paper)
+
+    if n == 0:
+        return np.array([0, 0]), np.array([False])
+
+    changes = np.flatnonzero(on_paper[1:] != on_paper[:-1]) + 1
+    starts = np.concatenate([[0, 0] if on_paper[0] else [0], changes])
+    offsets = np.append(starts, n)
+
+    stroke_on_paper = np.zeros(len(starts), dtype=bool)
+    non_empty = starts < offsets[1:]
+    stroke_on_paper[non_empty] = on_paper[starts[non_empty]]
+
+    return offsets, stroke_on_paper
+
+
+#-------------------------------------------------------------------------------------
+def default_segmentation(x, z, max_within_char_overlap, min_on_paper_z=5):
+    """
+    Create characters in a default manner: each stroke is a separate character, but horizontally-overlapping strokes
+    are in the same character. Off-paper strokes join the current character.
+
+    The x-extent of each on-paper stroke is computed once, and the x-extent of the current character is updated
+    as strokes are added to it, so this runs in linear time.
+
+    :param x: The x coordinate per point
+    :param z: The pen pressure per point
+    :param max_within_char_overlap: An on-paper stroke starts a new character if its horizontal overlap with the
+                                    current character is smaller than this ratio (see x_overlap_ratio)
+    :return: DefaultSegmentation
+    """
+
+    x = np.asarray(x, dtype=float)
+    offsets, stroke_on_paper = split_into_strokes(z, min_on_paper_z)
+    n_strokes = len(stroke_on_paper)
+
+    stroke_char = np.zeros(n_strokes, dtype=int)
+    char_ind = -1
+    char_min_x = None
+    char_max_x = None
+
+    for i in range(n_strokes):
+
+        start, end = offsets[i], offsets[i + 1]
+        on_paper = stroke_on_paper[i] and end > start
+        if on_paper:
+            stroke_x = x[start:end]
+            stroke_min_x, stroke_max_x = stroke_x.min(), stroke_x.max()
+
+        if char_ind < 0:
+            #-- First stroke: always in the first character
+            create_new_char = True
+        elif not on_paper or char_min_x is None:
+            create_new_char = False
+        else:
+            create_new_char = x_overlap_ratio(char_min_x, char_max_x, stroke_min_x, stroke_max_x) < max_within_char_overlap
+
+        if create_new_char:
+            char_ind += 1
+            char_min_x = None
+            char_max_x = None
+
+        stroke_char[i] = char_ind
+
+        if on_paper:
+            char_min_x = stroke_min_x if char_min_x is None else min(char_min_x, stroke_min_x)
+            char_max_x = stroke_max_x if char_max_x is None else max(char_max_x, stroke_max_x)
+
+    return DefaultSegmentation(offsets, stroke_on_paper, stroke_char)
+
+
+#-------------------------------------------------------------------------------------
+def x_overlap_ratio(min1, max1, min2, max2):
+    """
+    Get 2 horizontal intervals and return the % of overlap between them.
+    The overlap is defined as: overlapping_inverval / total_inverval
+    """
+
+    overlap = min(max1, max2) - max(min1, min2)
+    overlap = max(overlap, 0)
+
+    total_width = max(max1, max2) - min(min1, min2)
+
+    if total_width == 0:
+        return 1
+    else:
+        return overlap / total_width
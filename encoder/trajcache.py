@@ -0,0 +1,194 @@
+"""
+A persistent cache of parsed trajectory files.
+
+Each parsed file is saved as a .npy file (in the binary trajectory store's format, see trajstore) in a cache
+directory that is shared by all sessions. A cache entry is keyed by the source file's path, size and modification
+time, so a file that was changed is parsed again. When the cache exceeds its maximal size, the least recently used
+entries are deleted. This check scans the whole cache directory, so it runs only after new entries were written:
+every EVICT_EVERY_N_WRITES writes, and when a loader calls evict_if_written().
+
+The cache is not used by default; callers that load the same files repeatedly (e.g. batch scripts) opt in.
+"""
+import hashlib
+import os
+import threading
+import uuid
+import numpy as np
+import trajstore
+
+
+#-- Change this when the cache format changes, to ignore old entries
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_MAX_SIZE_MB = 500
+
+#-- The default cache directory can be set with this environment variable
+CACHE_DIR_ENV_VAR = 'WRITRACKER_CACHE_DIR'
+
+EVICT_EVERY_N_WRITES = 100
+
+#-- The number of entries written to each cache directory (by this process) since it was last checked for eviction.
+#-- This is per process and not per TrajectoryCache object, because worker processes get a copy of the object per file.
+_n_writes_since_evict = {}
+_n_writes_lock = threading.Lock()
+
+
+#-------------------------------------------------------------------------------------
+def default_cache_dir():
+    if os.environ.get(CACHE_DIR_ENV_VAR):
+        return os.environ[CACHE_DIR_ENV_VAR]
+    return os.path.join(os.path.expanduser('~'), '.writracker', 'cache')
+
+
+_default_cache = None
+
+
+def default_cache():
+    """
+    Get the cache in the default cache directory
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = TrajectoryCache(default_cache_dir())
+    return _default_cache
+
+
+#-------------------------------------------------------------------------------------
+class TrajectoryCache(object):
+
+    def __init__(self, cache_dir, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+
+
+    def load(self, filename, parse_func, column_names):
+        """
+        Get the columns of a trajectory file: from the cache if possible, otherwise by parsing the file (and saving
+        the result in the cache).
+
+        :param parse_func: A function that gets the filename and returns a dict with an array per column
+        :param column_names: The columns that parse_func returns (they must be columns of trajstore.POINT_DTYPE)
+        :return: dict with an array per column
+        """
+
+        entry_filename = self._entry_filename(filename, column_names)
+
+        if entry_filename is not None and os.path.isfile(entry_filename):
+            try:
+                points = np.load(entry_filename)
+            except (IOError, OSError, ValueError):
+                points = None
+
+            if points is not None and points.dtype == trajstore.POINT_DTYPE:
+                self._touch(entry_filename)
+                return {name: points[name] for name in column_names}
+
+        columns = parse_func(filename)
+
+        if entry_filename is not None:
+            self._save(entry_filename, columns, column_names)
+
+        return columns
+
+
+    def evict(self):
+        """
+        If the cache is larger than its maximal size, delete the least recently used entries
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+
+        entries = []
+        with os.scandir(self.cache_dir) as dir_entries:
+            for entry in dir_entries:
+                if entry.is_file() and entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+
+    def clear(self):
+        """ Delete all cache entries """
+        max_size = self.max_size_bytes
+        self.max_size_bytes = 0
+        self.evict()
+        self.max_size_bytes = max_size
+
+
+    def evict_if_written(self):
+        """
+        Evict old entries (see evict) if this process wrote new entries since the last eviction
+        """
+        if self._reset_writes() > 0:
+            self.evict()
+
+
+    def _count_write(self):
+        with _n_writes_lock:
+            n = _n_writes_since_evict.get(self.cache_dir, 0) + 1
+            _n_writes_since_evict[self.cache_dir] = n
+        if n >= EVICT_EVERY_N_WRITES:
+            self._reset_writes()
+            self.evict()
+
+
+    def _reset_writes(self):
+        with _n_writes_lock:
+            return _n_writes_since_evict.pop(self.cache_dir, 0)
+
+
+    def _entry_filename(self, filename, column_names):
+        """
+        The cache entry's filename, which depends on the source file's fingerprint. None if the source file
+        does not exist.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        key = '|'.join([str(CACHE_FORMAT_VERSION), os.path.abspath(filename), str(stat.st_size), str(stat.st_mtime_ns)]
+                       + list(column_names))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+
+    def _save(self, entry_filename, columns, column_names):
+        points = np.zeros(len(columns[column_names[0]]) if len(column_names) > 0 else 0, dtype=trajstore.POINT_DTYPE)
+        try:
+            for name in column_names:
+                points[name] = columns[name]
+        except (ValueError, TypeError):
+            #-- Values that cannot be saved in the store's format are not cached
+            return
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            #-- Several processes may save the same entry, so each writes its own temporary file
+            tmp_filename = '{:}.{:}.tmp'.format(entry_filename, uuid.uuid4().hex)
+            with open(tmp_filename, 'wb') as fp:
+                np.save(fp, points)
+            os.replace(tmp_filename, entry_filename)
+        except (IOError, OSError):
+            #-- The cache is an optimization; failing to save it is not an error
+            return
+
+        self._count_write()
+
+
+    @staticmethod
+    def _touch(entry_filename):
+        """ Mark the entry as recently used """
+        try:
+            os.utime(entry_filename)
+        except OSError:
+            pass
@@ -4,15 +4,18 @@ coding strokes & characters in one trial
 import PySimpleGUI as sg
 import numpy as np
 import re
+from concurrent.futures import ThreadPoolExecutor
 import data
 from tkinter import*
 import tkinter as tk
 from encoder import *
 from encoder import dataio
-import pyautogui
+from encoder import segmentation
 
 
-markup_config = dict(max_within_char_overlap=0.25, error_codes=('WrongNumber', 'NoResponse', 'BadHandwriting', 'TooConnected'))
+#-- render_mode: 'lines' draws each stroke as one polyline (fast); 'dots' draws one circle per dot
+markup_config = dict(max_within_char_overlap=0.25, error_codes=('WrongNumber', 'NoResponse', 'BadHandwriting', 'TooConnected'),
+                     render_mode='lines')
 
 RED = ["#FF0000", "#FF8080", "#FFA0A0"]
 CYAN = ["#00FFFF", "#A0FFFF", "#C0FFFF"]
@@ -21,7 +24,20 @@ ORANGE = ["DarkOrange1", "DarkOrange2", "DarkOrange3"]
 # root = tk.Tk()
 # screen_width = root.winfo_screenwidth()
 # screen_height = root.winfo_screenheight()
-width, height= pyautogui.size()
+
+
+#-------------------------------------------------------------------------------------
+def __getattr__(name):
+    """
+    The screen's width and height (trialcoder.width, trialcoder.height) are queried on first use, not when the
+    module is imported
+    """
+    if name in ('width', 'height'):
+        import pyautogui
+        global width, height
+        width, height = pyautogui.size()
+        return globals()[name]
+    raise AttributeError("module '{:}' has no attribute '{:}'".format(__name__, name))
 
 # full_window = app.desktop().frameGeometry()            # get desktop resolution
 #         self.resize(full_window.width(), full_window.height())  # set window size to full screen
@@ -31,15 +47,25 @@ width, height= pyautogui.size()
 
 
 #-------------------------------------------------------------------------------------
-def encode_one_trial(trial, out_dir, dot_radius=2, screen_size=(1000, 800), margin=25):
+def encode_one_trial(trial, out_dir, dot_radius=2, screen_size=(1000, 800), margin=25, prepared=None):
     """
     fully encode one trial.
 
+    :param prepared: A PreparedTrial (see TrialPrefetcher). If it was prepared with the current settings, its
+                     characters and layout are used instead of computing them here.
+
     Return what to do next: quit, next, prev, or choose_trial
     """
 
+    layout = None
+    if prepared is not None and prepared.is_valid_for(trial, screen_size, margin):
+        characters = prepared.characters
+        layout = prepared.layout
+    else:
+        characters = _create_default_characters(trial.traj_points, markup_config['max_within_char_overlap'])
+
     #-- trial_queue usually contains just one element, unless we split a trial into 2 trials
-    trial_queue = [_create_default_characters(trial.traj_points, markup_config['max_within_char_overlap'])]
+    trial_queue = [characters]
     sub_trial_num = 0
 
     selection_handler = None
@@ -54,7 +80,10 @@ def encode_one_trial(trial, out_dir, dot_radius=2, screen_size=(1000, 800), marg
         #-- This small loop runs the trial-encoding screen
         rc = 'continue'
         while rc == 'continue':
-            rc, characters, extra_info = _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, screen_size, margin, selection_handler, show_command)
+            rc, characters, extra_info = _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, screen_size, margin,
+                                                           selection_handler, show_command, layout)
+            #-- The prepared layout is valid only for the trial's initial characters
+            layout = None
 
         #-- Check what to do next: continue to another trial, or open another popup for the same trial
 
@@ -128,6 +157,96 @@ def encode_one_trial(trial, out_dir, dot_radius=2, screen_size=(1000, 800), marg
     return 'next'
 
 
+#-------------------------------------------------------------------------------------
+class PreparedTrial(object):
+    """
+    A trial's default segmentation into characters, and its screen layout - everything needed before the
+    trial-coding window can open
+    """
+
+    def __init__(self, trial, screen_size=(1000, 800), margin=25):
+        self.trial = trial
+        self.screen_size = screen_size
+        self.margin = margin
+        self.max_within_char_overlap = markup_config['max_within_char_overlap']
+        self.characters = _create_default_characters(trial.traj_points, self.max_within_char_overlap)
+
+        dots = [dot for c in self.characters for dot in c.on_paper_dots]
+        self.layout = _get_expand_ratio(dots, screen_size, margin) if len(dots) > 0 else None
+
+    def is_valid_for(self, trial, screen_size, margin):
+        """
+        Whether this object can be used for coding the given trial with the current settings
+        """
+        return self.trial is trial and self.screen_size == tuple(screen_size) and self.margin == margin and \
+            self.max_within_char_overlap == markup_config['max_within_char_overlap']
+
+
+#-------------------------------------------------------------------------------------
+class TrialPrefetcher(object):
+    """
+    Prepares the next few trials (see PreparedTrial) in a background thread, while the user is coding the current
+    trial. A prepared trial is discarded if markup_config['max_within_char_overlap'] has changed since it was prepared.
+
+    Each PreparedTrial is handed out only once, because the coding process modifies its characters.
+    """
+
+    def __init__(self, trials, n_ahead=3, screen_size=(1000, 800), margin=25):
+        """
+        :param trials: The list of trials being coded
+        :param n_ahead: How many trials to prepare ahead of the current one
+        """
+        self._trials = trials
+        self._n_ahead = n_ahead
+        self._screen_size = tuple(screen_size)
+        self._margin = margin
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='trial-prefetch')
+        self._futures = {}  # trial index -> (max_within_char_overlap, future)
+
+
+    def prefetch(self, index):
+        """
+        Make sure that trials #index ... #index+n_ahead are being prepared; forget about any other trial
+        """
+        max_overlap = markup_config['max_within_char_overlap']
+        wanted = range(max(index, 0), min(index + self._n_ahead + 1, len(self._trials)))
+
+        for i in list(self._futures):
+            overlap, future = self._futures[i]
+            if i not in wanted or overlap != max_overlap:
+                future.cancel()
+                del self._futures[i]
+
+        for i in wanted:
+            if i not in self._futures:
+                future = self._executor.submit(PreparedTrial, self._trials[i], self._screen_size, self._margin)
+                self._futures[i] = max_overlap, future
+
+
+    def get(self, index):
+        """
+        Return the PreparedTrial of trials[index], waiting for it if it's still being prepared.
+        Return None if this trial was not prefetched with the current settings.
+        """
+        entry = self._futures.pop(index, None)
+        if entry is None:
+            return None
+
+        overlap, future = entry
+        if overlap != markup_config['max_within_char_overlap'] or future.cancelled():
+            future.cancel()
+            return None
+
+        return future.result()
+
+
+    def close(self):
+        for overlap, future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._executor.shutdown(wait=False)
+
+
 #-------------------------------------------------------------------------------------
 def _open_settings(config):
     """
@@ -188,8 +307,11 @@ def _open_settings(config):
 
 
 #-------------------------------------------------------------------------------------
-def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, screen_size, margin, last_selection_handler, show_command):
+def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, screen_size, margin, last_selection_handler, show_command,
+                      layout=None):
     """"
+    :param layout: (expand_ratio, offset, screen_size) if it was precomputed; None = compute it here
+
     returns in this order: rc, characters, extra_info
     """
     strokes = [s for c in characters for s in c.on_paper_strokes]
@@ -204,7 +326,9 @@ def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, scr
     on_paper_chars = [c for c in characters if len(c.trajectory) > 0]
     on_paper_strokes = [s for s in strokes if len(s.trajectory) > 0]
 
-    expand_ratio, offset, screen_size = _get_expand_ratio(all_markup_dots, screen_size, margin)
+    if layout is None:
+        layout = _get_expand_ratio(all_markup_dots, screen_size, margin)
+    expand_ratio, offset, screen_size = layout
 
     title = 'Trial #{:}, target={:} ({:} characters, {:} strokes) '\
         .format(trial.trial_id, trial.stimulus, len(on_paper_chars), len(on_paper_strokes))
@@ -220,7 +344,7 @@ def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, scr
     graph = window.Element('graph')
     instructions = window.Element('instructions')
 
-    _plot_dots_for_markup(characters, graph, screen_size, expand_ratio, offset, margin, dot_radius)
+    dot_index = _plot_dots_for_markup(characters, graph, screen_size, expand_ratio, offset, margin, dot_radius)
 
     selection_handler = None
     current_command = None
@@ -335,30 +459,30 @@ def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, scr
                 instructions.Update('Select the characters to merge. ENTER=confirm, ESC=abort')
                 current_command = 'merge_chars'
                 if selection_handler is not None:
-                    selection_handler = _CharSelector(graph, characters, 'any', selection_handler.selected)
+                    selection_handler = _CharSelector(graph, characters, 'any', selection_handler.selected, dot_index)
                 else:
-                    selection_handler = _CharSelector(graph, characters, 'any', [])
+                    selection_handler = _CharSelector(graph, characters, 'any', [], dot_index)
 
         #-- Split a stroke into 2 characters
         elif event in ('s', 'S', 'split_stroke', 83):
             if current_command is None:
                 instructions.Update('Select a stroke to split. ENTER=confirm, ESC=abort')
                 current_command = 'split_stroke'
-                selection_handler = _SingleStrokeSelector(graph, strokes)
+                selection_handler = _SingleStrokeSelector(graph, strokes, dot_index)
 
         #-- Split a character
         elif event in ('c', 'C', 'split_char', 67):
             if current_command is None:
                 instructions.Update('Select a character to split to 2 different characters. ENTER=confirm, ESC=abort')
                 current_command = 'split_char'
-                selection_handler = _MultiStrokeSelector(graph, characters)
+                selection_handler = _MultiStrokeSelector(graph, characters, dot_index)
 
         #-- Split the trial into 2 trials
         elif event in ('t', 'T', 'split_trial', 84):
             if current_command is None:
                 instructions.Update('Select the last character of trial#1. ENTER=confirm, ESC=abort')
                 current_command = 'split_trial'
-                selection_handler = _CharSelector(graph, characters, 'series', None)
+                selection_handler = _CharSelector(graph, characters, 'series', None, dot_index)
 
 
         #-- Self correction
@@ -367,7 +491,7 @@ def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, scr
                 instructions.Update('Select the correct character. ENTER=confirm, ESC=abort')
                 #window['show_correction'].update(disabled=False)
                 current_command = 'self_correction'
-                selection_handler = _SingleStrokeSelector(graph, strokes)
+                selection_handler = _SingleStrokeSelector(graph, strokes, dot_index)
                 last_selection_handler = selection_handler
 
         # -- Show Self correction
@@ -385,7 +509,7 @@ def _try_encode_trial(trial, characters, sub_trial_num, out_dir, dot_radius, scr
             if current_command is None:
                 instructions.Update('Select a stroke to delete. ENTER=confirm, ESC=abort')
                 current_command = 'delete_stroke'
-                selection_handler = _SingleStrokeSelector(graph, strokes)
+                selection_handler = _SingleStrokeSelector(graph, strokes, dot_index)
 
         elif event == 'response':
             text = sg.popup_get_text('The participant wrote {:} characters'.format(len(on_paper_chars)), 'Please enter response:')
@@ -520,8 +644,18 @@ def _create_window_for_markup(screen_size, title):
 
 #-------------------------------------------------------------------------------------
 def _plot_dots_for_markup(characters, graph, screen_size, expand_ratio, offset, margin, dot_radius):
+    """
+    Plot the on-paper dots, and return a _DotIndex of the plotted dots
+
+    Depending on markup_config['render_mode'], each stroke is drawn as one polyline canvas item ('lines'), or as
+    one oval per dot ('dots'). Either way, consecutive dots that fall on the same pixel are drawn only once.
+    The canvas items of each stroke are saved in stroke.ui_items.
+    """
 
-    dot_num = 0
+    canvas = graph.TKCanvas
+    draw_lines = markup_config['render_mode'] == 'lines'
+
+    plotted_dots = []
     char_index = 0
     for char in characters:
         char_index += 1
@@ -534,23 +668,66 @@ def _plot_dots_for_markup(characters, graph, screen_size, expand_ratio, offset,
             if stroke.correction != 1:
                 stroke.color = color[i] if i < len(color) else color[-1]
 
-            for dot in stroke.trajectory:
-                x = (dot.x - offset[0]) * expand_ratio + margin
-                y = (dot.y - offset[1]) * expand_ratio + margin
-                y = screen_size[1] - y
-                #x = screen_size[1] - x
+            dots = stroke.trajectory
+            if len(dots) == 0:
+                stroke.ui_items = []
+                continue
+
+            xs = (np.array([dot.x for dot in dots], dtype=float) - offset[0]) * expand_ratio + margin
+            ys = screen_size[1] - ((np.array([dot.y for dot in dots], dtype=float) - offset[1]) * expand_ratio + margin)
+            for dot, x, y in zip(dots, xs.tolist(), ys.tolist()):
                 dot.screen_x = x
                 dot.screen_y = y
-                if stroke.correction == 1:
-                    if dot_num % 2 == 0:
-                        dot.ui = graph.TKCanvas.create_oval(x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius, fill = "red")
-                    else:
-                        dot.ui = graph.TKCanvas.create_oval(x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius, fill = "yellow")
-                else:
-                    dot.ui = graph.TKCanvas.create_oval(x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius, fill = stroke.color)
-                dot_num = dot_num + 1
+            plotted_dots.extend(dots)
+
+            xs, ys = _decimate_to_pixels(xs, ys)
+
+            if draw_lines:
+                stroke.ui_items = _create_stroke_polyline(canvas, xs, ys, dot_radius, stroke)
+            elif stroke.correction == 1:
+                stroke.ui_items = [canvas.create_oval(x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius,
+                                                      fill="red" if j % 2 == 0 else "yellow")
+                                   for j, (x, y) in enumerate(zip(xs, ys))]
+            else:
+                stroke.ui_items = [canvas.create_oval(x - dot_radius, y - dot_radius, x + dot_radius, y + dot_radius, fill=stroke.color)
+                                   for x, y in zip(xs, ys)]
+
+            canvas.create_text(xs[-1]+2 , ys[-1]+2 , fill='yellow', text=str(char_index) + "." + str(i+1), anchor = NW)
+
+    return _DotIndex(plotted_dots)
+
+
+#-------------------------------------------------------------------------------------
+def _decimate_to_pixels(xs, ys):
+    """
+    Drop dots that fall on the same screen pixel as the previous dot. Return the remaining dots' coordinates (lists).
+    """
+    px = np.round(xs)
+    py = np.round(ys)
+    keep = np.ones(len(xs), dtype=bool)
+    keep[1:] = (px[1:] != px[:-1]) | (py[1:] != py[:-1])
+    return xs[keep].tolist(), ys[keep].tolist()
+
+
+#-------------------------------------------------------------------------------------
+def _create_stroke_polyline(canvas, xs, ys, dot_radius, stroke):
+    """
+    Draw a stroke as a single line item. A self-correction stroke gets a red dashed line over a yellow one.
+    Return the list of canvas items.
+    """
+    if len(xs) == 1:
+        #-- A line must have 2 points
+        xs = xs * 2
+        ys = ys * 2
+
+    coords = [c for xy in zip(xs, ys) for c in xy]
+    line_args = dict(width=dot_radius * 2, capstyle=ROUND, joinstyle=ROUND)
 
-            graph.TKCanvas.create_text(x+2 , y+2 , fill='yellow', text=str(char_index) + "." + str(i+1), anchor = NW)
+    if stroke.correction == 1:
+        return [canvas.create_line(*coords, fill="yellow", **line_args),
+                canvas.create_line(*coords, fill="red", dash=(4, 4), **line_args)]
+    else:
+        return [canvas.create_line(*coords, fill=stroke.color, **line_args)]
 
     '''self.canvas = Canvas(root, width=800, height=650, bg='#afeeee')
             self.canvas.create_text(100, 10, fill="darkblue", font="Times 20 italic bold",
@@ -575,6 +752,7 @@ def _split_stroke(stroke, screen_size, margin, dot_radius=6):
     graph = window.Element('graph')
 
     dots = _plot_dots_for_split(stroke.trajectory, graph, screen_size, expand_ratio, offset, margin, dot_radius)
+    dot_index = _DotIndex(dots)
 
     selected_dot = None
 
@@ -590,7 +768,7 @@ def _split_stroke(stroke, screen_size, margin, dot_radius=6):
             if click_coord[0] is None:
                 continue
 
-            clicked_dot = _find_clicked_dot(dots, click_coord)
+            clicked_dot = _find_clicked_dot(dots, click_coord, dot_index)
             for dot in dots:
                 graph.TKCanvas.itemconfig(dot.ui, fill=dot.color)
 
@@ -716,6 +894,9 @@ class _Stroke(data.Stroke):
         super().__init__(on_paper, None, dots)
         self.stroke_num = stroke_num
         self.is_seen = True
+        #-- Each dot knows its stroke (used by _DotIndex). A stroke that was split re-assigns its dots to the new strokes.
+        for dot in dots:
+            dot.stroke = self
         # self.correction = correction
 
     @property
@@ -750,10 +931,11 @@ class _SingleStrokeSelector(object):
     Handles click to select one stroke
     """
 
-    def __init__(self, graph, strokes):
+    def __init__(self, graph, strokes, dot_index=None):
         self.graph = graph
         self.strokes = [s for s in strokes if len(s.trajectory) > 0]
         self.selected = None
+        self.dot_index = dot_index
 
 
     def clicked(self, values):
@@ -762,7 +944,7 @@ class _SingleStrokeSelector(object):
         if click_coord[0] is None:
             return
 
-        clicked_stroke = _find_clicked_stroke(self.strokes, click_coord)        #finds the selected stroke
+        clicked_stroke = _find_clicked_stroke(self.strokes, click_coord, self.dot_index)        #finds the selected stroke
 
         if clicked_stroke == self.selected:             #second click on the same stroke
             self.cleanup()
@@ -789,12 +971,13 @@ class _MultiStrokeSelector(object):
     Handles click to split a character into two sets of strokes
     """
 
-    def __init__(self, graph, characters):
+    def __init__(self, graph, characters, dot_index=None):
         self.graph = graph
         self.characters = [c for c in characters if len(c.on_paper_dots) > 0]
         self.strokes = [s for c in characters for s in c.on_paper_strokes]
         self.selected_stroke = None
         self.selected_char = None
+        self.dot_index = dot_index
 
 
     def clicked(self, values):
@@ -805,14 +988,14 @@ class _MultiStrokeSelector(object):
 
         self.cleanup()
 
-        self.selected_char = _find_clicked_char(self.characters, click_coord)
+        self.selected_char = _find_clicked_char(self.characters, click_coord, self.dot_index)
         if len(self.selected_char.on_paper_strokes) == 1:
             #-- Can't choose a 1-stroke character
             self.selected_char = None
             self.selected_stroke = None
             return
 
-        self.selected_stroke = _find_clicked_stroke(self.selected_char.on_paper_strokes, click_coord)
+        self.selected_stroke = _find_clicked_stroke(self.selected_char.on_paper_strokes, click_coord, self.dot_index)
         self.highlight_selected()
 
 
@@ -841,12 +1024,13 @@ class _CharSelector(object):
     Handles click to select one character
     """
 
-    def __init__(self, graph, characters, mode, selected):
+    def __init__(self, graph, characters, mode, selected, dot_index=None):
         assert mode in ('pair', 'series', 'any')
         self.graph = graph
         self.characters = [c for c in characters if len(c.on_paper_dots) > 0]
         self.mode = mode
         self.selected = selected
+        self.dot_index = dot_index
 
 
     def clicked(self, values):
@@ -854,7 +1038,7 @@ class _CharSelector(object):
         if click_coord[0] is None:
             return
 
-        clicked_char = _find_clicked_char(self.characters, click_coord)
+        clicked_char = _find_clicked_char(self.characters, click_coord, self.dot_index)
 
 
         if self.mode == 'any':
@@ -904,90 +1088,35 @@ def _create_default_characters(dots, max_within_char_overlap):
     """
     Create characters in a default manner: each stroke is a separate character, but horizontally-overlapping strokes
     are separate characters
+
+    The segmentation itself is done by segmentation.default_segmentation(); this function only creates the
+    coding app's objects.
     """
 
-    strokes = _split_dots_into_strokes(dots)
+    if isinstance(dots, data.Trajectory):
+        x, z = dots.x, dots.z
+    else:
+        x, z = [dot.x for dot in dots], [dot.z for dot in dots]
+    seg = segmentation.default_segmentation(x, z, max_within_char_overlap)
+
+    all_dots = [_Dot(dot) for dot in dots]
 
     characters = []
-    curr_char = None
-    curr_char_has_on_paper_strokes = False
     correction = 0
 
-    for stroke in strokes:
+    for i in range(seg.n_strokes):
+        start, end = seg.stroke_range(i)
+        #-- Strokes are numbered from 2, as they always were
+        stroke = _Stroke(all_dots[start:end], i + 2, bool(seg.stroke_on_paper[i]))
 
-        if curr_char is None:
-            #-- First stroke in a the number: always in the first character
-            create_new_char = True
-        elif not stroke.on_paper or not curr_char_has_on_paper_strokes:
-            create_new_char = False
+        if seg.stroke_char[i] == len(characters):
+            characters.append(_Character(len(characters) + 1, [stroke], correction))
         else:
-            create_new_char = len(stroke.trajectory) == 0 or _x_overlap_ratio(curr_char.on_paper_dots, stroke.trajectory) < max_within_char_overlap
-
-        if create_new_char:
-            curr_char = _Character(len(characters) + 1, [stroke], correction)
-            curr_char_has_on_paper_strokes = stroke.on_paper
-            characters.append(curr_char)
-        else:
-            curr_char.strokes.append(stroke)
-            curr_char_has_on_paper_strokes = curr_char_has_on_paper_strokes or stroke.on_paper
+            characters[-1].strokes.append(stroke)
 
     return characters
 
 
-#-------------------------------------------------------------------------------------
-def _split_dots_into_strokes(dots):
-
-    strokes = []
-
-    curr_stroke_dots = []
-    curr_stroke_num = 1
-    prev_on_paper = False
-    correction = 0
-
-    for dot in dots:
-
-        on_paper = dot.z > 5
-
-        if prev_on_paper != on_paper:
-            #-- Pen lifted from paper or put on it
-            curr_stroke_num += 1
-            strokes.append(_Stroke(curr_stroke_dots, curr_stroke_num, prev_on_paper))
-            curr_stroke_dots = []
-
-        curr_stroke_dots.append(_Dot(dot))
-        prev_on_paper = on_paper
-
-    strokes.append(_Stroke(curr_stroke_dots, curr_stroke_num + 1, prev_on_paper))
-
-    return strokes
-
-
-#-------------------------------------------------------------------------------------
-def _x_overlap_ratio(dots1, dots2):
-    """
-    Get 2 arrays of dots and return the % of overlap between the two intervals.
-    The overlap is defined as: overlapping_inverval / total_inverval
-    """
-
-    x1 = [d.x for d in dots1]
-    x2 = [d.x for d in dots2]
-
-    max1 = max(x1)
-    min1 = min(x1)
-    max2 = max(x2)
-    min2 = min(x2)
-
-    overlap = min(max1, max2) - max(min1, min2)
-    overlap = max(overlap, 0)
-
-    total_width = max(max1, max2) - min(min1, min2)
-
-    if total_width == 0:
-        return 1
-    else:
-        return overlap / total_width
-
-
 #-------------------------------------------------------------------------------------
 def _get_expand_ratio(dots, screen_size, margin):
 
@@ -1015,7 +1144,13 @@ def _get_expand_ratio(dots, screen_size, margin):
 
 
 #-------------------------------------------------------------------------------------
-def _find_clicked_dot(dots, coord):
+def _find_clicked_dot(dots, coord, dot_index=None):
+    """
+    Find the dot nearest to the given screen coordinates. dot_index, if provided, must index the same dots.
+    """
+    if dot_index is not None:
+        return dot_index.nearest(coord)
+
     distances = [distance2(d, coord) for d in dots]
     closest = np.argmin(distances)
     # noinspection PyTypeChecker
@@ -1023,8 +1158,15 @@ def _find_clicked_dot(dots, coord):
 
 
 #-------------------------------------------------------------------------------------
-def _find_clicked_char(characters, coord):
+def _find_clicked_char(characters, coord, dot_index=None):
     characters = [c for c in characters]
+
+    if dot_index is not None:
+        char_per_stroke = {id(s): c for c in characters for s in c.on_paper_strokes}
+        dot = dot_index.nearest(coord, lambda d: id(d.stroke) in char_per_stroke)
+        if dot is not None:
+            return char_per_stroke[id(dot.stroke)]
+
     distances = [_get_distance_to_char(s, coord) for s in characters]
     closest = np.argmin(distances)
     # noinspection PyTypeChecker
@@ -1036,8 +1178,15 @@ def _get_distance_to_char(char, coord):
 
 
 #-------------------------------------------------------------------------------------
-def _find_clicked_stroke(strokes, coord):
+def _find_clicked_stroke(strokes, coord, dot_index=None):
     strokes = [s for s in strokes]
+
+    if dot_index is not None:
+        stroke_ids = set(id(s) for s in strokes)
+        dot = dot_index.nearest(coord, lambda d: id(d.stroke) in stroke_ids)
+        if dot is not None:
+            return dot.stroke
+
     distances = [_get_distance_to_stroke(s, coord) for s in strokes]
     closest = np.argmin(distances)
     # noinspection PyTypeChecker
@@ -1048,6 +1197,95 @@ def _get_distance_to_stroke(stroke, coord):
     return min([distance2(dot, coord) for dot in stroke.trajectory])
 
 
+#-------------------------------------------------------------------------------------
+class _DotIndex(object):
+    """
+    A grid index of dots in screen coordinates (dot.screen_x, dot.screen_y), for finding the dot nearest to a
+    mouse click without scanning all dots.
+
+    The index holds dots only. Queries can be restricted to some dots (e.g. those of the selectable strokes), so the
+    index remains valid when strokes/characters are split, merged or deleted - as long as the dots were not moved.
+    """
+
+    def __init__(self, dots, cell_size=20):
+        self.dots = list(dots)
+        self.cell_size = cell_size
+        self.cells = {}
+
+        if len(self.dots) == 0:
+            return
+
+        self.x = np.array([d.screen_x for d in self.dots], dtype=float)
+        self.y = np.array([d.screen_y for d in self.dots], dtype=float)
+        cx = np.floor(self.x / cell_size).astype(int)
+        cy = np.floor(self.y / cell_size).astype(int)
+        self.min_cell = cx.min(), cy.min()
+        self.max_cell = cx.max(), cy.max()
+
+        #-- Group the dot indices by cell (each cell's dots remain in their original order)
+        order = np.lexsort((np.arange(len(cx)), cy, cx))
+        keys = np.stack([cx[order], cy[order]], axis=1)
+        bounds = np.concatenate([[0], np.where(np.any(keys[1:] != keys[:-1], axis=1))[0] + 1, [len(order)]])
+        for i in range(len(bounds) - 1):
+            key = tuple(keys[bounds[i]])
+            self.cells[key] = order[bounds[i]:bounds[i + 1]]
+
+
+    def nearest(self, coord, accept=None):
+        """
+        Return the dot nearest to the given screen coordinates (or None if there are no dots).
+        Among equally-near dots, the first one (in the original order) is returned.
+
+        :param accept: If provided - function(dot) -> bool. Only dots for which it returns True are considered.
+        """
+        if len(self.cells) == 0:
+            return None
+
+        qx, qy = float(coord[0]), float(coord[1])
+        qcx = int(np.floor(qx / self.cell_size))
+        qcy = int(np.floor(qy / self.cell_size))
+
+        #-- Number of rings around the query cell needed to cover the whole grid
+        max_ring = max(abs(qcx - self.min_cell[0]), abs(qcx - self.max_cell[0]),
+                       abs(qcy - self.min_cell[1]), abs(qcy - self.max_cell[1]))
+
+        best_ind = None
+        best_d2 = None
+
+        for ring in range(max_ring + 1):
+            for key in self._ring_cells(qcx, qcy, ring):
+                inds = self.cells.get(key)
+                if inds is None:
+                    continue
+                d2 = (self.x[inds] - qx) ** 2 + (self.y[inds] - qy) ** 2
+                for j in np.argsort(d2, kind='stable'):
+                    if best_d2 is not None and d2[j] > best_d2:
+                        break
+                    ind = inds[j]
+                    if best_d2 is not None and d2[j] == best_d2 and ind > best_ind:
+                        continue
+                    if accept is None or accept(self.dots[ind]):
+                        best_ind, best_d2 = ind, d2[j]
+                        break
+
+            #-- Dots in the next rings are at least (ring * cell_size) away from the query point
+            if best_d2 is not None and best_d2 <= (ring * self.cell_size) ** 2:
+                break
+
+        return None if best_ind is None else self.dots[best_ind]
+
+
+    @staticmethod
+    def _ring_cells(cx, cy, ring):
+        if ring == 0:
+            return [(cx, cy)]
+        cells = [(cx + dx, cy - ring) for dx in range(-ring, ring + 1)] + \
+                [(cx + dx, cy + ring) for dx in range(-ring, ring + 1)] + \
+                [(cx - ring, cy + dy) for dy in range(-ring + 1, ring)] + \
+                [(cx + ring, cy + dy) for dy in range(-ring + 1, ring)]
+        return cells
+
+
 #-------------------------------------------------------------------------------------
 def distance2(dot, coord):
     return (dot.screen_x - coord[0]) ** 2 + (dot.screen_y - coord[1]) ** 2
@@ -1062,14 +1300,14 @@ def _set_char_color(char, color, graph):
 def _set_stroke_color(stroke, color, graph):
     if color is None:
         color = stroke.color
-    for dot in stroke:
-        graph.TKCanvas.itemconfig(dot.ui, fill=color)
+    for item in stroke.ui_items:
+        graph.TKCanvas.itemconfig(item, fill=color)
 #-------------------------------------------------------------------------------------
 
 def _set_corrected_stroke_color(stroke, color, graph):
     stroke.color = color
-    for dot in stroke:
-        graph.TKCanvas.itemconfig(dot.ui, fill=color)
+    for item in stroke.ui_items:
+        graph.TKCanvas.itemconfig(item, fill=color)
 
 #-------------------------------------------------------------------------------------
 def _apply_split_character(characters, selection_handler):
@@ -0,0 +1,119 @@
+"""
+Measure how long it takes to import the core (GUI-free) modules, and check that they do not import GUI or other
+heavy libraries. Each module is imported in a fresh Python process, so the times include all its dependencies.
+
+Usage: python import_benchmark.py [--repeat N] [--budget-ms MS] [--save FILE] [--baseline FILE]
+
+The exit code is 1 if a core module imported a forbidden library, exceeded the time budget, or is much slower than
+in the baseline file.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+#-- Modules that analysis scripts use. They should import with only numpy.
+CORE_MODULES = ('data', 'utils', 'trajstore', 'encoder.segmentation', 'encoder.dataiooldrecorder', 'encoder.dataio',
+                'analyze.transform')
+
+#-- Libraries that the core modules must not import (directly or indirectly)
+FORBIDDEN_MODULES = ('PySimpleGUI', 'tkinter', 'pyautogui', 'matplotlib', 'pandas', 'PyQt5')
+
+DEFAULT_BUDGET_MS = 1000
+
+#-- A module is a regression if it's this much slower than in the baseline
+BASELINE_TOLERANCE = 1.5
+
+_root_dir = os.path.dirname(os.path.abspath(__file__))
+
+_measure_code = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+forbidden = [m for m in {forbidden!r} if m in sys.modules]
+print(json.dumps(dict(ms=duration * 1000, forbidden=forbidden)))
+'''
+
+
+#-------------------------------------------------------------------------------------
+def measure_import(module, repeat=3):
+    """
+    Import a module in fresh Python processes
+
+    :param repeat: Number of processes; the fastest one is reported
+    :return: dict with the import time ('ms') and the forbidden modules it imported ('forbidden')
+    """
+
+    results = []
+    for _ in range(repeat):
+        code = _measure_code.format(module=module, forbidden=FORBIDDEN_MODULES)
+        out = subprocess.run([sys.executable, '-c', code], cwd=_root_dir, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise Exception('Importing {:} failed:\n{:}'.format(module, out.stderr))
+        results.append(json.loads(out.stdout.strip().split('\n')[-1]))
+
+    return min(results, key=lambda r: r['ms'])
+
+
+#-------------------------------------------------------------------------------------
+def run_benchmark(modules=CORE_MODULES, repeat=3, budget_ms=DEFAULT_BUDGET_MS, baseline=None):
+    """
+    Measure the import time of each module
+
+    :param baseline: Import times (ms) per module of an earlier run (optional)
+    :return: (results, errors) - results is a dict with the time (ms) per module; errors is a list of messages
+    """
+
+    results = {}
+    errors = []
+
+    for module in modules:
+        result = measure_import(module, repeat)
+        results[module] = result['ms']
+
+        if len(result['forbidden']) > 0:
+            errors.append('{:} imports {:}'.format(module, ', '.join(result['forbidden'])))
+        if result['ms'] > budget_ms:
+            errors.append('{:} took {:.0f} ms to import (budget: {:} ms)'.format(module, result['ms'], budget_ms))
+        if baseline is not None and module in baseline and result['ms'] > baseline[module] * BASELINE_TOLERANCE:
+            errors.append('{:} took {:.0f} ms to import (baseline: {:.0f} ms)'.format(module, result['ms'], baseline[module]))
+
+    return results, errors
+
+
+#-------------------------------------------------------------------------------------
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Measure the import time of the core (GUI-free) modules')
+    parser.add_argument('modules', nargs='*', help='modules to import (default: {:})'.format(', '.join(CORE_MODULES)))
+    parser.add_argument('--repeat', type=int, default=3, help='processes per module; the fastest is reported')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS, help='maximal import time per module')
+    parser.add_argument('--save', default=None, help='save the import times to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare with the import times in this JSON file')
+    opts = parser.parse_args(args)
+
+    baseline = None
+    if opts.baseline is not None:
+        with open(opts.baseline) as fp:
+            baseline = json.load(fp)
+
+    results, errors = run_benchmark(opts.modules or CORE_MODULES, repeat=opts.repeat, budget_ms=opts.budget_ms, baseline=baseline)
+
+    for module, ms in results.items():
+        print('{:<30} {:8.1f} ms'.format(module, ms))
+
+    if opts.save is not None:
+        with open(opts.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    for err in errors:
+        print('ERROR: ' + err)
+
+    return 1 if len(errors) > 0 else 0
+
+
+#-------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+Export animations (or static thumbnails) of all trials of a session, without the GUI.
+
+    python batch_export.py <trials.csv> <output directory> [options]
+
+The trials are exported in parallel by worker processes. A trial is skipped if its output file is newer than its
+trajectory file, so running the export again only exports new or modified trials (use --force to export all).
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import trajvideo
+
+
+FORMATS = ('gif', 'mp4', 'png')
+
+
+#-------------------------------------------------------------------------------------
+def load_trials(trials_file):
+    """
+    Load the trials file (CSV or Excel, as in the plotter app). Return a list of dicts, one per trial.
+    """
+    if os.path.splitext(trials_file)[1].lower() == '.csv':
+        df = pd.read_csv(trials_file)
+    else:
+        df = pd.read_excel(trials_file)
+
+    for field in ('trial_id', 'raw_file_name'):
+        if field not in df.columns:
+            raise ValueError('Invalid trials file {:}: there is no "{:}" column'.format(trials_file, field))
+
+    return df.to_dict('records')
+
+
+#-------------------------------------------------------------------------------------
+def trajectory_filename(trials_file, trial):
+    """ The trajectory file of a trial: in the directory of the trials file """
+    filename = str(trial['raw_file_name'])
+    if not filename.lower().endswith('.csv'):
+        filename += '.csv'
+    return os.path.join(os.path.dirname(os.path.abspath(trials_file)), filename)
+
+
+#-------------------------------------------------------------------------------------
+def output_filename(out_dir, trial, fmt):
+    name = os.path.splitext(os.path.basename(str(trial['raw_file_name'])))[0]
+    return os.path.join(out_dir, '{:}.{:}'.format(name, fmt))
+
+
+#-------------------------------------------------------------------------------------
+def is_up_to_date(out_filename, traj_filename):
+    """ Whether the output file exists and is newer than the trajectory file """
+    return os.path.isfile(out_filename) and os.path.getmtime(out_filename) >= os.path.getmtime(traj_filename)
+
+
+#-------------------------------------------------------------------------------------
+def parse_trial_ids(spec):
+    """
+    Parse a list of trial IDs, e.g. "1-10,15,20-22"
+    """
+    trial_ids = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        try:
+            if '-' in part:
+                first, last = part.split('-')
+                trial_ids.update(range(int(first), int(last) + 1))
+            else:
+                trial_ids.add(int(part))
+        except ValueError:
+            raise ValueError('Invalid list of trial IDs: "{:}"'.format(spec))
+    return trial_ids
+
+
+#-------------------------------------------------------------------------------------
+def export_session(trials_file, out_dir, fmt='gif', trial_ids=None, rc=None, n_workers=None, force=False,
+                   progress=None, **render_args):
+    """
+    Export an animation or an image of each trial in a session
+
+    :param trials_file: The session's trials file
+    :param out_dir: The directory in which the output files are saved (created if needed)
+    :param fmt: 'gif' or 'mp4' (animations), or 'png' (a static image of the whole trajectory)
+    :param trial_ids: Export only these trials (default: all trials)
+    :param rc: Export only trials with this return code (e.g. 'OK')
+    :param n_workers: The number of worker processes (default: the number of CPUs)
+    :param force: Export all trials, even if their output files are up to date
+    :param progress: If provided, this function is called with (n_done, n_total) after each exported trial
+    :param render_args: Options for trajvideo.render_trajectory_animation() / render_trajectory_image()
+    :return: (exported, skipped, errors) - lists of output files; errors is a list of (trajectory file, error message)
+    """
+
+    if fmt not in FORMATS:
+        raise ValueError('Invalid format "{:}" (expecting one of: {:})'.format(fmt, ", ".join(FORMATS)))
+
+    trials = load_trials(trials_file)
+    if trial_ids is not None:
+        trials = [t for t in trials if int(t['trial_id']) in trial_ids]
+    if rc is not None:
+        trials = [t for t in trials if str(t.get('rc')) == rc]
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    exported = []
+    skipped = []
+    errors = []
+    to_export = []
+
+    for trial in trials:
+        traj_fn = trajectory_filename(trials_file, trial)
+        out_fn = output_filename(out_dir, trial, fmt)
+        if not os.path.isfile(traj_fn):
+            errors.append((traj_fn, 'The trajectory file does not exist'))
+        elif not force and is_up_to_date(out_fn, traj_fn):
+            skipped.append(out_fn)
+        else:
+            to_export.append((traj_fn, out_fn))
+
+    if len(to_export) == 0:
+        return exported, skipped, errors
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_export_trial, traj_fn, out_fn, render_args): (traj_fn, out_fn) for traj_fn, out_fn in to_export}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            traj_fn, out_fn = futures[future]
+            error = future.result()
+            if error is None:
+                exported.append(out_fn)
+            else:
+                errors.append((traj_fn, error))
+            if progress is not None:
+                progress(n_done, len(to_export))
+
+    return sorted(exported), skipped, errors
+
+
+#-------------------------------------------------------------------------------------
+def _export_trial(traj_fn, out_fn, render_args):
+    """
+    Export one trial (this runs in a worker process). The output is written to a temporary file that is then
+    renamed, so an interrupted export never leaves a file that seems up to date.
+
+    :return: None, or an error message
+    """
+    base, ext = os.path.splitext(out_fn)
+    tmp_fn = base + '.tmp' + ext
+
+    try:
+        if ext == '.png':
+            trajvideo.save_trajectory_image(traj_fn, tmp_fn, **render_args)
+        else:
+            x, y, pressure, time = trajvideo.load_trajectory_file(traj_fn)
+            n_frames = trajvideo.render_trajectory_animation(x, y, pressure, time, tmp_fn, **render_args)
+            check_animation_duration(n_frames, time, render_args.get('fps', 30), render_args.get('speed', 1.0))
+        os.replace(tmp_fn, out_fn)
+        return None
+
+    except Exception as e:
+        if os.path.isfile(tmp_fn):
+            os.remove(tmp_fn)
+        return '{:}: {:}'.format(type(e).__name__, e)
+
+
+#-------------------------------------------------------------------------------------
+def check_animation_duration(n_frames, time, fps, speed):
+    """
+    Check that an animation covers the trajectory's recorded duration (at the given speed)
+
+    :param n_frames: The number of frames in the animation
+    :param time: The trajectory's times (ms)
+    """
+    if len(time) == 0:
+        return
+
+    recorded_ms = max(time) - time[0]
+    animation_ms = n_frames * 1000 / fps
+
+    #-- The last frame is shown at the end of the trajectory, so the animation may exceed it by up to one frame
+    if animation_ms < recorded_ms / speed:
+        raise ValueError('The animation ({:} frames, {:.1f} s) is shorter than the trajectory ({:.1f} s at {:g}x speed)'
+                         .format(n_frames, animation_ms / 1000, recorded_ms / 1000 / speed, speed))
+
+
+#-------------------------------------------------------------------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python batch_export.py',
+                                     description='Export animations or images of all trials in a session. Trials whose '
+                                                 'output is newer than their trajectory file are skipped.')
+    parser.add_argument('trials_file', help='The trials.csv file (the trajectory files must be in the same directory)')
+    parser.add_argument('out_dir', help='The output directory')
+    parser.add_argument('--format', choices=FORMATS, default='gif', help='gif/mp4 animations, or png images (default: gif)')
+    parser.add_argument('--trials', help='Export only these trial IDs, e.g. "1-10,15"')
+    parser.add_argument('--rc', help='Export only trials with this return code, e.g. OK')
+    parser.add_argument('--workers', type=int, default=None, help='No. of worker processes (default: no. of CPUs)')
+    parser.add_argument('--fps', type=int, default=30, help='Frames per second of animations (default: 30)')
+    parser.add_argument('--speed', type=float, default=1.0, help='Animation speed relative to the writing speed (default: 1)')
+    parser.add_argument('--size', default=None, help='Output size in pixels, e.g. 640x480')
+    parser.add_argument('--force', action='store_true', help='Export all trials, even those whose output is up to date')
+    args = parser.parse_args(argv)
+
+    render_args = {}
+    if args.format != 'png':
+        render_args.update(fps=args.fps, speed=args.speed)
+    if args.size is not None:
+        try:
+            width, height = args.size.lower().split('x')
+            render_args['size'] = int(width), int(height)
+        except ValueError:
+            parser.error('Invalid size "{:}" (expecting WIDTHxHEIGHT)'.format(args.size))
+
+    try:
+        trial_ids = None if args.trials is None else parse_trial_ids(args.trials)
+        exported, skipped, errors = export_session(args.trials_file, args.out_dir, fmt=args.format, trial_ids=trial_ids,
+                                                   rc=args.rc, n_workers=args.workers, force=args.force,
+                                                   progress=lambda n, total: print('{:}/{:} trials exported'.format(n, total)),
+                                                   **render_args)
+    except (IOError, ValueError) as e:
+        print('Error: {:}'.format(e))
+        return 1
+
+    print('Exported {:} trials, skipped {:} up-to-date trials'.format(len(exported), len(skipped)))
+    for traj_fn, error in errors:
+        print('ERROR in {:}: {:}'.format(traj_fn, error))
+
+    return 1 if len(errors) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
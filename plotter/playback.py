@@ -0,0 +1,230 @@
+"""
+Real-time playback of a trajectory in a matplotlib figure.
+
+Wall-clock time is mapped to the recorded time (at a chosen speed), so a trajectory plays exactly as long as it
+took to write it (at 1x). Each frame draws only the points written since the previous frame: the points drawn so
+far are kept in the blitting background, so the cost of a frame does not grow with the trajectory's length.
+"""
+import time as _time
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+MIN_SPEED = 0.25
+MAX_SPEED = 8.0
+
+
+#-------------------------------------------------------------------------------------
+class TrajectoryPlayer(object):
+    """
+    Play a trajectory in a matplotlib axes.
+
+    Keyboard controls (in the figure window): space = pause/resume, +/- = double/halve the speed,
+    r = restart
+    """
+
+    def __init__(self, x, y, pressure, time, speed=1.0, ax=None, interval=15, margin=100, on_finished=None,
+                 clock=_time.perf_counter):
+        """
+        :param x: The x coordinate per point
+        :param y: The y coordinate per point
+        :param pressure: The pen pressure per point. Only points with non-zero pressure are drawn.
+        :param time: The time (ms) per point. The recorder's trajectory files save the time in seconds -
+                     convert it with trajvideo.recorder_time_to_ms().
+        :param speed: Playback speed, relative to the real writing speed (between MIN_SPEED and MAX_SPEED)
+        :param ax: The axes to play in (default: a new figure)
+        :param interval: Time (ms) between frames
+        :param margin: Margin (in trajectory units) around the trajectory
+        :param on_finished: A function called when the playback ends
+        :param clock: A function that returns the wall-clock time in seconds
+        """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        time = np.asarray(time, dtype=float)
+        ink = np.asarray(pressure, dtype=float) != 0
+
+        #-- The ink points, and their recorded times (in ms since the trajectory started)
+        self._x = np.ascontiguousarray(x[ink])
+        self._y = np.ascontiguousarray(y[ink])
+        if len(time) > 0:
+            time = np.maximum.accumulate(time)
+            self._t = time[ink] - time[0]
+            self.duration = time[-1] - time[0]
+        else:
+            self._t = np.zeros(0)
+            self.duration = 0
+
+        self._clock = clock
+        self._on_finished = on_finished
+        self._speed = _validate_speed(speed)
+
+        if ax is None:
+            fig, ax = plt.subplots()
+        self.ax = ax
+        self.fig = ax.figure
+        self._set_limits(x, y, margin)
+
+        #-- Both lines are drawn only by the player (animated=True), not by the figure's regular drawing
+        self._drawn_line, = ax.plot([], [], 'o', markersize=1, color='C0', animated=True)
+        self._new_line, = ax.plot([], [], 'o', markersize=1, color='C0', animated=True)
+
+        self._n_drawn = 0
+        self._background = None
+        self._start_clock = None
+        self._start_time = 0.0
+        self._paused = True
+
+        self._timer = self.fig.canvas.new_timer(interval=interval)
+        self._timer.add_callback(self._on_timer)
+
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self.fig.canvas.mpl_connect('key_press_event', self._on_key)
+        self._update_title()
+
+
+    #-----------------------------------------------------------------
+    @property
+    def speed(self):
+        return self._speed
+
+
+    @property
+    def current_time(self):
+        """ The recorded time (ms since the trajectory started) that is currently shown """
+        if self._paused:
+            return self._start_time
+        return min(self._start_time + (self._clock() - self._start_clock) * 1000 * self._speed, self.duration)
+
+
+    @property
+    def n_drawn(self):
+        """ The number of points drawn so far """
+        return self._n_drawn
+
+
+    @property
+    def finished(self):
+        return self._n_drawn == len(self._x) and self.current_time >= self.duration
+
+
+    #-----------------------------------------------------------------
+    def play(self):
+        if not self._paused:
+            return
+        if self._start_time >= self.duration and self._n_drawn == len(self._x):
+            #-- Play again from the start
+            self._restart_state()
+            self.fig.canvas.draw_idle()
+        self._start_clock = self._clock()
+        self._paused = False
+        self._timer.start()
+
+
+    def pause(self):
+        if self._paused:
+            return
+        self._start_time = self.current_time
+        self._paused = True
+        self._timer.stop()
+
+
+    def restart(self):
+        paused = self._paused
+        self.pause()
+        self._restart_state()
+        self.fig.canvas.draw_idle()
+        if not paused:
+            self.play()
+
+
+    def set_speed(self, speed):
+        """ Change the playback speed. The playback continues from the current point. """
+        speed = _validate_speed(speed)
+        if not self._paused:
+            self._start_time = self.current_time
+            self._start_clock = self._clock()
+        self._speed = speed
+        self._update_title()
+        self.fig.canvas.draw_idle()
+
+
+    #-----------------------------------------------------------------
+    def update(self):
+        """ Draw the points up to the current time (this is called by the timer) """
+
+        n = int(np.searchsorted(self._t, self.current_time, side='right'))
+
+        if n > self._n_drawn:
+            start = self._n_drawn
+            self._n_drawn = n
+
+            if self._background is None or not self.fig.canvas.supports_blit:
+                self.fig.canvas.draw_idle()
+            else:
+                #-- Only the new points are drawn, on top of the background (which has all previous points)
+                canvas = self.fig.canvas
+                canvas.restore_region(self._background)
+                self._new_line.set_data(self._x[start:n], self._y[start:n])
+                self.ax.draw_artist(self._new_line)
+                canvas.blit(self.ax.bbox)
+                self._background = canvas.copy_from_bbox(self.ax.bbox)
+
+        if self.finished:
+            self.pause()
+            self._start_time = self.duration
+            if self._on_finished is not None:
+                self._on_finished()
+
+
+    #-----------------------------------------------------------------
+    def _on_timer(self):
+        if not self._paused:
+            self.update()
+
+
+    def _on_draw(self, event):
+        """ After the figure was redrawn (e.g. resized): draw all points so far, and save this as the background """
+        self._drawn_line.set_data(self._x[:self._n_drawn], self._y[:self._n_drawn])
+        self.ax.draw_artist(self._drawn_line)
+        self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        if not self.fig.canvas.supports_blit:
+            self._background = None
+
+
+    def _on_key(self, event):
+        if event.key == ' ':
+            if self._paused:
+                self.play()
+            else:
+                self.pause()
+        elif event.key in ('+', '='):
+            self.set_speed(min(self._speed * 2, MAX_SPEED))
+        elif event.key == '-':
+            self.set_speed(max(self._speed / 2, MIN_SPEED))
+        elif event.key == 'r':
+            self.restart()
+
+
+    def _restart_state(self):
+        self._n_drawn = 0
+        self._start_time = 0.0
+        #-- The background has the drawn points; it's recreated (empty) when the figure is redrawn
+        self._background = None
+
+
+    def _set_limits(self, x, y, margin):
+        if len(x) == 0:
+            return
+        self.ax.set(xlim=(x.min() - margin, x.max() + margin), ylim=(max(0, y.min() - margin), y.max() + margin))
+
+
+    def _update_title(self):
+        self.ax.set_title('Speed: {:g}x  (space = pause, +/- = speed, r = restart)'.format(self._speed), fontsize=8)
+
+
+#-------------------------------------------------------------------------------------
+def _validate_speed(speed):
+    if not MIN_SPEED <= speed <= MAX_SPEED:
+        raise ValueError('Invalid playback speed ({:}): expecting a value between {:} and {:}'.format(speed, MIN_SPEED, MAX_SPEED))
+    return float(speed)
@@ -2,12 +2,13 @@ from PyQt5.QtWidgets import QMainWindow, QApplication
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5 import uic
-import matplotlib.animation as animation
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import sys
 import os
+import trajvideo
+import playback
 
 global anim  # declaring this global is a must due to garbage collection bug in matplotlib animation
 
@@ -15,19 +16,9 @@ global anim  # declaring this global is a must due to garbage collection bug in
 # Input: Trajectory file path (to read the raw writing from)
 # action: "play" will display the animation immediately. "save" will only convert to gif and save it.
 # filename: when choosing action="save", insert file name as well.
-def animate_trajectory(traj_file, action="play", filename=""):
-    def animation_init():  # only required for blitting to give a clean slate.
-        line.set_ydata([np.nan] * len(x))
-        return line,
-
-    def animate(i):
-        if i < len(raw_points.x):
-            if raw_points.pressure[i] != 0:
-                xdata.append(raw_points.x[i])
-                ydata.append(raw_points.y[i])
-                line.set_data(xdata, ydata)
-        return line,
-
+# fps: frames per second of the saved animation
+# speed: playback speed relative to the writing speed (0.25 - 8). While playing, +/- change the speed.
+def animate_trajectory(traj_file, action="play", filename="", fps=30, speed=1.0):
     fields = ['x', 'y', 'pressure', 'time']
     try:
         raw_points = pd.read_csv(traj_file, usecols=fields)
@@ -35,31 +26,21 @@ def animate_trajectory(traj_file, action="play", filename=""):
         QMessageBox().critical(None, "Warning! file access error",
                                "WriTracker couldn't load the trajectory file.", QMessageBox.Ok)
         return False
-    fig, ax = plt.subplots()
-    xmargin = 100
-    ymargin = 100
-    maxx = raw_points.x.max() + xmargin
-    minx = raw_points.x.min() - xmargin
-    maxy = raw_points.y.max() + ymargin
-    miny = raw_points.y.min() - ymargin
-    x = np.arange(0, max(maxx, maxy), 1)
-    y = np.arange(0, max(maxx, maxy), 1)
-    line, = ax.plot(x, y, 'o', markersize=1)
-    ax.set(xlim=(minx, maxx), ylim=(max(0, miny), maxy))
-    xdata, ydata = [], []
+
+    if action == "save":
+        print("WriTracker Plotter: Saving GIF, please wait")
+        # The frames are rendered directly (not via FuncAnimation), so the whole trajectory is saved, at writing speed
+        trajvideo.render_trajectory_animation(raw_points.x.values, raw_points.y.values, raw_points.pressure.values,
+                                              trajvideo.recorder_time_to_ms(raw_points.time.values), filename + ".gif", fps=fps)
+        return True
 
     if action == "play":
-        # When using plt.show, 'interval' controls the speed of the animation
-        anim = animation.FuncAnimation(fig, animate, init_func=animation_init, interval=10, blit=True)
+        # The player follows the recorded times, so the trajectory plays as fast as it was written (times speed)
+        anim = playback.TrajectoryPlayer(raw_points.x.values, raw_points.y.values, raw_points.pressure.values,
+                                         trajvideo.recorder_time_to_ms(raw_points.time.values), speed=speed)
+        anim.play()
         plt.show()    # to display "live" the animation
         return anim   # required when calling from inside a function
-    elif action == "save":
-        print("WriTracker Plotter: Saving GIF, please wait")
-        f = filename+".gif"
-        # save_count > 1000 might cause memory error.
-        ani = animation.FuncAnimation(fig, animate, init_func=animation_init, blit=True, save_count=1000)
-        writergif = animation.PillowWriter(fps=40)  # fps > 60  | fps < 15 caused very very slow output. 30-40 fits.
-        ani.save(f, writer=writergif)
 
     # -----------------------------------------------------------------------------------------------------------------
     # -----------------------------------------------     GUI setup     -----------------------------------------------
@@ -114,8 +95,8 @@ class MainWindow(QMainWindow):
             return False
         traj_file_path = self.combox_trials.currentData()
         anim_file_path = self.destination_folder+os.sep+filename
-        response = QMessageBox.question(self, "Notice", "Conversion is slow and might take up to a minute.\n"
-                                        "Please be patient. a message will appear when finished",
+        response = QMessageBox.question(self, "Notice", "Conversion might take a few seconds.\n"
+                                        "A message will appear when finished",
                                         QMessageBox.Ok | QMessageBox.Cancel)
         if response == QMessageBox.Ok:
             try:
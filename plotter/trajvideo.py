@@ -0,0 +1,351 @@
+"""
+Render a trajectory as an animation (GIF, or MP4 if ffmpeg is installed), without matplotlib.
+
+The ink is rasterized incrementally into a NumPy frame buffer: each frame adds only the points written since the
+previous frame. Frames are sampled by time - frame #k shows the points written until k/fps seconds after the first
+point - so the animation plays at the real writing speed (or at a given multiple of it), and trajectories of any
+length can be rendered.
+
+GIF frames are encoded and written one by one, and only the region that changed is saved per frame, so memory use
+does not depend on the trajectory's length.
+"""
+import os
+import shutil
+import subprocess
+import numpy as np
+import pandas as pd
+from PIL import Image, GifImagePlugin
+
+
+BACKGROUND_COLOR = (255, 255, 255)
+INK_COLOR = (0, 0, 0)
+
+#-- GIF viewers don't respect shorter frame delays (20 ms)
+MAX_GIF_FPS = 50
+
+#-- The recorder saves the 'time' column in seconds; the rendering functions get times in ms
+RECORDER_TIME_UNIT_MS = 1000
+
+
+#-------------------------------------------------------------------------------------
+def load_trajectory_file(traj_file):
+    """
+    Load a trajectory file saved by the recorder (a CSV file with x, y, pressure and time columns)
+
+    :return: (x, y, pressure, time) arrays. The time is converted from seconds to ms.
+    """
+    points = pd.read_csv(traj_file, usecols=['x', 'y', 'pressure', 'time'], skipinitialspace=True)
+    return points.x.values, points.y.values, points.pressure.values, recorder_time_to_ms(points.time.values)
+
+
+def recorder_time_to_ms(time):
+    """ Convert times from a recorder's trajectory file (seconds) to ms """
+    return np.asarray(time, dtype=float) * RECORDER_TIME_UNIT_MS
+
+
+#-------------------------------------------------------------------------------------
+def save_trajectory_animation(traj_file, out_filename, **kwargs):
+    """
+    Render a recorder's trajectory file (see load_trajectory_file) as an animation.
+
+    :param out_filename: The animation file. Its extension (.gif or .mp4) determines the format.
+    :param kwargs: Rendering options - see render_trajectory_animation()
+    :return: The number of frames
+    """
+    x, y, pressure, time = load_trajectory_file(traj_file)
+    return render_trajectory_animation(x, y, pressure, time, out_filename, **kwargs)
+
+
+#-------------------------------------------------------------------------------------
+def render_trajectory_animation(x, y, pressure, time, out_filename, fps=30, size=(640, 480), speed=1.0, dot_radius=1,
+                                margin=100, hold_end_ms=1000):
+    """
+    Render a trajectory as an animation.
+
+    :param x: The x coordinate per point
+    :param y: The y coordinate per point
+    :param pressure: The pen pressure per point. Only points with non-zero pressure are drawn.
+    :param time: The time (ms) per point
+    :param out_filename: The animation file. Its extension (.gif or .mp4) determines the format.
+    :param fps: Frames per second (at most MAX_GIF_FPS for GIF files)
+    :param size: (width, height) of the animation, in pixels
+    :param speed: Playback speed, relative to the real writing speed
+    :param dot_radius: The radius (in pixels) of each drawn point
+    :param margin: Margin (in trajectory units) around the trajectory
+    :param hold_end_ms: How long the last frame is shown
+    :return: The number of frames
+    """
+
+    fmt = os.path.splitext(out_filename)[1].lower()
+    if fmt not in ('.gif', '.mp4'):
+        raise ValueError('Unsupported animation format "{:}" (expecting .gif or .mp4)'.format(fmt))
+    if fps <= 0 or speed <= 0:
+        raise ValueError('Invalid fps ({:}) or speed ({:}): expecting positive values'.format(fps, speed))
+    if fmt == '.gif' and fps > MAX_GIF_FPS:
+        raise ValueError('GIF animations cannot exceed {:} frames per second'.format(MAX_GIF_FPS))
+
+    width, height = size
+    if fmt == '.mp4':
+        #-- The video encoder needs even dimensions
+        width, height = width + width % 2, height + height % 2
+
+    frames = TrajectoryFrames(x, y, pressure, time, fps=fps, size=(width, height), speed=speed, dot_radius=dot_radius, margin=margin)
+
+    if fmt == '.gif':
+        writer = _GifWriter(out_filename, (width, height), fps)
+    else:
+        writer = _FfmpegWriter(out_filename, (width, height), fps)
+
+    try:
+        n_frames = 0
+        for canvas, changed_box in frames:
+            writer.add_frame(canvas, changed_box)
+            n_frames += 1
+        writer.hold(hold_end_ms)
+    finally:
+        writer.close()
+
+    return n_frames
+
+
+#-------------------------------------------------------------------------------------
+def save_trajectory_image(traj_file, out_filename, **kwargs):
+    """
+    Save a static image (e.g. PNG) of the whole trajectory in a trajectory file.
+
+    :param kwargs: Rendering options - see render_trajectory_image()
+    """
+    points = pd.read_csv(traj_file, usecols=['x', 'y', 'pressure'], skipinitialspace=True)
+    render_trajectory_image(points.x.values, points.y.values, points.pressure.values, out_filename, **kwargs)
+
+
+#-------------------------------------------------------------------------------------
+def render_trajectory_image(x, y, pressure, out_filename, size=(320, 240), dot_radius=1, margin=100):
+    """
+    Save a static image of a whole trajectory, drawn as in the animations. The format is determined by the
+    file's extension.
+    """
+    frames = TrajectoryFrames(x, y, pressure, np.zeros(len(x)), size=size, dot_radius=dot_radius, margin=margin)
+    canvas, _ = next(iter(frames))
+    colors = np.array([BACKGROUND_COLOR, INK_COLOR], dtype=np.uint8)
+    Image.fromarray(colors[canvas]).save(out_filename)
+
+
+#-------------------------------------------------------------------------------------
+class TrajectoryFrames(object):
+    """
+    Iterate over the frames of a trajectory animation. Each frame is a (canvas, changed_box) tuple:
+
+    - canvas: The frame buffer, a (height, width) uint8 array: 0 for background, 1 for ink. The same array is
+              returned for all frames (it's updated in place).
+    - changed_box: (left, top, right, bottom) of the region that changed since the previous frame, or None if
+                   nothing changed. For the first frame, this is the whole frame.
+    """
+
+    def __init__(self, x, y, pressure, time, fps=30, size=(640, 480), speed=1.0, dot_radius=1, margin=100):
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        pressure = np.asarray(pressure, dtype=float)
+        time = np.asarray(time, dtype=float)
+
+        self.width, self.height = size
+
+        #-- Times must not decrease (the recorder's timestamps are monotonic; this protects against glitches)
+        time = np.maximum.accumulate(time) if len(time) > 0 else time
+
+        ink = pressure != 0
+        self._px, self._py = self._to_pixels(x, y, ink, margin)
+        self._stamp_dx, self._stamp_dy = _disk_offsets(dot_radius)
+
+        #-- Frame #k shows the ink points written until frame_times[k]
+        if len(time) > 0:
+            frame_interval = 1000 / fps * speed
+            n_frames = int(np.floor((time[-1] - time[0]) / frame_interval)) + 1
+            frame_times = time[0] + np.arange(n_frames) * frame_interval
+            self._n_points_per_frame = np.searchsorted(time[ink], frame_times, side='right')
+            self._n_points_per_frame[-1] = len(self._px)
+        else:
+            self._n_points_per_frame = np.zeros(1, dtype=int)
+
+        self.canvas = np.zeros((self.height, self.width), dtype=np.uint8)
+
+
+    def __len__(self):
+        return len(self._n_points_per_frame)
+
+
+    def __iter__(self):
+
+        self.canvas[:] = 0
+        n_drawn = 0
+
+        for frame_ind, n_points in enumerate(self._n_points_per_frame):
+            changed_box = self._draw(n_drawn, n_points)
+            n_drawn = n_points
+            if frame_ind == 0:
+                changed_box = (0, 0, self.width, self.height)
+            yield self.canvas, changed_box
+
+
+    def _to_pixels(self, x, y, ink, margin):
+        """
+        Convert the coordinates of the ink points to pixels. The y axis points upwards, and the aspect ratio is kept.
+        """
+        x = x[ink]
+        y = y[ink]
+        if len(x) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        min_x, max_x = x.min() - margin, x.max() + margin
+        min_y, max_y = max(0, y.min() - margin), y.max() + margin
+
+        scale = min(self.width / max(max_x - min_x, 1), self.height / max(max_y - min_y, 1))
+        offset_x = (self.width - (max_x - min_x) * scale) / 2
+        offset_y = (self.height - (max_y - min_y) * scale) / 2
+
+        px = np.floor((x - min_x) * scale + offset_x).astype(int)
+        py = np.floor(self.height - 1 - ((y - min_y) * scale + offset_y)).astype(int)
+        return px, py
+
+
+    def _draw(self, start, end):
+        """ Draw ink points #start to #end-1, and return the box that contains them (None if there are none) """
+        if end <= start:
+            return None
+
+        cols = (self._px[start:end, np.newaxis] + self._stamp_dx).ravel()
+        rows = (self._py[start:end, np.newaxis] + self._stamp_dy).ravel()
+        inside = (cols >= 0) & (cols < self.width) & (rows >= 0) & (rows < self.height)
+        if not np.any(inside):
+            return None
+
+        cols = cols[inside]
+        rows = rows[inside]
+        self.canvas[rows, cols] = 1
+
+        return int(cols.min()), int(rows.min()), int(cols.max()) + 1, int(rows.max()) + 1
+
+
+#-------------------------------------------------------------------------------------
+def _disk_offsets(radius):
+    """ The (dx, dy) offsets of all pixels in a disk of the given radius """
+    r = max(0, int(radius))
+    dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+    in_disk = dx ** 2 + dy ** 2 <= r * (r + 1)
+    return dx[in_disk], dy[in_disk]
+
+
+#-------------------------------------------------------------------------------------
+class _GifWriter(object):
+    """
+    Write an animated GIF frame by frame. Each frame saves only the region that changed, on top of the previous
+    frame; a frame that did not change extends the previous frame's duration.
+    """
+
+    def __init__(self, filename, size, fps):
+        self._fp = open(filename, 'wb')
+        self._fps = fps
+        self._n_frames = 0
+        self._pending = None   # (image, offset, duration in 1/100 sec) of the last frame, not written yet
+
+        width, height = size
+        palette = bytearray(256 * 3)
+        palette[0:3] = bytes(BACKGROUND_COLOR)
+        palette[3:6] = bytes(INK_COLOR)
+
+        self._fp.write(b'GIF89a' + _o16(width) + _o16(height) + bytes([0xF7, 0, 0]) + bytes(palette))
+        #-- Loop forever
+        self._fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + _o16(0) + b'\x00')
+
+
+    def add_frame(self, canvas, changed_box):
+        duration = self._frame_duration(self._n_frames)
+        self._n_frames += 1
+
+        if changed_box is None:
+            if self._pending is not None:
+                self._pending[2] += duration
+            return
+
+        self._flush()
+        left, top, right, bottom = changed_box
+        image = Image.fromarray(np.ascontiguousarray(canvas[top:bottom, left:right]))
+        self._pending = [image, (left, top), duration]
+
+
+    def hold(self, duration_ms):
+        if self._pending is not None:
+            self._pending[2] += int(round(duration_ms / 10))
+
+
+    def close(self):
+        if self._fp is None:
+            return
+        self._flush()
+        self._fp.write(b';')
+        self._fp.close()
+        self._fp = None
+
+
+    def _frame_duration(self, frame_ind):
+        """ The duration of a frame, in 1/100 sec (rounded so the total duration doesn't drift) """
+        return int(round((frame_ind + 1) * 100 / self._fps)) - int(round(frame_ind * 100 / self._fps))
+
+
+    def _flush(self):
+        if self._pending is None:
+            return
+        image, offset, duration = self._pending
+        #-- disposal=1: the next frame is drawn on top of this one
+        for chunk in GifImagePlugin.getdata(image, offset=offset, duration=max(duration, 1) * 10, disposal=1):
+            self._fp.write(chunk)
+        self._pending = None
+
+
+def _o16(value):
+    return int(value).to_bytes(2, 'little')
+
+
+#-------------------------------------------------------------------------------------
+class _FfmpegWriter(object):
+    """
+    Write an MP4 video by piping raw frames to ffmpeg
+    """
+
+    def __init__(self, filename, size, fps):
+        ffmpeg = shutil.which('ffmpeg')
+        if ffmpeg is None:
+            raise ValueError('Saving MP4 animations requires ffmpeg, which was not found')
+
+        width, height = size
+        self._fps = fps
+        self._last_frame = None
+        self._colors = np.array([BACKGROUND_COLOR, INK_COLOR], dtype=np.uint8)
+        self._process = subprocess.Popen([ffmpeg, '-y', '-loglevel', 'error',
+                                          '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{:}x{:}'.format(width, height),
+                                          '-r', str(fps), '-i', '-',
+                                          '-c:v', 'libx264', '-pix_fmt', 'yuv420p', filename],
+                                         stdin=subprocess.PIPE)
+
+
+    def add_frame(self, canvas, changed_box):
+        if changed_box is not None or self._last_frame is None:
+            self._last_frame = self._colors[canvas].tobytes()
+        self._process.stdin.write(self._last_frame)
+
+
+    def hold(self, duration_ms):
+        if self._last_frame is not None:
+            for _ in range(int(round(duration_ms / 1000 * self._fps))):
+                self._process.stdin.write(self._last_frame)
+
+
+    def close(self):
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        rc = self._process.wait()
+        self._process = None
+        if rc != 0:
+            raise ValueError('ffmpeg failed to save the animation (exit code {:})'.format(rc))
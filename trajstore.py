@@ -0,0 +1,322 @@
+"""
+A binary store of all trajectories of one session, kept alongside the CSV files.
+
+The CSV files remain the interchange format; the store is an additional copy that loads much faster. It consists
+of 2 files in the session directory:
+
+- trajectories.npy: the points of all trials, as one structured numpy array (see POINT_DTYPE)
+- trajectories_index.npy: the (trial_id, sub_trial_num) of each trial, the range of its points, and the fingerprint
+  (size, modification time) of the CSV file it was copied from
+
+Opening the store memory-maps the points file, so accessing a trial's points neither reads nor copies the other
+trials. Saving a trial appends its points to the points file and updates the index. When a trial is saved again,
+its old points remain in the file, unused, until the store is rebuilt with compact().
+
+The CSV files can change after the store was saved (e.g. a trial that was coded again). A trial whose CSV file no
+longer matches the fingerprint in the index is treated as not being in the store, so it is loaded from the CSV file.
+"""
+import io
+import os
+from collections import namedtuple
+import numpy as np
+import data
+
+
+POINT_DTYPE = np.dtype([('x', '<f8'), ('y', '<f8'), ('pressure', '<f8'), ('time', '<f8'),
+                        ('stroke', '<i4'), ('char_num', '<i4'), ('pen_down', 'i1'), ('correction', 'i1')])
+
+INDEX_DTYPE = np.dtype([('trial_id', '<i8'), ('sub_trial_num', '<i8'), ('start', '<i8'), ('end', '<i8'),
+                        ('source', '<U255'), ('source_size', '<i8'), ('source_mtime_ns', '<i8')])
+
+POINTS_FILENAME = 'trajectories.npy'
+INDEX_FILENAME = 'trajectories_index.npy'
+
+
+#-------------------------------------------------------------------------------------
+def exists(dir_name):
+    return os.path.isfile(os.path.join(dir_name, POINTS_FILENAME)) and os.path.isfile(os.path.join(dir_name, INDEX_FILENAME))
+
+
+#-------------------------------------------------------------------------------------
+def create_points(x, y, pressure, time, stroke=0, char_num=0, pen_down=0, correction=0):
+    """
+    Create an array of trajectory points in the store's format. Each argument is an array or a single value.
+    """
+    x = np.asarray(x)
+    points = np.zeros(len(x), dtype=POINT_DTYPE)
+    points['x'] = x
+    points['y'] = y
+    points['pressure'] = pressure
+    points['time'] = time
+    points['stroke'] = stroke
+    points['char_num'] = char_num
+    points['pen_down'] = pen_down
+    points['correction'] = correction
+    return points
+
+
+#-------------------------------------------------------------------------------------
+def source_fingerprint(filename):
+    """
+    The (size, modification time in ns) of a trial's source CSV file, or None if the file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+#-------------------------------------------------------------------------------------
+class TrajectoryStore(object):
+    """
+    Read access to a session's binary trajectory store
+    """
+
+    def __init__(self, dir_name):
+        self.dir_name = dir_name
+        self._points = _load_points(os.path.join(dir_name, POINTS_FILENAME), mmap_mode='r')
+        self._entries = _load_index(os.path.join(dir_name, INDEX_FILENAME))
+
+    def keys(self):
+        """ The (trial_id, sub_trial_num) of all trials in the store, including trials whose CSV file has changed """
+        return sorted(self._entries.keys())
+
+    def is_fresh(self, trial_id, sub_trial_num=1):
+        """
+        Whether the trial's CSV file is unchanged since the trial was saved in the store. A trial saved without a
+        source CSV file is never fresh.
+        """
+        entry = self._entries.get((trial_id, sub_trial_num))
+        if entry is None or entry.source == '':
+            return False
+        return source_fingerprint(os.path.join(self.dir_name, entry.source)) == (entry.source_size, entry.source_mtime_ns)
+
+    def __contains__(self, trial_key):
+        """ Whether the trial is in the store and its CSV file did not change since """
+        return self.is_fresh(*trial_key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def points(self, trial_id, sub_trial_num=1):
+        """
+        Get one trial's points: a read-only structured array (see POINT_DTYPE) that shares the store's memory.
+        A trial whose CSV file changed since it was saved in the store is considered missing (KeyError).
+        """
+        if not self.is_fresh(trial_id, sub_trial_num):
+            raise KeyError('Trial #{:}, sub-trial #{:} is not in the trajectory store in {:}, or its CSV file has changed'
+                           .format(trial_id, sub_trial_num, self.dir_name))
+        return self._stored_points((trial_id, sub_trial_num))
+
+    def _stored_points(self, trial_key):
+        entry = self._entries[trial_key]
+        return self._points[entry.start:entry.end]
+
+    def columns(self, trial_id, sub_trial_num=1):
+        """
+        Get one trial's points as a dict with an array per column (like dataio.read_csv_columns)
+        """
+        points = self.points(trial_id, sub_trial_num)
+        return {name: points[name] for name in POINT_DTYPE.names}
+
+    def trajectory(self, trial_id, sub_trial_num=1):
+        """
+        Get one trial's points as a data.Trajectory, split into strokes according to the 'stroke' column.
+        The trajectory's arrays share the store's memory.
+        """
+        points = self.points(trial_id, sub_trial_num)
+        stroke_nums = points['stroke']
+        stroke_starts = np.flatnonzero(stroke_nums[1:] != stroke_nums[:-1]) + 1
+        stroke_offsets = np.concatenate([[0], stroke_starts, [len(points)]]) if len(points) > 0 else None
+        return data.Trajectory(points['x'], points['y'], points['pressure'], points['time'], stroke_offsets=stroke_offsets)
+
+
+#-------------------------------------------------------------------------------------
+def save_trial(dir_name, trial_id, sub_trial_num, points, source_filename):
+    """
+    Add a trial to the session's store, or replace the trial if it's already there
+
+    :param points: An array created by create_points()
+    :param source_filename: The trial's CSV file, which has the same points. Save the store after saving this file:
+                            its current fingerprint is saved in the store.
+    """
+    save_trials(dir_name, [(trial_id, sub_trial_num, points, source_filename)])
+
+
+#-------------------------------------------------------------------------------------
+def save_trials(dir_name, trials):
+    """
+    Add several trials to the session's store (or replace them)
+
+    :param trials: A list of (trial_id, sub_trial_num, points, source_filename) tuples (see save_trial)
+    """
+
+    points_fn = os.path.join(dir_name, POINTS_FILENAME)
+    index_fn = os.path.join(dir_name, INDEX_FILENAME)
+
+    entries = _load_index(index_fn) if os.path.isfile(index_fn) and os.path.isfile(points_fn) else {}
+
+    all_points = [np.asarray(points, dtype=POINT_DTYPE) for trial_id, sub_trial_num, points, source_filename in trials]
+    start = _append_points(points_fn, np.concatenate(all_points) if len(all_points) > 0 else np.zeros(0, dtype=POINT_DTYPE),
+                           truncate=len(entries) == 0)
+
+    for (trial_id, sub_trial_num, _, source_filename), points in zip(trials, all_points):
+        entries[(trial_id, sub_trial_num)] = _new_entry(dir_name, start, start + len(points), source_filename)
+        start += len(points)
+
+    #-- The index is written after the points, so a failure leaves the store consistent (with some unused points)
+    _save_index(index_fn, entries)
+
+
+#-------------------------------------------------------------------------------------
+def create(dir_name, trials):
+    """
+    Create the session's store from scratch (an existing store is overwritten)
+
+    :param trials: A list of (trial_id, sub_trial_num, points, source_filename) tuples (see save_trial)
+    """
+    _create(dir_name, [(trial_id, sub_trial_num, points, _new_entry(dir_name, 0, 0, source_filename))
+                       for trial_id, sub_trial_num, points, source_filename in trials])
+
+
+#-------------------------------------------------------------------------------------
+def _create(dir_name, trials):
+    """
+    :param trials: A list of (trial_id, sub_trial_num, points, index_entry) tuples. The entries' point ranges are ignored.
+    """
+
+    all_points = [np.asarray(points, dtype=POINT_DTYPE) for trial_id, sub_trial_num, points, entry in trials]
+    _save_points(os.path.join(dir_name, POINTS_FILENAME), np.concatenate(all_points) if len(all_points) > 0 else np.zeros(0, dtype=POINT_DTYPE))
+
+    entries = {}
+    start = 0
+    for (trial_id, sub_trial_num, _, entry), points in zip(trials, all_points):
+        entries[(trial_id, sub_trial_num)] = entry._replace(start=start, end=start + len(points))
+        start += len(points)
+    _save_index(os.path.join(dir_name, INDEX_FILENAME), entries)
+
+
+#-------------------------------------------------------------------------------------
+def compact(dir_name):
+    """
+    Rewrite the store, dropping the points of trials that were saved again later. The trials' source fingerprints
+    are kept as they are.
+    """
+    store = TrajectoryStore(dir_name)
+    trials = [trial_key + (np.array(store._stored_points(trial_key)), store._entries[trial_key]) for trial_key in store.keys()]
+    del store
+
+    _create(dir_name, trials)
+
+
+#-------------------------------------------------------------------------------------
+def _load_points(filename, mmap_mode=None):
+    try:
+        points = np.load(filename, mmap_mode=mmap_mode)
+    except ValueError:
+        #-- An empty array cannot be memory-mapped
+        points = np.load(filename)
+
+    if points.dtype != POINT_DTYPE or points.ndim != 1:
+        raise ValueError('Invalid trajectory store file {:}'.format(filename))
+
+    return points
+
+
+#-------------------------------------------------------------------------------------
+def _append_points(filename, points, truncate=False):
+    """
+    Append points to the points file. Usually, only the file's header is rewritten, not the existing points.
+    Return the index of the first appended point.
+    """
+
+    if truncate or not os.path.isfile(filename):
+        _save_points(filename, points)
+        return 0
+
+    with open(filename, 'rb') as fp:
+        version = np.lib.format.read_magic(fp)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(fp)
+        header_len = fp.tell()
+
+    if dtype != POINT_DTYPE or fortran_order or len(shape) != 1:
+        raise ValueError('Invalid trajectory store file {:}'.format(filename))
+
+    n_existing = shape[0]
+
+    #-- numpy pads the header so that the array can grow without changing the header's length
+    header = _array_header(n_existing + len(points), version)
+
+    if len(header) != header_len:
+        existing = np.load(filename)
+        _save_points(filename, np.concatenate([existing, points]))
+        return n_existing
+
+    with open(filename, 'r+b') as fp:
+        fp.seek(header_len + n_existing * POINT_DTYPE.itemsize)
+        fp.truncate()
+        fp.write(points.tobytes())
+        fp.flush()
+
+        #-- The header is updated last, so a failure while writing the points leaves a valid file
+        fp.seek(0)
+        fp.write(header)
+
+    return n_existing
+
+
+#-------------------------------------------------------------------------------------
+def _array_header(n_points, version):
+    buf = io.BytesIO()
+    header_data = dict(descr=np.lib.format.dtype_to_descr(POINT_DTYPE), fortran_order=False, shape=(n_points, ))
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(buf, header_data)
+    else:
+        np.lib.format.write_array_header_2_0(buf, header_data)
+    return buf.getvalue()
+
+
+#-------------------------------------------------------------------------------------
+def _save_points(filename, points):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fp:
+        np.save(fp, points)
+    os.replace(tmp_filename, filename)
+
+
+#-------------------------------------------------------------------------------------
+_IndexEntry = namedtuple('_IndexEntry', ['start', 'end', 'source', 'source_size', 'source_mtime_ns'])
+
+
+def _new_entry(dir_name, start, end, source_filename):
+    fingerprint = source_fingerprint(source_filename) if source_filename is not None else None
+    if fingerprint is None:
+        return _IndexEntry(start, end, '', -1, -1)
+    return _IndexEntry(start, end, os.path.relpath(source_filename, dir_name), *fingerprint)
+
+
+#-------------------------------------------------------------------------------------
+def _load_index(filename):
+    """
+    Load the index: a dict with an _IndexEntry per (trial_id, sub_trial_num)
+    """
+    index = np.load(filename)
+    if index.dtype != INDEX_DTYPE:
+        raise ValueError('Invalid trajectory store index file {:}'.format(filename))
+    return {(int(e['trial_id']), int(e['sub_trial_num'])):
+                _IndexEntry(int(e['start']), int(e['end']), str(e['source']), int(e['source_size']), int(e['source_mtime_ns']))
+            for e in index}
+
+
+#-------------------------------------------------------------------------------------
+def _save_index(filename, entries):
+    index = np.zeros(len(entries), dtype=INDEX_DTYPE)
+    for i, (trial_key, entry) in enumerate(sorted(entries.items())):
+        index[i] = trial_key + tuple(entry)
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as fp:
+        np.save(fp, index)
+    os.replace(tmp_filename, filename)
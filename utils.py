@@ -31,15 +31,26 @@ def split_list_at(elems, is_bound, is_bound_args=None):
 class ProgressBar(object):
 
     def __init__(self, total, prefix='', suffix='', start_now=True):
+        """
+        :param total: The total number of items. If None, it must be provided in the first call to progress()
+        """
         self._prefix = prefix
         self._suffix = suffix
         self._total = total
         self._last_progress = None
-        if start_now:
+        if start_now and total is not None:
             self.progress(0)
 
 
-    def progress(self, n):
+    def progress(self, n, total=None):
+        """
+        :param n: The number of items done so far
+        :param total: If provided, update the total number of items
+        """
+        if total is not None:
+            self._total = total
+        if self._total == 0:
+            return
         progress = round(n / self._total * 1000) / 10
         if progress != self._last_progress:
             self._last_progress = progress
@@ -73,6 +84,31 @@ def print_progress_bar(iteration, total, prefix='Progress: ', suffix='', decimal
         print()
 
 
+#------------------------------------------------------------------------
+_dir_listing_cache = {}
+
+
+def list_dir(dir_name):
+    """
+    Get the names of all entries in a directory (as a frozenset).
+
+    The listing is cached per directory, keyed by the directory's modification time (which changes whenever files
+    are added, removed or renamed), so repeated calls do not scan the directory again.
+    """
+    key = os.path.abspath(dir_name)
+    mtime = os.stat(dir_name).st_mtime_ns
+
+    cached = _dir_listing_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with os.scandir(dir_name) as entries:
+        names = frozenset(entry.name for entry in entries)
+
+    _dir_listing_cache[key] = mtime, names
+    return names
+
+
 #------------------------------------------------------------------------
 def is_windows():
     return os.name == 'nt'
@@ -1,4 +1,4 @@
 from . import recorder_io
+from . import input_source
 from . import recorder
-from . import wintab
 from . import wintab_params
@@ -0,0 +1,186 @@
+from wacom_recorder.wintab_params import PACKET
+import numpy as np
+import pandas as pd
+import time
+import math
+
+
+# -------------------------------------------------------------------------------------------------------------
+# Pen input sources for the recorder.
+# A source delivers pen samples as Wintab-style PACKET structures (pkX, pkY, pkNormalPressure, pkTime,
+# pkSerialNumber), so the recorder processes samples the same way regardless of where they come from:
+#   WintabSource - a real tablet, via wintab32.dll (Windows only)
+#   ReplaySource - recorded trajectory_*.csv files or synthetic handwriting, for headless tests and benchmarks
+MAX_PACKETS = 100           # maximal number of packets returned by one read_packets() call
+PRESSURE_SCALE = 327.67     # raw pressure (0-32767) per unit of the recorder's normalized pressure (0-100)
+
+
+# -------------------------------------------------------------------------------------------------------------
+class InputSource:
+    max_packets = MAX_PACKETS
+
+    # Start delivering packets. window_handle: the native handle of the window that receives the pen input.
+    def open(self, window_handle=None):
+        pass
+
+    # return (n, packets): the number of packets received since the last call, and a PACKET array whose first n
+    # elements are the packets, oldest first. The array may be reused by the next call.
+    def read_packets(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    # return the name of the connected device, or None if no device is connected
+    def get_device_name(self):
+        return None
+
+
+# -------------------------------------------------------------------------------------------------------------
+class WintabSource(InputSource):
+    def __init__(self):
+        from wacom_recorder import wintab    # loads wintab32.dll, so import only when a real tablet is used
+        self.wintab = wintab
+        self.max_packets = wintab.MAX_PACKETS
+
+    def open(self, window_handle=None):
+        self.wintab.hctx = self.wintab.OpenTabletContexts(window_handle)   # context handle for GetPackets()
+
+    def read_packets(self):
+        return self.wintab.GetPackets()
+
+    def close(self):
+        self.wintab.CloseTabletContext(self.wintab.hctx)
+
+    def get_device_name(self):
+        return self.wintab.getTabletInfo()
+
+
+# -------------------------------------------------------------------------------------------------------------
+# Replays pen samples (x, y, pressure 0-100, time in ms).
+# rate_hz: packets per second. If None, packets are delivered according to the samples' recorded times.
+# realtime: if True, packets become available as time passes (as with a real tablet). If False, each
+#           read_packets() returns a full batch, to measure the maximal throughput.
+class ReplaySource(InputSource):
+    def __init__(self, x, y, pressure, time_ms, rate_hz=None, realtime=True):
+        self.x = np.asarray(x, dtype=int)
+        self.y = np.asarray(y, dtype=int)
+        self.raw_pressure = np.round(np.asarray(pressure, dtype=float) * PRESSURE_SCALE).astype(int)
+        if rate_hz is None:
+            self.time_ms = np.asarray(time_ms, dtype=float) - (time_ms[0] if len(time_ms) > 0 else 0)
+        else:
+            self.time_ms = np.arange(len(self.x)) * (1000 / rate_hz)
+        self.realtime = realtime
+        self.n_delivered = 0
+        self.start_time = None
+        self._packets = (PACKET * self.max_packets)()
+
+    # Create a source that replays recorded trajectory files (the recorder's trajectory_*.csv format), one after
+    # the other. The files' time column is in seconds.
+    @classmethod
+    def from_trajectory_files(cls, filenames, rate_hz=None, realtime=True):
+        x, y, pressure, time_ms = [], [], [], []
+        offset_ms = 0
+        for filename in filenames:
+            df = pd.read_csv(filename, usecols=['x', 'y', 'pressure', 'time'])
+            x.append(df.x.values)
+            y.append(df.y.values)
+            pressure.append(df.pressure.values)
+            t = df.time.values * 1000
+            if len(t) > 0:
+                time_ms.append(t - t[0] + offset_ms)
+                offset_ms = time_ms[-1][-1] + 1000     # 1 second between files
+        if len(x) == 0:
+            return cls([], [], [], [], rate_hz=rate_hz, realtime=realtime)
+        return cls(np.concatenate(x), np.concatenate(y), np.concatenate(pressure), np.concatenate(time_ms),
+                   rate_hz=rate_hz, realtime=realtime)
+
+    # Create a source that replays synthetic handwriting: a row of loop-shaped "characters", each written as one
+    # stroke, with the pen lifted between characters.
+    @classmethod
+    def synthetic(cls, n_chars=10, rate_hz=200, char_duration_s=0.6, gap_duration_s=0.2, realtime=True, seed=0):
+        rnd = np.random.RandomState(seed)
+        n_char_samples = max(2, int(char_duration_s * rate_hz))
+        n_gap_samples = max(1, int(gap_duration_s * rate_hz))
+        phase = np.linspace(0, 2 * math.pi, n_char_samples)
+        x, y, pressure = [], [], []
+        for i in range(n_chars):
+            left = 200 + i * 120
+            width = rnd.uniform(30, 50)
+            height = rnd.uniform(60, 90)
+            char_x = left + width * (1 + np.sin(phase * 2)) + phase * 8
+            char_y = 500 - height * (1 - np.cos(phase)) / 2
+            x.append(char_x)
+            y.append(char_y)
+            pressure.append(40 + 30 * np.sin(phase / 2))
+            #-- Hovering to the next character
+            x.append(np.linspace(char_x[-1], left + 120, n_gap_samples))
+            y.append(np.linspace(char_y[-1], 500, n_gap_samples))
+            pressure.append(np.zeros(n_gap_samples))
+        x = np.concatenate(x)
+        return cls(np.round(x), np.round(np.concatenate(y)), np.concatenate(pressure), None,
+                   rate_hz=rate_hz, realtime=realtime)
+
+    @property
+    def n_samples(self):
+        return len(self.x)
+
+    @property
+    def finished(self):
+        return self.n_delivered >= len(self.x)
+
+    def open(self, window_handle=None):
+        self.n_delivered = 0
+        self.start_time = time.perf_counter()
+
+    def read_packets(self):
+        if self.start_time is None:
+            self.open()
+        first = self.n_delivered
+        if self.realtime:
+            elapsed_ms = (time.perf_counter() - self.start_time) * 1000
+            n_due = int(np.searchsorted(self.time_ms, elapsed_ms, side='right'))
+        else:
+            n_due = len(self.x)
+        n = min(n_due - first, self.max_packets)
+        packets = self._packets
+        for i in range(n):
+            packet = packets[i]
+            packet.pkX = int(self.x[first + i])
+            packet.pkY = int(self.y[first + i])
+            packet.pkNormalPressure = int(self.raw_pressure[first + i])
+            packet.pkTime = int(self.time_ms[first + i]) & 0xFFFFFFFF
+            packet.pkSerialNumber = (first + i) & 0xFFFFFFFF
+        self.n_delivered += n
+        return n, packets
+
+    def get_device_name(self):
+        return "Replay"
+
+
+# -------------------------------------------------------------------------------------------------------------
+# Per-trial packet counters
+# received: packets read from the source. processed: packets handled by the recorder.
+# dropped: packets lost before we could read them (e.g. Wintab queue overflow), detected by gaps in pkSerialNumber.
+class PacketStats:
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.last_serial_number = None
+
+    def reset(self):
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+
+    def packet_received(self, packet):
+        self.received += 1
+        if self.last_serial_number is not None:
+            gap = (packet.pkSerialNumber - self.last_serial_number - 1) & 0xFFFFFFFF
+            if gap < MAX_PACKETS * 1000:   # ignore a serial-number reset (e.g. when the context was re-opened)
+                self.dropped += gap
+        self.last_serial_number = packet.pkSerialNumber
+
+    def __str__(self):
+        return "received={}, processed={}, dropped={}".format(self.received, self.processed, self.dropped)
@@ -5,12 +5,17 @@ from PyQt5 import uic
 from wacom_recorder.recorder_io import Target, Trial, Trajectory
 from datetime import datetime, date
 from pygame import error as pgerr  # handle pygame errors as exceptions
-from wacom_recorder import wintab
+from wacom_recorder.input_source import WintabSource, ReplaySource, PacketStats
 from mutagen.mp3 import MP3        # get mp3 length
 from shutil import copyfile
 from pygame import mixer           # handle sound files
 import pandas as pd
+import numpy as np
+import trajstore
 import subprocess                  # This originally used only to check if WACOM tablet is connected on MAC
+import argparse
+import tempfile
+import time
 import sys
 import csv
 import os
@@ -29,17 +34,68 @@ def _null_converter(v):
 TABLET_POLL_TIME = 5    # defines the polling frequency for tablet packets, in milliseconds
 
 
+# -------------------------------------------------------------------------------------------------------------
+# Draws the live ink on a QGraphicsScene. Each stroke has a single path item, to which new segments are appended.
+# Updating the scene is coalesced: it happens at most once per display refresh, however often samples arrive.
+class InkRenderer:
+    def __init__(self, scene, parent=None):
+        self.scene = scene
+        self.path = None                # the current stroke
+        self.path_item = None           # the current stroke's item in the scene
+        self.dirty = False              # path has segments not yet shown in path_item
+        self.refresh_timer = QTimer(parent)
+        self.refresh_timer.setSingleShot(True)
+        self.refresh_timer.timeout.connect(self.refresh)
+        screen = QGuiApplication.primaryScreen()
+        refresh_rate = screen.refreshRate() if screen is not None and screen.refreshRate() > 0 else 60
+        self.refresh_interval = max(1, int(1000 / refresh_rate))    # ms
+
+    def pen_down(self, x, y):
+        self.refresh()                  # show the end of the previous stroke before starting a new one
+        self.path = QPainterPath()
+        self.path.moveTo(QPointF(x, y))
+        self.path_item = self.scene.addPath(self.path)
+
+    def pen_move(self, x, y):
+        if self.path is None:           # pen was already touching the surface when the recording started
+            self.pen_down(x, y)
+        self.path.lineTo(QPointF(x, y))
+        self.dirty = True
+
+    def schedule_refresh(self):
+        if self.dirty and not self.refresh_timer.isActive():
+            self.refresh_timer.start(self.refresh_interval)
+
+    def refresh(self):
+        if self.dirty:
+            self.path_item.setPath(self.path)
+            self.dirty = False
+
+    def clear(self):
+        self.refresh_timer.stop()
+        self.scene.clear()              # also deletes the path items
+        self.path = None
+        self.path_item = None
+        self.dirty = False
+
+
 # -------------------------------------------------------------------------------------------------------------
 class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define window = QMainWindow() or Qwidget()
-    def __init__(self, parent=None):
+    # input_source: where pen samples come from (see input_source.py). Default: the Wintab tablet.
+    # poll: whether to start polling the input source with a timer (the headless benchmark polls by itself)
+    # save_binary_trajectories: the default of the session configuration's binary store option (see trajstore)
+    def __init__(self, parent=None, input_source=None, poll=True, save_binary_trajectories=False):
         super(MainWindow, self).__init__(parent)
         self.title = "WriTracker Recorder"
         # Establish tablet connection & Start polling
+        self.input_source = input_source if input_source is not None else WintabSource()
         hWnd = int(self.winId())                            # Get current window's window handle
-        wintab.hctx = wintab.OpenTabletContexts(hWnd)       # context handle for the tablet polling function.
+        self.input_source.open(hWnd)
         self.poll_timer = QTimer(self)
         self.poll_timer.timeout.connect(self.tabletPoll)    # Start timer & Run polling function
-        self.poll_timer.start(TABLET_POLL_TIME)
+        if poll:
+            self.poll_timer.start(TABLET_POLL_TIME)
+        self.packet_stats = PacketStats()                   # per-trial counters of tablet packets
         # pen settings & variables
         self.pen_x = 0
         self.pen_xtilt = 0
@@ -71,8 +127,8 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         self.cyclic_remaining_targets = True    # Controls whether ERROR target returns to end of the targets line
         self.allow_sound_play = False
         self.skip_ok_targets = False        # Controls viewing mode: when True, skip targets where RC = "ok".
+        self.save_binary_trajectories = save_binary_trajectories   # Also save each trial in the session's binary store (see trajstore)
 
-        self.path = QPainterPath()
         # UI settings
         uic.loadUi(os.path.dirname(__file__) + os.sep + 'recorder_ui.ui', self)
         self.cfg_window = QDialog()
@@ -102,6 +158,7 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         self.tablet_paint_area = self.findChild(QGraphicsView, 'tablet_paint_graphicsview')
         self.scene = QGraphicsScene()
         self.tablet_paint_area.setScene(self.scene)
+        self.ink = InkRenderer(self.scene, self)    # draws the pen's path
         # UI - labels (mostly used for statistics)
         self.lbl_targetsfile = self.findChild(QLabel, 'stats_targetsname_label')
         self.lbl_total_targets = self.findChild(QLabel, 'stats_total_label')
@@ -152,14 +209,24 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         self.tablet_paint_area.fitInView(800, 600, 0, 0, Qt.KeepAspectRatio)  # reset the graphicsView scaling
         self.show()
 
+    # Read all the packets queued since the last poll, and process them in order
     def tabletPoll(self):
-        lpPkts = (wintab.PACKET * 100)()
-        lpPkts  = wintab.GetPackets()
-        if lpPkts == 0:  # no packets received
-            return
-        self.pen_x = lpPkts[0].pkX
-        self.pen_y = lpPkts[0].pkY
-        new_pressure = int(lpPkts[0].pkNormalPressure/327.67)      # normalized to 0-100 range
+        n_total = 0
+        while True:
+            n_packets, packets = self.input_source.read_packets()
+            for i in range(n_packets):
+                self.packet_stats.packet_received(packets[i])
+                self.process_packet(packets[i])
+            n_total += n_packets
+            if n_packets < self.input_source.max_packets:   # otherwise, more packets may still be waiting in the queue
+                break
+        if n_total > 0:
+            self.ink.schedule_refresh()
+
+    def process_packet(self, packet):
+        self.pen_x = packet.pkX
+        self.pen_y = packet.pkY
+        new_pressure = int(packet.pkNormalPressure/327.67)      # normalized to 0-100 range
         # mark Trial started flag, but only if the ok/error are not checked.
         # this allows buffer time from the moment we chose RC to pressing next and avoid new file creation
         if self.btn_radio_ok.isChecked() is False and self.btn_radio_err.isChecked() is False and self.session_started:
@@ -169,18 +236,19 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
                 self.start_trial()
 
         if self.pen_pressure == 0 and new_pressure > 0:     # "TabletPress"
-            self.path.moveTo(QPoint(self.pen_x, self.pen_y))
+            self.ink.pen_down(self.pen_x, self.pen_y)
         elif self.pen_pressure > 0 and new_pressure == 0:   # "TabletRelease"
             if self.session_started:
                 # When the pen leaves the surface, add a sample point with zero pressure
-                self.current_active_trajectory.add_row(self.pen_x, self.pen_y, 0)
+                self.current_active_trajectory.add_row(self.pen_x, self.pen_y, 0, packet.pkTime)
         elif new_pressure > 0:                                               # it's a "TabletMove" event
-            self.path.lineTo(QPoint(self.pen_x, self.pen_y))
-        self.update()                                       # calls paintEvent
+            self.ink.pen_move(self.pen_x, self.pen_y)
         self.pen_pressure = new_pressure
         # write to traj file:
         if self.current_active_trajectory is not None and self.session_started:
-            self.current_active_trajectory.add_row(self.x_resolution - self.pen_x, self.pen_y, self.pen_pressure)   # Fix tablet mirroring-flip X axis
+            # Fix tablet mirroring-flip X axis
+            self.current_active_trajectory.add_row(self.x_resolution - self.pen_x, self.pen_y, self.pen_pressure, packet.pkTime)
+        self.packet_stats.processed += 1
 
     """ This is the old function to get tablet information using events. 
         it work well, but does not allow recording tablet move above the surface ('hovering') """
@@ -212,9 +280,6 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
     #     tabletEvent.accept()
     #     self.update()                   # calls paintEvent behind the scenes
 
-    def paintEvent(self, event):
-        self.scene.addPath(self.path)
-
     #               -------------------------- Button/Menu Functions --------------------------
     # This function rotates the graphicsView, then calculates the rotation factor for the points in the traj file.
     def f_btn_rotate(self):
@@ -304,6 +369,7 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         answer = msg.question(self, 'Reset current Target', "This action will also delete the current trajectory file\n Press yes to confirm", msg.Yes | msg.No, msg.No)
         if answer == msg.Yes:
             print("Writracker: trajectory file deleted, " + str(self.current_active_trajectory))
+            self.current_active_trajectory.close()
             os.remove(str(self.current_active_trajectory))
             self.set_recording_on()
             if self.allow_sound_play:
@@ -383,7 +449,8 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
                 self.save_trials_file()
                 self.save_remaining_targets_file()
             self.poll_timer.stop()
-            wintab.CloseTabletContext(wintab.hctx)
+            self.close_trajectory()
+            self.input_source.close()
             self.close()
 
     def f_btn_end_ssn(self):
@@ -533,6 +600,10 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
                                    "or leave empty to use default error types")
         lineedit_error_types = QLineEdit(objectName="lineedit_error_types")
         lineedit_error_types.setPlaceholderText("Spelling, Motor, Incomplete")
+        cbox_binary_store = QCheckBox("Also save the trajectories in a binary file (trajectories.npy), which the "
+                                      "analysis scripts load faster than the CSV files")
+        cbox_binary_store.setChecked(self.save_binary_trajectories)
+        cbox_binary_store.toggled.connect(self.cfg_set_save_binary_trajectories)
         # Add everything to the the main layout, layout_v (vertical)
         layout_v.addWidget(label_sound_folder)
         layout_v.addWidget(choose_folder_btn)
@@ -541,6 +612,7 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         layout_v.addLayout(layout_h)
         layout_v.addWidget(label_error_types)
         layout_v.addWidget(lineedit_error_types)
+        layout_v.addWidget(cbox_binary_store)
         layout_v.addWidget(ok_btn)
         if not self.allow_sound_play:
             choose_folder_btn.setEnabled(False)
@@ -564,6 +636,10 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
     def cfg_set_cyclic_targets_on(self):
         self.cyclic_remaining_targets = True
 
+    # ----------------------------------------------------------------------------------
+    def cfg_set_save_binary_trajectories(self, checked):
+        self.save_binary_trajectories = checked
+
     #               -------------------------- rest of the Functions --------------------------
 
     # start logging data from the tablet. The trigger might come from play button, or tabletEvent
@@ -571,6 +647,7 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         print("Writracker: Starting new trial\n")
         self.trial_started = True
         self.current_trial_start_time = datetime.now().strftime("%H:%M:%S")
+        self.packet_stats.reset()
         self.set_recording_on()
 
     # ----------------------------------------------------------------------------------
@@ -635,6 +712,7 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         self.remaining_targets_file = None
         self.trials_file = None
         self.trial_unique_id = 1
+        self.close_trajectory()
         self.current_active_trajectory = None
         self.results_folder_path = None
         self.targets = []
@@ -690,9 +768,13 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
     # ----------------------------------------------------------------------------------
 
     def close_current_trial(self):
+        self.current_active_trajectory.close()     # write all buffered samples to the file
+        print("Writracker: tablet packets in trial: " + str(self.packet_stats))
         # Rotate trajectory file if a rotation was applied during the writing
         if self.rotation_angle != 180:
             self.current_active_trajectory.rotate_trajectory_file(self.rotation_angle)
+        if self.save_binary_trajectories:
+            self.save_trial_to_store(self.trial_unique_id)
         # Handle RC code: Read radio buttons & read value from the combo box error list
         rc_code = "noValue"
         if self.btn_radio_ok.isChecked() is True:
@@ -712,6 +794,19 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
         current_target.rc_code = rc_code    # Update the target's RC code based on the last evaluated trial
         self.trial_unique_id += 1
 
+    # ----------------------------------------------------------------------------------
+    # Copy the current trial's trajectory (as saved in the CSV file, after rotation) to the binary store
+    def save_trial_to_store(self, trial_id):
+        try:
+            points = pd.read_csv(self.current_active_trajectory.full_path, usecols=['x', 'y', 'pressure', 'time'])
+            trajstore.save_trial(self.results_folder_path, trial_id, 1,
+                                 trajstore.create_points(points.x, points.y, points.pressure, points.time),
+                                 self.current_active_trajectory.full_path)
+        except (IOError, FileNotFoundError, ValueError):
+            QMessageBox().critical(self, "Warning! file access error",
+                                   "WriTracker couldn't save the trajectory in the binary trajectory store. "
+                                   "The trajectory CSV file was saved.", QMessageBox.Ok)
+
     # ----------------------------------------------------------------------------------
     def stats_reset(self):
         self.stats['total_targets'] = 0
@@ -807,9 +902,15 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
     # ----------------------------------------------------------------------------------
     def open_trajectory(self, unique_id):
         name = "trajectory_"+unique_id
+        self.close_trajectory()
         self.current_active_trajectory = Trajectory(name, self.results_folder_path)
         self.current_active_trajectory.open_traj_file("header")
 
+    # ----------------------------------------------------------------------------------
+    def close_trajectory(self):
+        if self.current_active_trajectory is not None:
+            self.current_active_trajectory.close()
+
     # ----------------------------------------------------------------------------------
     def set_recording_on(self):
         print("Writracker: rec_on()")
@@ -828,9 +929,7 @@ class MainWindow(QMainWindow):  # inherits QMainWindow, can equally define windo
 
     # ----------------------------------------------------------------------------------
     def clean_display(self):
-        self.scene.clear()
-        self.path = QPainterPath()  # Re-declare path for a fresh start
-        self.update()               # update view after re-declare
+        self.ink.clear()
 
     # ----------------------------------------------------------------------------------
     def update_target_textfields(self, target, target_id):
@@ -940,6 +1039,7 @@ def check_if_tablet_connected_mac():
 # Check if a wacom tablet is connected. This check works on windows device - depended on wintab32 library
 # The check isn't blocking the program from running - for the case the device status is not 100% reliable.
 def check_if_tablet_connected_windows():
+    from wacom_recorder import wintab
     tablet_name = wintab.getTabletInfo()
     if tablet_name is not None:
         print("WintabW: Tablet Found: {}".format(tablet_name))
@@ -953,11 +1053,100 @@ def check_if_tablet_connected_windows():
 
 
 # ---------------------------------------------------------------------------------------------------------
-def main():
+def main(input_source=None, save_binary_trajectories=False):
     global app
     app = QApplication(sys.argv)        # must initialize when working with pyqt5. can send arguments using argv
     app.setStyle('Fusion')
-    mainform = MainWindow()
+    mainform = MainWindow(input_source=input_source, save_binary_trajectories=save_binary_trajectories)
     mainform.show()
-    check_if_tablet_connected()
+    if input_source is None:
+        check_if_tablet_connected()
     sys.exit(app.exec_())                 # set exit code ass the app exit code
+
+
+# ---------------------------------------------------------------------------------------------------------
+# Run the recorder's input path (polling, sample processing, trajectory writing, ink rendering) headlessly,
+# feeding it from the given input source until the source is exhausted. No user interaction is needed.
+# Set QT_QPA_PLATFORM=offscreen to run without a display.
+# Returns a dict with throughput and per-poll latency statistics.
+def benchmark(input_source, results_folder):
+    global app
+    app = QApplication.instance() or QApplication(sys.argv)
+    window = MainWindow(input_source=input_source, poll=False)
+    window.results_folder_path = results_folder
+    window.targets = [Target("benchmark", "benchmark")]
+    window.curr_target_index = 0
+    window.session_start_time = datetime.now().strftime("%H:%M:%S")
+    window.session_started = True
+
+    poll_durations = []
+    start_time = time.perf_counter()
+    while not input_source.finished:
+        poll_start = time.perf_counter()
+        window.tabletPoll()
+        app.processEvents()
+        poll_durations.append(time.perf_counter() - poll_start)
+        if input_source.realtime:
+            time.sleep(TABLET_POLL_TIME / 1000)
+    # No trial is started if the replayed input has no pen-down samples
+    trajectory = window.current_active_trajectory
+    if trajectory is not None:
+        trajectory.close()
+    duration = time.perf_counter() - start_time
+    window.poll_timer.stop()
+    window.close()
+
+    poll_durations = np.array(poll_durations) * 1000
+    has_polls = len(poll_durations) > 0
+    return dict(n_samples=window.packet_stats.processed, duration_s=duration,
+                samples_per_s=window.packet_stats.processed / duration if duration > 0 else 0,
+                dropped=window.packet_stats.dropped,
+                poll_ms_mean=poll_durations.mean() if has_polls else None,
+                poll_ms_p99=np.percentile(poll_durations, 99) if has_polls else None,
+                poll_ms_max=poll_durations.max() if has_polls else None,
+                trajectory_file=str(trajectory) if trajectory is not None else None)
+
+
+def _benchmark_main(args):
+    parser = argparse.ArgumentParser(prog="python -m wacom_recorder.recorder benchmark",
+                                     description="Benchmark the recorder headlessly, using replayed pen input")
+    parser.add_argument("trajectory_files", nargs="*", help="trajectory_*.csv files to replay (default: synthetic handwriting)")
+    parser.add_argument("--rate", type=float, default=None, help="packets per second (default: recorded timing, or 200 Hz for synthetic input)")
+    parser.add_argument("--n-chars", type=int, default=100, help="number of synthetic characters")
+    parser.add_argument("--max-speed", action="store_true", help="deliver packets as fast as possible, not in real time")
+    parser.add_argument("--out", default=None, help="results folder (default: a temporary folder)")
+    opts = parser.parse_args(args)
+
+    if opts.trajectory_files:
+        source = ReplaySource.from_trajectory_files(opts.trajectory_files, rate_hz=opts.rate, realtime=not opts.max_speed)
+    else:
+        source = ReplaySource.synthetic(n_chars=opts.n_chars, rate_hz=opts.rate or 200, realtime=not opts.max_speed)
+    results_folder = opts.out or tempfile.mkdtemp(prefix="writracker_benchmark_")
+    # Fail here: a write error in the recorder window opens a message box, which nobody can close in a headless run
+    try:
+        os.makedirs(results_folder, exist_ok=True)
+    except OSError as e:
+        parser.error("cannot create the results folder {}: {}".format(results_folder, e))
+    if not os.access(results_folder, os.W_OK):
+        parser.error("the results folder {} is not writable".format(results_folder))
+    stats = benchmark(source, results_folder)
+    for key, value in stats.items():
+        print("{}: {}".format(key, value))
+
+
+def _main_from_command_line(args):
+    parser = argparse.ArgumentParser(prog="python -m wacom_recorder.recorder",
+                                     description="WriTracker Recorder. Use 'benchmark' as the first argument to run the "
+                                                 "headless benchmark.")
+    parser.add_argument("--binary-store", action="store_true",
+                        help="also save each trial in the session's binary trajectory store (trajectories.npy). "
+                             "This can also be set in the session configuration window.")
+    opts = parser.parse_args(args)
+    main(save_binary_trajectories=opts.binary_store)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        _benchmark_main(sys.argv[2:])
+    else:
+        _main_from_command_line(sys.argv[1:])
@@ -1,7 +1,9 @@
 from datetime import datetime, date
 from PyQt5.QtWidgets import *
 import pandas as pd
-import csv
+import numpy as np
+import threading
+import time
 import os
 
 
@@ -44,41 +46,77 @@ class Trial:
                + str(self.abs_time)+"|"
 
 
+# -------------------------------------------------------------------------------------------------------------
+# Durability of the trajectory files: samples are written to disk in batches, from a background thread.
+# A batch is written when this number of samples was accumulated, or after this interval - whichever comes first.
+# All samples are always written when the trial's trajectory is closed.
+TRAJ_FLUSH_EVERY_N_SAMPLES = 200
+TRAJ_FLUSH_EVERY_MS = 500
+
+
 # -------------------------------------------------------------------------------------------------------------
 class Trajectory:
-    def __init__(self, filename, filepath):
+    def __init__(self, filename, filepath, flush_every_n_samples=None, flush_every_ms=None):
         self.filename = filename
         self.filepath = filepath
         self.full_path = self.filepath + os.sep + self.filename + ".csv"
-        self.file_handle = None
-        self.start_time = datetime.now().strftime("%M:%S:%f")[:-2]
+        self.file_handle = None         # TrajectoryWriter, open while samples are recorded
+        self.flush_every_n_samples = flush_every_n_samples or TRAJ_FLUSH_EVERY_N_SAMPLES
+        self.flush_every_ms = flush_every_ms or TRAJ_FLUSH_EVERY_MS
+        self.start_time = time.perf_counter()
+        self.device_time_origin = None  # device timestamp (ms) that corresponds to start_time
 
     def __str__(self):
         return self.full_path
 
     def open_traj_file(self, row):
         try:
-            with open(self.full_path, mode='a+', encoding='utf-8') as traj_file:
-                self.file_handle = csv.DictWriter(traj_file, ['x', 'y', 'pressure', 'time'], lineterminator='\n')
-                if row == "header":
-                    self.file_handle.writeheader()
-                else:
-                    self.file_handle.writerow(row)
+            if self.file_handle is None:
+                self.file_handle = TrajectoryWriter(self.full_path, ['x', 'y', 'pressure', 'time'],
+                                                    self.flush_every_n_samples, self.flush_every_ms)
+            if row == "header":
+                self.file_handle.write_header()
+            else:
+                self.file_handle.write(row['x'], row['y'], row['pressure'], row['time'])
         except (IOError, FileNotFoundError):
-            QMessageBox().critical(None, "Warning! file access error",
-                                   "WriTracker couldn't save Trajectory file. Last trial trajectory"
-                                   " wasn't saved. If the problem repeats, restart the session.",
-                                   QMessageBox.Ok)
+            self.file_handle = None
+            self._show_write_error()
             raise Exception("Error writing trajectory file in:" + self.filepath + os.sep + self.filename + ".csv")
 
-    def add_row(self, x_cord, y_cord, pressure):
-        time_abs = datetime.now().strftime("%M:%S:%f")[:-2]
-        time_relative = datetime.strptime(time_abs, "%M:%S:%f") - datetime.strptime(self.start_time, "%M:%S:%f")
-        row = dict(x=x_cord, y=y_cord, pressure=pressure, time=time_relative.total_seconds())
+    # device_time_ms: the sample's timestamp from the tablet (e.g. Wintab's PK_TIME). If not provided, the
+    # sample is timestamped when add_row() is called.
+    def add_row(self, x_cord, y_cord, pressure, device_time_ms=None):
+        if device_time_ms is None:
+            time_relative = round(time.perf_counter() - self.start_time, 4)
+        else:
+            if self.device_time_origin is None:
+                self.device_time_origin = device_time_ms - (time.perf_counter() - self.start_time) * 1000
+            time_relative = round((device_time_ms - self.device_time_origin) / 1000, 4)
+        row = dict(x=x_cord, y=y_cord, pressure=pressure, time=time_relative)
         self.open_traj_file(row)
 
+    # Write all pending samples and close the file. Samples added later re-open the file in append mode.
+    def close(self):
+        if self.file_handle is None:
+            return
+        writer = self.file_handle
+        self.file_handle = None
+        try:
+            writer.close()
+        except (IOError, FileNotFoundError):
+            self._show_write_error()
+            raise Exception("Error writing trajectory file in:" + self.filepath + os.sep + self.filename + ".csv")
+
     def reset_start_time(self):
-        self.start_time = datetime.now().strftime("%M:%S:%f")[:-2]
+        self.start_time = time.perf_counter()
+        self.device_time_origin = None
+
+    @staticmethod
+    def _show_write_error():
+        QMessageBox().critical(None, "Warning! file access error",
+                               "WriTracker couldn't save Trajectory file. Last trial trajectory"
+                               " wasn't saved. If the problem repeats, restart the session.",
+                               QMessageBox.Ok)
 
     # This function rotates trajectory file by angle degrees. Angle must be one of the following: 0, 90, 270.
     # Angle of 0 will cause 180 degrees rotation. This is due to mismatch between the tablet & PyQt Coordinate system.
@@ -94,6 +132,7 @@ class Trajectory:
             cos_ang = 0
             sin_ang = -1
 
+        self.close()
         fields = ['x', 'y', 'pressure', 'time']
         try:
             raw_points = pd.read_csv(self.full_path, usecols=fields)
@@ -118,3 +157,86 @@ class Trajectory:
             QMessageBox().critical(None, "Warning! file access error",
                                    "Rotation was not applied to active trajectory", QMessageBox.Ok)
             return False
+
+
+# -------------------------------------------------------------------------------------------------------------
+# Writes the samples of one trajectory file. The file is kept open; samples are accumulated in a preallocated
+# buffer and written in batches by a background thread, so the caller (the Qt event loop) never waits for the disk.
+# I/O errors in the background thread are re-raised on the next call to write() or close().
+class TrajectoryWriter:
+    def __init__(self, full_path, fieldnames, flush_every_n_samples, flush_every_ms):
+        self.full_path = full_path
+        self.fieldnames = fieldnames
+        self.flush_every_n_samples = flush_every_n_samples
+        self.flush_every_ms = flush_every_ms
+        self._fp = open(full_path, mode='a+', encoding='utf-8')
+        # Two buffers: the caller fills one while the writer thread saves the other
+        capacity = max(1024, 4 * flush_every_n_samples)
+        self._buffer = np.empty((capacity, len(fieldnames)))
+        self._spare_buffer = np.empty((capacity, len(fieldnames)))
+        self._n_samples = 0
+        self._lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="TrajectoryWriter", daemon=True)
+        self._thread.start()
+
+    def write_header(self):
+        self._raise_pending_error()
+        with self._lock:
+            self._fp.write(",".join(self.fieldnames) + "\n")
+
+    def write(self, *values):
+        self._raise_pending_error()
+        with self._lock:
+            if self._n_samples == len(self._buffer):   # the writer thread is behind: grow rather than drop samples
+                self._buffer = np.concatenate([self._buffer, np.empty_like(self._buffer)])
+            self._buffer[self._n_samples] = values
+            self._n_samples += 1
+            if self._n_samples >= self.flush_every_n_samples:
+                self._flush_requested.set()
+
+    # Write all pending samples, stop the writer thread and close the file
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._flush_requested.set()
+            self._thread.join()
+            self._fp.close()
+        self._raise_pending_error()
+
+    def _raise_pending_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(self.flush_every_ms / 1000)
+            self._flush_requested.clear()
+            try:
+                self._write_pending_samples()
+            except (IOError, OSError) as e:
+                self._error = e
+            if self._closed:
+                break
+        # close() may have been called while the last batch was written
+        try:
+            self._write_pending_samples()
+        except (IOError, OSError) as e:
+            self._error = e
+
+    def _write_pending_samples(self):
+        with self._lock:
+            n = self._n_samples
+            if n == 0:
+                return
+            samples = self._buffer
+            if len(self._spare_buffer) < len(samples):
+                self._spare_buffer = np.empty_like(samples)
+            self._buffer, self._spare_buffer = self._spare_buffer, samples
+            self._n_samples = 0
+        np.savetxt(self._fp, samples[:n], fmt='%.10g', delimiter=',')
+        self._fp.flush()
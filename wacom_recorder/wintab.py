@@ -48,7 +48,7 @@ PK_TANGENT_PRESSURE = 0X0800  # tangential or barrel pressure
 
 # ** Modify PACKETDATA's OR condition to add/remove packet information **
 # Don't forget to modify PACKET  (in wintab_params.py) structure fields to match the values below
-PACKETDATA = (PK_CHANGED | PK_CURSOR | PK_X | PK_Y | PK_BUTTONS | PK_NORMAL_PRESSURE | PK_SERIAL_NUMBER)
+PACKETDATA = (PK_TIME | PK_CHANGED | PK_CURSOR | PK_X | PK_Y | PK_BUTTONS | PK_NORMAL_PRESSURE | PK_SERIAL_NUMBER)
 
 # Context Option values
 CXO_SYSTEM          = 0x0001  # Specifies that the context is a system cursor context.
@@ -147,13 +147,14 @@ hctx = None  # Context handle, used across importing modules (recorder.py)
 
 # -- Reads the latest packets the the tablets packet queue --
 # use this function after calling OpenTabletContext()
-# return lpPkts PACKET array if any packet was received, 0 otherwise.
+# return (n, lpPkts): the number of packets received, and a PACKET array whose first n elements are the packets,
+# oldest first. The array is reused by the next call, so process the packets before calling again.
+MAX_PACKETS = 100
+_packets_buffer = (PACKET * MAX_PACKETS)()
+
+
 def GetPackets():
     global hctx
-    cMaxPkts = 100
-    lpPkts = (PACKET * 100)()
-    recv_num = wintab.WTPacketsGet(hctx, cMaxPkts, lpPkts)
-    if recv_num > 0:
-        return lpPkts
-    return 0
+    recv_num = wintab.WTPacketsGet(hctx, MAX_PACKETS, _packets_buffer)
+    return recv_num, _packets_buffer
 
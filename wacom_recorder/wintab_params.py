@@ -35,7 +35,8 @@ class ROTATION(Structure):
 
 
 class PACKET(Structure):        # Contains only the fields currently in PACKETDATA
-    _fields_ = [("pkChanged", WTPKT),           ("pkSerialNumber", c_uint),      ("pkCursor", c_uint),
+    _fields_ = [("pkTime", DWORD),
+                ("pkChanged", WTPKT),           ("pkSerialNumber", c_uint),      ("pkCursor", c_uint),
                 ("pkButtons", DWORD),           ("pkX", LONG),                   ("pkY", LONG),
                 ("pkNormalPressure", c_uint),]
 